@@ -8,8 +8,23 @@ module kb_GenericsReport {
     */
     typedef int boolean;
 
+    /*
+      html_dir: directory of the generated heatmap report
+      cluster_strategy: clustering path taken for 'rows' and 'columns' (exact or kmeans_two_stage).
+                        Only set when the data was clustered
+      value_summary: count, min, max, mean and approximate median of the heatmap values
+      metrics: seconds spent in every stage (<stage>_s: read, select, sort, cluster,
+               truncate, dendrogram, figure, write) and in the parts of cluster spent on
+               cluster_rows and cluster_columns (which may run concurrently), with the peak
+               RSS (MB) during each stage (<stage>_peak_rss_mb), total_s, peak_rss_mb, the rows
+               and columns of the matrix, heatmap_rows after truncation and output_bytes of
+               html_dir
+    */
     typedef structure {
         string html_dir;
+        mapping<string, string> cluster_strategy;
+        mapping<string, float> value_summary;
+        mapping<string, float> metrics;
     } build_heatmap_html_result;
 
     /*
@@ -20,9 +35,63 @@ module kb_GenericsReport {
       cluster_data: True if data should be clustered. Default: True
       sort_by_sum: True if data should be sorted by sum of values. Default: False
       top_percent: Only display top x percent of data. Default: 100
+      top_by: row statistic used to select the top_percent rows (sum, mean, max or variance).
+              Default: sum
       centered_by: set midpoint of color range. Default: None
       dist_metric: distance metric used for clustering. Default: euclidean (https://docs.scipy.org/doc/scipy/reference/generated/scipy.spatial.distance.pdist.html)
       linkage_method: linkage method used for clustering. Default: ward (https://docs.scipy.org/doc/scipy/reference/generated/scipy.cluster.hierarchy.linkage.html)
+      leaf_ordering: order of the dendrogram leaves among the equivalent flips of the tree.
+                     none: as merged by the linkage, optimal: adjacent leaves as close as
+                     possible (exact up to optimal-leaf-ordering-max-leaves leaves, greedy
+                     above), greedy: each merge flips its sub-trees so the leaves meeting at
+                     the junction are closest. Default: none
+      cluster_memory_budget_mb: memory (in MB) exact clustering may use for its distance matrix.
+                                Larger matrices are clustered with k-means pre-aggregation
+                                followed by hierarchical clustering of the centroids.
+                                Default: cluster-memory-budget-mb in deploy.cfg (4096)
+      plotlyjs_mode: how the report loads plotly.js. inline: embedded in the report html,
+                     directory: written once as plotly.min.js next to the report html (a
+                     batch index_page shares one copy next to index.html between its
+                     reports), cdn: loaded from the plotly CDN. Default: inline
+      gzip_html: True if gzip precompressed copies (.gz) of the report files should be written
+                 next to them. Default: False
+      z_encoding: how heatmap values are stored in the report html. json: plain JSON numbers,
+                  float32: base64 encoded float32 array, uint16/uint8: base64 encoded values
+                  quantised evenly over the color_scale, sparse: base64 encoded CSR
+                  arrays of the non-zero float32 values. Binary encodings are decoded
+                  in the browser. Default: json
+      raster_cell_threshold: matrices with more cells are drawn as a server-side rendered image
+                             with a coarse hover layer instead of a plotly heatmap, 0 disables
+                             rasterising. Default: raster-cell-threshold of the module config
+                             (1000000)
+      raster_aggregation: how cells sharing an image pixel or a zoom pyramid cell are combined,
+                          one of mean or max. Default: mean
+      tile_pyramid: store matrices longer than 256 cells on either axis as a zoom pyramid of
+                    binary tiles in html_dir; the report shows the overview level and fetches
+                    finer tiles on zoom, so html_dir has to be served over http. Default: False
+      color_scale: how colours are spread over the values, computed from the data.
+                   quantile: evenly over the value quantiles, log10: evenly over
+                   log10(value + pseudo_count), diverging: symmetric around centered_by.
+                   Default: diverging if centered_by is set, log10 otherwise
+      pseudo_count: added to the values of the log10 color_scale. Default: 1
+      color_clip_percent: values below this percentile and above 100 - color_clip_percent share
+                          the end colours (0 to below 50). Default: 0
+      sparse: True if the matrix is mostly zeros (e.g. amplicon/OTU tables). It is then kept as
+              a sparse matrix while loading, selecting top rows and clustering with the cosine,
+              jaccard or braycurtis dist_metric. Default: False
+      precision: numeric type the matrix is loaded, clustered and serialised in (float64 or
+                 float32). float32 halves memory and payload size; the json z_encoding is
+                 then replaced by float32. Default: float64
+      truncate_levels: cut the row dendrogram to the merges up to this many levels below the
+                       root; the rows of every cluster cut off are collapsed into one heatmap
+                       row labelled with its first and last row and row count
+      truncate_distance: cut the row dendrogram to the merges above this distance instead,
+                         collapsing rows the same way
+      truncate_aggregation: how collapsed rows are combined: mean, max or sum. Default: mean
+      profile: True to profile the call; html_dir then also holds profile.pstats (cProfile
+               statistics) and profile.collapsed (sampled stacks for flame graphs). Setting the
+               KB_GENERICSREPORT_PROFILE environment variable profiles every call.
+               Default: False
 
     */
     typedef structure {
@@ -31,11 +100,54 @@ module kb_GenericsReport {
         boolean cluster_data;
         boolean sort_by_sum;
         int top_percent;
+        string top_by;
         float centered_by;
         string dist_metric;
         string linkage_method;
+        string leaf_ordering;
+        int cluster_memory_budget_mb;
+        string plotlyjs_mode;
+        boolean gzip_html;
+        string z_encoding;
+        int raster_cell_threshold;
+        string raster_aggregation;
+        boolean tile_pyramid;
+        string color_scale;
+        float pseudo_count;
+        float color_clip_percent;
+        boolean sparse;
+        string precision;
+        boolean profile;
+        int truncate_levels;
+        float truncate_distance;
+        string truncate_aggregation;
     } build_heatmap_html_params;
 
     funcdef build_heatmap_html(build_heatmap_html_params params) returns (build_heatmap_html_result output) authentication required;
 
+    /*
+      required params:
+      params_list: build_heatmap_html parameter sets, one heatmap per entry
+
+      optional params:
+      index_page: True if the report directories should be collected under one directory with
+                  an index.html linking every heatmap. Default: False
+    */
+    typedef structure {
+        list<build_heatmap_html_params> params_list;
+        boolean index_page;
+    } build_heatmap_html_batch_params;
+
+    /*
+      results: build_heatmap_html result of every parameter set, in params_list order
+      index_dir: directory holding index.html and the report directories. Only set with
+                 index_page
+    */
+    typedef structure {
+        list<build_heatmap_html_result> results;
+        string index_dir;
+    } build_heatmap_html_batch_result;
+
+    funcdef build_heatmap_html_batch(build_heatmap_html_batch_params params) returns (build_heatmap_html_batch_result output) authentication required;
+
 };
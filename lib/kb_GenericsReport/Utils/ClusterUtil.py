@@ -0,0 +1,488 @@
+import logging
+import math
+import warnings
+
+import numpy as np
+
+from kb_GenericsReport.Utils.SparseUtil import sparse_pdist, supports_sparse_pdist
+
+EXACT_STRATEGY = 'exact'
+TWO_STAGE_STRATEGY = 'kmeans_two_stage'
+
+# bytes per condensed distance entry, doubled as scipy.linkage works on its own copy
+CONDENSED_ENTRY_BYTES = 8 * 2
+
+KMEANS_SEED = 1234
+
+NO_LEAF_ORDERING = 'none'
+OPTIMAL_LEAF_ORDERING = 'optimal'
+GREEDY_LEAF_ORDERING = 'greedy'
+LEAF_ORDERINGS = [NO_LEAF_ORDERING, OPTIMAL_LEAF_ORDERING, GREEDY_LEAF_ORDERING]
+# largest axis ordered with the exact optimal leaf ordering, whose cost grows with the cube of
+# the leaves (about 1s for 1000 leaves, 8s for 2000)
+DEFAULT_OPTIMAL_LEAF_ORDERING_MAX_LEAVES = 1000
+
+# (left sub-tree end, right sub-tree end) meeting at a merge, in order of preference on ties:
+# 0 is the first and 1 the last leaf of the sub-tree as it is
+JUNCTIONS = [(1, 0), (0, 0), (1, 1), (0, 1)]
+# sums held at once by a (min, +) matrix product of the optimal leaf ordering
+MIN_PLUS_BLOCK = 2 ** 22
+
+# how the rows of a collapsed cluster are combined into one heatmap row
+COLLAPSE_AGGREGATIONS = ['mean', 'max', 'sum']
+
+
+class ClusterResult:
+    """
+    ClusterResult: linkage matrices and leaf orders of a clustered matrix
+
+    Computed once by HeatmapUtil._cluster_data and reused both for reordering the matrix and
+    for drawing the dendrograms, so distances and linkages are never recomputed.
+
+    row_linkage/col_linkage: scipy linkage matrices of the rows and columns
+    row_order/col_order: row and column labels in dendrogram leaf order
+    row_strategy/col_strategy: clustering path taken for each axis (EXACT_STRATEGY or
+                               TWO_STAGE_STRATEGY)
+    """
+
+    def __init__(self, row_linkage, row_order, col_linkage, col_order,
+                 row_strategy=EXACT_STRATEGY, col_strategy=EXACT_STRATEGY):
+        self.row_linkage = row_linkage
+        self.row_order = row_order
+        self.col_linkage = col_linkage
+        self.col_order = col_order
+        self.row_strategy = row_strategy
+        self.col_strategy = col_strategy
+
+    @property
+    def strategy(self):
+        return {'rows': self.row_strategy, 'columns': self.col_strategy}
+
+
+def max_exact_leaves(memory_budget):
+    """
+    max_exact_leaves: largest number of observations whose condensed distance matrix fits
+                      into memory_budget (in bytes)
+    """
+    return max(2, int(math.sqrt(2 * memory_budget / CONDENSED_ENTRY_BYTES)))
+
+
+def linkage_memory(observation_count, memory_budget):
+    """
+    linkage_memory: bytes clustering observation_count observations takes at most, their
+                    condensed distance matrix but no more than memory_budget
+    """
+    return min(memory_budget,
+               observation_count * (observation_count - 1) // 2 * CONDENSED_ENTRY_BYTES)
+
+
+def select_cluster_strategy(observation_count, memory_budget):
+    """
+    select_cluster_strategy: pick the clustering path for observation_count observations
+
+    The exact path materialises the full condensed pdist vector, so it is only used while
+    that vector fits into memory_budget (in bytes).
+    """
+    if observation_count <= max_exact_leaves(memory_budget):
+        return EXACT_STRATEGY
+    return TWO_STAGE_STRATEGY
+
+
+def select_leaf_ordering(leaf_ordering, observation_count, strategy, max_optimal_leaves):
+    """
+    select_leaf_ordering: leaf ordering actually applied to an axis of observation_count
+
+    optimal falls back to greedy for axes longer than max_optimal_leaves, and for the
+    two-stage strategy whose full distance matrix is never computed
+    """
+    if (leaf_ordering == OPTIMAL_LEAF_ORDERING and
+            (strategy != EXACT_STRATEGY or observation_count > max_optimal_leaves)):
+        return GREEDY_LEAF_ORDERING
+    return leaf_ordering
+
+
+def exact_linkage(values, dist_metric, linkage_method, optimal_ordering=False):
+    """
+    exact_linkage: hierarchical clustering over the full pairwise distance matrix
+
+    values: dense array or scipy sparse matrix, densified only for metrics sparse_pdist lacks
+    optimal_ordering: reorder the leaves with optimal_leaf_ordering, reusing the distance
+                      matrix
+    """
+    from scipy.cluster.hierarchy import linkage
+    from scipy.spatial.distance import pdist, squareform
+
+    if hasattr(values, 'tocsr') and supports_sparse_pdist(values, dist_metric):
+        dist_matrix = sparse_pdist(values, dist_metric)
+    else:
+        if hasattr(values, 'tocsr'):
+            values = values.toarray()
+        dist_matrix = pdist(values, metric=dist_metric)
+    linkage_matrix = linkage(dist_matrix, method=linkage_method)
+    if optimal_ordering:
+        linkage_matrix = optimal_leaf_ordering(linkage_matrix,
+                                               squareform(dist_matrix.astype(np.float64)))
+
+    return linkage_matrix
+
+
+def _kmeans_space(values, dist_metric):
+    # k-means partitions in euclidean space; angular metrics are approximated by
+    # partitioning (centered) unit vectors instead
+    if dist_metric not in ['cosine', 'correlation']:
+        return values
+
+    if dist_metric == 'correlation':
+        values = values - values.mean(axis=1, keepdims=True)
+    norms = np.linalg.norm(values, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+
+    return values / norms
+
+
+def _partition(values, dist_metric, cluster_count):
+    """
+    _partition: k-means pre-aggregation, returns the member indices of each non-empty cluster
+    """
+    from scipy.cluster.vq import kmeans2
+
+    with warnings.catch_warnings(), np.errstate(invalid='ignore', divide='ignore'):
+        # empty clusters and degenerate seeding are handled below
+        warnings.simplefilter('ignore')
+        _, assignment = kmeans2(_kmeans_space(values, dist_metric), cluster_count,
+                                minit='++', seed=KMEANS_SEED)
+
+    order = np.argsort(assignment, kind='stable')
+    boundaries = np.flatnonzero(np.diff(assignment[order])) + 1
+    members = np.split(order, boundaries)
+
+    if len(members) < 2:
+        # k-means could not separate the observations (e.g. identical rows),
+        # fall back to contiguous chunks so the recursion always shrinks
+        members = np.array_split(np.arange(values.shape[0]), cluster_count)
+
+    return members
+
+
+def _relabel(sub_linkage, node_ids):
+    relabeled = sub_linkage.copy()
+    relabeled[:, 0] = node_ids[sub_linkage[:, 0].astype(int)]
+    relabeled[:, 1] = node_ids[sub_linkage[:, 1].astype(int)]
+    return relabeled
+
+
+def two_stage_linkage(values, dist_metric, linkage_method, max_leaves):
+    """
+    two_stage_linkage: memory-bounded hierarchical clustering of a large matrix
+
+    Observations are first pre-aggregated with k-means, every cluster is then clustered on its
+    own and the cluster centroids are clustered to join the sub-trees into a single linkage
+    matrix over all observations. No distance matrix ever holds more than max_leaves
+    observations, so peak memory is bounded by the budget max_leaves was derived from.
+    """
+    values = np.asarray(values)
+    if values.dtype != np.float32:
+        values = values.astype(np.float64, copy=False)
+    observation_count = values.shape[0]
+    if observation_count <= max_leaves:
+        return exact_linkage(values, dist_metric, linkage_method)
+
+    cluster_count = int(min(max_leaves, max(2, math.ceil(math.sqrt(observation_count)))))
+    members = _partition(values, dist_metric, cluster_count)
+    logging.info('Pre-aggregated {} observations into {} k-means clusters'.format(
+                                                        observation_count, len(members)))
+
+    merges = list()
+    next_node_id = observation_count
+    root_ids = np.empty(len(members), dtype=float)
+    root_counts = np.empty(len(members), dtype=float)
+    max_sub_height = 0.
+
+    for i, member_idx in enumerate(members):
+        root_counts[i] = member_idx.size
+        if member_idx.size == 1:
+            root_ids[i] = member_idx[0]
+            continue
+
+        sub_linkage = two_stage_linkage(values[member_idx], dist_metric, linkage_method,
+                                        max_leaves)
+        internal_ids = np.arange(next_node_id, next_node_id + member_idx.size - 1)
+        merges.append(_relabel(sub_linkage, np.concatenate([member_idx, internal_ids])))
+
+        next_node_id += member_idx.size - 1
+        root_ids[i] = next_node_id - 1
+        max_sub_height = max(max_sub_height, sub_linkage[:, 2].max())
+
+    centroids = np.array([values[member_idx].mean(axis=0) for member_idx in members])
+    top_linkage = exact_linkage(centroids, dist_metric, linkage_method)
+
+    top_ids = np.concatenate([root_ids, np.arange(next_node_id,
+                                                  next_node_id + len(members) - 1)])
+    top_counts = np.concatenate([root_counts, np.zeros(len(members) - 1)])
+    for i, (left, right) in enumerate(top_linkage[:, :2].astype(int)):
+        top_counts[len(members) + i] = top_counts[left] + top_counts[right]
+
+    top_merges = _relabel(top_linkage, top_ids)
+    # keep the joined tree monotonic: centroid merges sit above every sub-tree
+    top_merges[:, 2] += max_sub_height
+    top_merges[:, 3] = top_counts[len(members):]
+    merges.append(top_merges)
+
+    return np.vstack(merges)
+
+
+def _swap_children(linkage_matrix, swap):
+    swapped = linkage_matrix.copy()
+    swapped[swap, 0] = linkage_matrix[swap, 1]
+    swapped[swap, 1] = linkage_matrix[swap, 0]
+    return swapped
+
+
+def _first_positions(children, order):
+    # position of the first leaf of every node in the leaf order
+    leaf_count = children.shape[0] + 1
+    positions = np.empty(2 * leaf_count - 1, dtype=np.intp)
+    positions[order] = np.arange(leaf_count)
+    for i, (left, right) in enumerate(children.tolist()):
+        positions[leaf_count + i] = min(positions[left], positions[right])
+    return positions
+
+
+def _min_plus(left, right):
+    # (min, +) matrix product, in row blocks of at most MIN_PLUS_BLOCK sums
+    rows = max(1, MIN_PLUS_BLOCK // max(1, left.shape[1] * right.shape[1]))
+    return np.vstack([(left[start:start + rows, :, None] + right[None, :, :]).min(axis=1)
+                      for start in range(0, left.shape[0], rows)])
+
+
+def optimal_leaf_ordering(linkage_matrix, distances):
+    """
+    optimal_leaf_ordering: linkage_matrix with its merges flipped so the sum of the distances
+                           between adjacent leaves is minimal
+
+    Dynamic programming over the tree (Bar-Joseph et al. 2001): for every merge, the shortest
+    path through its leaves between any leaf of one child and any leaf of the other is kept,
+    n^2 / 2 values over the whole tree, and the best path is traced back from the root. Time
+    grows with the cube of the leaves. scipy's optimal_leaf_ordering is not used as it misses
+    the optimum on many trees.
+
+    distances: square distance matrix of the leaves
+    """
+    children = linkage_matrix[:, :2].astype(np.intp)
+    leaf_count = children.shape[0] + 1
+    node_count = 2 * leaf_count - 1
+    leaves = [np.array([i]) for i in range(leaf_count)] + [None] * (leaf_count - 1)
+    # blocks[node][a, b]: shortest path from the a-th leaf of the left child of node to the
+    # b-th leaf of its right child
+    blocks = [None] * node_count
+
+    def path_costs(node):
+        # shortest paths between any two leaves of node, inf if both are on the same side
+        if node < leaf_count:
+            return np.zeros((1, 1))
+        block = blocks[node]
+        left_size = block.shape[0]
+        costs = np.full((leaves[node].size,) * 2, np.inf)
+        costs[:left_size, left_size:] = block
+        costs[left_size:, :left_size] = block.T
+        return costs
+
+    for i, (left, right) in enumerate(children):
+        node = leaf_count + i
+        leaves[node] = np.concatenate([leaves[left], leaves[right]])
+        between = distances[np.ix_(leaves[left], leaves[right])]
+        blocks[node] = _min_plus(_min_plus(path_costs(left), between), path_costs(right))
+
+    # trace the path back: each merge is entered at start and left at end, the leaves where
+    # its children meet are those minimising the path
+    root = node_count - 1
+    start, end = np.unravel_index(np.argmin(blocks[root]), blocks[root].shape)
+    local_index = np.empty(leaf_count, dtype=np.intp)
+    order = list()
+    pending = [(root, leaves[children[-1, 0]][start], leaves[children[-1, 1]][end])]
+    while pending:
+        node, start, end = pending.pop()
+        if node < leaf_count:
+            order.append(node)
+            continue
+        first_child, second_child = children[node - leaf_count]
+        if start not in leaves[first_child]:
+            first_child, second_child = second_child, first_child
+        local_index[leaves[first_child]] = np.arange(leaves[first_child].size)
+        local_index[leaves[second_child]] = np.arange(leaves[second_child].size)
+        costs = (path_costs(first_child)[local_index[start], :, None] +
+                 distances[np.ix_(leaves[first_child], leaves[second_child])] +
+                 path_costs(second_child)[None, :, local_index[end]])
+        first_end, second_start = np.unravel_index(np.argmin(costs), costs.shape)
+        pending.append((second_child, leaves[second_child][second_start], end))
+        pending.append((first_child, start, leaves[first_child][first_end]))
+
+    # a merge is swapped if its right child holds the first leaf of the path
+    positions = _first_positions(children, order)
+
+    return _swap_children(linkage_matrix, positions[children[:, 1]] < positions[children[:, 0]])
+
+
+def greedy_leaf_ordering(linkage_matrix, values, dist_metric):
+    """
+    greedy_leaf_ordering: linkage_matrix with its sub-trees flipped so adjacent leaves are close
+
+    Bottom-up, every merge keeps or reverses each of its two sub-trees so the leaves meeting at
+    the junction are the closest of the four candidate pairs. It takes one pass of 4 distances
+    per merge instead of the cubic optimal leaf ordering; the tree, and so every cluster, stays
+    the same, only the children of merges are swapped.
+
+    values: observations the linkage was computed from, dense array or scipy sparse matrix
+    """
+    from scipy.spatial.distance import cdist
+
+    children = linkage_matrix[:, :2].astype(np.intp)
+    leaf_count = children.shape[0] + 1
+    node_count = 2 * leaf_count - 1
+
+    # outer leaves of every sub-tree as oriented so far, and whether a sub-tree is reversed
+    # relative to its parent
+    first = np.arange(node_count)
+    last = np.arange(node_count)
+    flipped = np.zeros(node_count, dtype=bool)
+    for i, (left, right) in enumerate(children):
+        ends = [first[left], last[left], first[right], last[right]]
+        rows = values[ends]
+        if hasattr(rows, 'toarray'):
+            rows = rows.toarray()
+        # distances[a, b]: left end a to right end b; undefined distances never win
+        distances = np.nan_to_num(cdist(rows[:2], rows[2:], metric=dist_metric), nan=np.inf)
+        left_end, right_end = min(JUNCTIONS, key=lambda junction: distances[junction])
+
+        flipped[left] = left_end == 0
+        flipped[right] = right_end == 1
+        first[leaf_count + i] = ends[1] if flipped[left] else ends[0]
+        last[leaf_count + i] = ends[2] if flipped[right] else ends[3]
+
+    # top-down, a sub-tree is reversed if an odd number of its ancestors (itself included)
+    # were flipped; reversing a merge swaps its children
+    reversed_nodes = np.zeros(node_count, dtype=bool)
+    for i in range(leaf_count - 2, -1, -1):
+        for child in children[i]:
+            reversed_nodes[child] = reversed_nodes[leaf_count + i] ^ flipped[child]
+
+    return _swap_children(linkage_matrix, reversed_nodes[leaf_count:])
+
+
+def truncate_linkage(linkage_matrix, levels=None, distance=None):
+    """
+    truncate_linkage: (truncated_linkage, group_sizes) of the tree cut to its top merges
+
+    Either the merges up to levels below the root are kept (as scipy's dendrogram
+    truncate_mode='level'), or those above distance; the root is always kept, so at least two
+    groups remain. Every sub-tree hanging off a kept merge becomes
+    a single leaf of truncated_linkage. Leaves are numbered in leaf order, so group i holds the
+    group_sizes[i] observations following those of groups 0 to i - 1 in leaves_list order of
+    linkage_matrix.
+    """
+    from scipy.cluster.hierarchy import leaves_list
+
+    children = linkage_matrix[:, :2].astype(np.intp)
+    leaf_count = children.shape[0] + 1
+
+    # top-down, a merge is kept if its parent is and it is within levels or above distance
+    kept = np.zeros(leaf_count - 1, dtype=bool)
+    kept[-1] = True
+    depth = np.zeros(2 * leaf_count - 1, dtype=np.intp)
+    for i in range(leaf_count - 2, -1, -1):
+        if not kept[i]:
+            continue
+        for child in children[i]:
+            depth[child] = depth[leaf_count + i] + 1
+            if child >= leaf_count:
+                if levels is not None:
+                    kept[child - leaf_count] = depth[child] <= levels
+                else:
+                    kept[child - leaf_count] = linkage_matrix[child - leaf_count, 2] > distance
+
+    kept_merges = np.flatnonzero(kept)
+    kept_children = children[kept_merges]
+    group_nodes = kept_children[~np.isin(kept_children, kept_merges + leaf_count)]
+    positions = _first_positions(children, leaves_list(linkage_matrix))
+    group_nodes = group_nodes[np.argsort(positions[group_nodes])]
+
+    sizes = np.ones(2 * leaf_count - 1, dtype=np.intp)
+    sizes[leaf_count:] = linkage_matrix[:, 3]
+    group_count = group_nodes.size
+
+    node_ids = np.full(2 * leaf_count - 1, -1, dtype=np.intp)
+    node_ids[group_nodes] = np.arange(group_count)
+    node_ids[kept_merges + leaf_count] = np.arange(group_count, 2 * group_count - 1)
+
+    truncated_linkage = np.empty((group_count - 1, 4))
+    truncated_linkage[:, :2] = node_ids[kept_children]
+    truncated_linkage[:, 2] = linkage_matrix[kept_merges, 2]
+    counts = np.ones(2 * group_count - 1)
+    for i, (left, right) in enumerate(truncated_linkage[:, :2].astype(np.intp).tolist()):
+        counts[group_count + i] = counts[left] + counts[right]
+    truncated_linkage[:, 3] = counts[group_count:]
+
+    return truncated_linkage, sizes[group_nodes]
+
+
+def collapse_rows(values, group_sizes, how='mean'):
+    """
+    collapse_rows: one row per group of consecutive rows, combined with how (mean, max or sum)
+
+    values: dense array or scipy sparse matrix; sparse values stay sparse and only their
+            non-zero values are visited
+    """
+    starts = np.concatenate([[0], np.cumsum(group_sizes)[:-1]])
+    if not hasattr(values, 'tocsr'):
+        ufunc = np.maximum if how == 'max' else np.add
+        collapsed = ufunc.reduceat(values, starts, axis=0)
+        if how == 'mean':
+            collapsed = collapsed / np.asarray(group_sizes, dtype=collapsed.dtype)[:, None]
+        return collapsed
+
+    from scipy import sparse
+
+    coo = values.tocoo()
+    groups = np.repeat(np.arange(len(group_sizes)), group_sizes)[coo.row]
+    shape = (len(group_sizes), values.shape[1])
+    if how != 'max':
+        collapsed = sparse.csr_matrix((coo.data, (groups, coo.col)), shape=shape)
+        if how == 'mean':
+            collapsed = sparse.diags(1. / np.asarray(group_sizes, dtype=float)) @ collapsed
+        return collapsed.astype(values.dtype).tocsr()
+
+    # the maximum of the stored values, or 0 where a group has implicit zeros in a column
+    maximum = np.full(shape, -np.inf)
+    np.maximum.at(maximum, (groups, coo.col), coo.data)
+    stored = sparse.csr_matrix((np.ones_like(coo.data), (groups, coo.col)), shape=shape)
+    has_zeros = stored.toarray() < np.asarray(group_sizes)[:, None]
+    maximum[has_zeros] = np.maximum(maximum[has_zeros], 0)
+
+    return sparse.csr_matrix(maximum.astype(values.dtype))
+
+
+def compute_linkage(values, dist_metric, linkage_method, strategy, memory_budget,
+                    leaf_ordering=NO_LEAF_ORDERING):
+    """
+    compute_linkage: (linkage_matrix, ordered_index) of values clustered along strategy
+
+    module level function, so independent axes can be clustered in worker processes
+    leaf_ordering: leaf ordering as returned by select_leaf_ordering; none keeps the order
+                   scipy's linkage merges in
+    """
+    if strategy == EXACT_STRATEGY:
+        linkage_matrix = exact_linkage(values, dist_metric, linkage_method,
+                                       optimal_ordering=leaf_ordering == OPTIMAL_LEAF_ORDERING)
+    else:
+        if hasattr(values, 'tocsr'):
+            # k-means pre-aggregation works on dense observations
+            values = values.toarray()
+        linkage_matrix = two_stage_linkage(values, dist_metric, linkage_method,
+                                           max_exact_leaves(memory_budget))
+
+    if leaf_ordering == GREEDY_LEAF_ORDERING:
+        linkage_matrix = greedy_leaf_ordering(linkage_matrix, values, dist_metric)
+
+    from scipy.cluster.hierarchy import leaves_list
+
+    return linkage_matrix, leaves_list(linkage_matrix)
@@ -0,0 +1,128 @@
+import re
+
+import numpy as np
+
+QUANTILE_SCALE = 'quantile'
+LOG10_SCALE = 'log10'
+DIVERGING_SCALE = 'diverging'
+COLOR_SCALES = [QUANTILE_SCALE, LOG10_SCALE, DIVERGING_SCALE]
+# colour positions linear in the values, as for the diverging scale
+LINEAR_TRANSFORM = 'linear'
+
+# plotly OrRd without its near-white first colour, and RdBu
+SEQUENTIAL_COLORS = ['rgb(254,232,200)', 'rgb(253,212,158)', 'rgb(253,187,132)',
+                     'rgb(252,141,89)', 'rgb(239,101,72)', 'rgb(215,48,31)', 'rgb(179,0,0)',
+                     'rgb(127,0,0)']
+DIVERGING_COLORS = ['rgb(103,0,31)', 'rgb(178,24,43)', 'rgb(214,96,77)', 'rgb(244,165,130)',
+                    'rgb(253,219,199)', 'rgb(247,247,247)', 'rgb(209,229,240)',
+                    'rgb(146,197,222)', 'rgb(67,147,195)', 'rgb(33,102,172)', 'rgb(5,48,97)']
+
+QUANTILE_BREAKS = 10
+# piecewise linear stops approximating the log10 colour mapping
+LOG10_BREAKS = 32
+DEFAULT_PSEUDO_COUNT = 1.
+# values beyond the clip percentiles share the end colours
+MAX_CLIP_PERCENT = 50
+
+
+def parse_color(color):
+    """
+    parse_color: [r, g, b] of a '#rrggbb' or 'rgb(r, g, b)' colour
+    """
+    if color.startswith('#'):
+        return [int(color[i:i + 2], 16) for i in (1, 3, 5)]
+    return [float(channel) for channel in re.findall(r'[\d.]+', color)[:3]]
+
+
+def _sample_colors(colors, fractions):
+    """
+    _sample_colors: colours at fractions (0 to 1) of the evenly spaced palette colors
+    """
+    rgb = np.array([parse_color(color) for color in colors], dtype=float)
+    palette_stops = np.linspace(0, 1, len(colors))
+    channels = [np.interp(fractions, palette_stops, rgb[:, channel]) for channel in range(3)]
+
+    return ['rgb({},{},{})'.format(*np.rint(color).astype(int)) for color in zip(*channels)]
+
+
+def _stops(positions, colors):
+    """
+    _stops: plotly colorscale of colors at increasing positions, stretched to 0 and 1
+
+    the last colour of positions shared by several breaks wins
+    """
+    colorscale = list()
+    for position, color in zip(positions, colors):
+        position = float(min(max(position, 0.), 1.))
+        if colorscale and position <= colorscale[-1][0]:
+            colorscale[-1][1] = color
+        else:
+            colorscale.append([position, color])
+
+    colorscale[0][0] = 0.
+    if len(colorscale) == 1:
+        colorscale.append([1., colorscale[0][1]])
+    colorscale[-1][0] = 1.
+
+    return colorscale
+
+
+def compute_color_scale(sketch, color_scale, centered_by=None, pseudo_count=DEFAULT_PSEUDO_COUNT,
+                        clip_percent=0):
+    """
+    compute_color_scale: data driven colour scale from a QuantileSketch of the values
+
+    quantile: colours change evenly over the value quantiles
+    log10: colours change evenly over log10(value + pseudo_count), values below 0 share the
+           lowest colour
+    diverging: symmetric around centered_by (0 if not set), reaching the value furthest away
+
+    clip_percent: outliers below this percentile and above 100 - clip_percent share the end
+                  colours instead of stretching the scale
+
+    the heatmap values stay untransformed; the breaks are placed as stops of a plotly
+    colorscale over the returned cmin/cmax range. transform describes the mapping of values
+    to colour positions, for quantising them where the colours change (see encode_z)
+
+    returns dict of colorscale, cmin, cmax and transform
+    """
+    low, high = clip_percent / 100., 1 - clip_percent / 100.
+
+    if color_scale == QUANTILE_SCALE:
+        breaks = sketch.quantiles(np.linspace(low, high, QUANTILE_BREAKS + 1))
+        scale = _sequential_scale(breaks, float(breaks[0]), float(breaks[-1]))
+        scale['transform'] = {'type': QUANTILE_SCALE,
+                              'breaks': [float(value) for value in breaks]}
+        return scale
+
+    vmin, vmax = [float(value) for value in sketch.quantiles([low, high])]
+
+    if color_scale == DIVERGING_SCALE:
+        center = float(centered_by) if centered_by is not None else 0.
+        half_range = max(vmax - center, center - vmin)
+        positions = np.linspace(0, 1, len(DIVERGING_COLORS))
+        # low values blue, high values red
+        return {'colorscale': _stops(positions, DIVERGING_COLORS[::-1]),
+                'cmin': center - half_range,
+                'cmax': center + half_range,
+                'transform': {'type': LINEAR_TRANSFORM}}
+
+    if color_scale == LOG10_SCALE:
+        cmin, cmax = max(vmin, 0.), max(vmax, 0.)
+        log_breaks = np.linspace(np.log10(cmin + pseudo_count), np.log10(cmax + pseudo_count),
+                                 LOG10_BREAKS)
+        scale = _sequential_scale(10 ** log_breaks - pseudo_count, cmin, cmax)
+        scale['transform'] = {'type': LOG10_SCALE, 'pseudo_count': float(pseudo_count)}
+        return scale
+
+    raise ValueError('Unsupported color scale: {}'.format(color_scale))
+
+
+def _sequential_scale(breaks, cmin, cmax):
+    value_range = cmax - cmin
+    positions = (breaks - cmin) / value_range if value_range > 0 else np.zeros(len(breaks))
+    colors = _sample_colors(SEQUENTIAL_COLORS, np.linspace(0, 1, len(breaks)))
+
+    return {'colorscale': _stops(positions, colors),
+            'cmin': cmin,
+            'cmax': cmax}
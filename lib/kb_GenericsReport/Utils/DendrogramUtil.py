@@ -0,0 +1,88 @@
+import numpy as np
+
+# distance between two adjacent leaves in scipy dendrogram coordinates
+LEAF_SPACING = 10
+# first colour of plotly's qualitative Set2 palette
+DEFAULT_LINE_COLOR = 'rgb(102,194,165)'
+
+
+def leaf_positions(leaf_count):
+    """
+    leaf_positions: axis positions of the dendrogram leaves (5, 15, 25, ...)
+    """
+    return np.arange(leaf_count) * LEAF_SPACING + LEAF_SPACING / 2
+
+
+def dendrogram_segments(linkage_matrix):
+    """
+    dendrogram_segments: (leaf axis, height axis) coordinates of every link of a dendrogram
+
+    Same layout as scipy's dendrogram (leaves at leaf_positions in leaves_list order, a merge
+    centred between its children) without its recursion: node positions are filled in one
+    pass over the merges, which always come after their children, and the links are built as
+    arrays. Every link is the 4 corners of its bracket followed by a NaN gap, so all links of a
+    dendrogram draw as a single line trace.
+    """
+    from scipy.cluster.hierarchy import leaves_list
+
+    children = linkage_matrix[:, :2].astype(np.intp)
+    heights = linkage_matrix[:, 2]
+    leaf_count = children.shape[0] + 1
+
+    positions = np.empty(leaf_count)
+    positions[leaves_list(linkage_matrix)] = leaf_positions(leaf_count)
+    node_positions = positions.tolist()
+    for left, right in children.tolist():
+        node_positions.append((node_positions[left] + node_positions[right]) / 2)
+    positions = np.asarray(node_positions)
+
+    node_heights = np.concatenate([np.zeros(leaf_count), heights])
+    left, right = children[:, 0], children[:, 1]
+    gaps = np.full(children.shape[0], np.nan)
+    xs = np.column_stack([positions[left], positions[left], positions[right], positions[right],
+                          gaps])
+    ys = np.column_stack([node_heights[left], heights, heights, node_heights[right], gaps])
+
+    return xs.ravel(), ys.ravel()
+
+
+def build_dendrogram(linkage_matrix, ordered_labels, orientation='bottom',
+                     line_color=DEFAULT_LINE_COLOR):
+    """
+    build_dendrogram: build a dendrogram figure from a precomputed linkage matrix
+
+    Drawn like plotly.figure_factory.create_dendrogram, except the linkage matrix computed
+    while clustering is reused instead of running distfun/linkagefun again, and all links are
+    a single trace (see dendrogram_segments) instead of one trace per link.
+
+    ordered_labels: leaf labels in linkage leaf order (as returned by leaves_list)
+    orientation: 'bottom' draws a column dendrogram above the heatmap, 'left' draws a row
+                 dendrogram to the right side of the heatmap
+    """
+    if orientation not in ['bottom', 'left']:
+        raise ValueError('Unsupported dendrogram orientation: {}'.format(orientation))
+
+    import plotly.graph_objects as go
+
+    leaf_axis, height_axis = dendrogram_segments(linkage_matrix)
+
+    # same sign convention as figure_factory: the row dendrogram grows along the negative y axis
+    if orientation == 'bottom':
+        xs, ys = leaf_axis, height_axis
+    else:
+        xs, ys = height_axis, -leaf_axis
+
+    trace = go.Scatter(x=xs, y=ys, mode='lines', line=dict(color=line_color, width=1),
+                       hoverinfo='skip')
+
+    label_axis = 'xaxis' if orientation == 'bottom' else 'yaxis'
+    tickvals = leaf_positions(len(ordered_labels))
+    if orientation == 'left':
+        tickvals = -tickvals
+
+    fig = go.Figure(data=[trace])
+    fig.update_layout({label_axis: {'ticktext': list(ordered_labels),
+                                    'tickvals': tickvals.tolist(),
+                                    'tickmode': 'array'}})
+
+    return fig
@@ -0,0 +1,176 @@
+import base64
+import json
+
+import numpy as np
+
+from kb_GenericsReport.Utils.ColorScaleUtil import LINEAR_TRANSFORM, LOG10_SCALE, QUANTILE_SCALE
+
+SPARSE_Z_ENCODING = 'sparse'
+
+# z_encoding -> little endian dtype of the encoded payload (of the non-zero values for sparse)
+Z_ENCODINGS = {'float32': '<f4',
+               'uint16': '<u2',
+               'uint8': 'u1',
+               SPARSE_Z_ENCODING: '<f4'}
+# row pointers and column indices of the sparse payload
+SPARSE_INDEX_DTYPE = '<i4'
+
+# decodes the payload into a Float32Array and swaps it into the heatmap trace;
+# {plot_id} is filled in by plotly.io.write_html
+DECODE_Z_SCRIPT = """
+(function() {
+    var encoded = %s;
+    var decode = function(data) {
+        var binary = atob(data);
+        var bytes = new Uint8Array(binary.length);
+        for (var i = 0; i < binary.length; i++) {
+            bytes[i] = binary.charCodeAt(i);
+        }
+        return bytes;
+    };
+    var bytes = decode(encoded.data);
+    var rows = encoded.shape[0], columns = encoded.shape[1];
+    var values;
+    if (encoded.dtype === 'float32') {
+        values = new Float32Array(bytes.buffer);
+    } else if (encoded.dtype === 'sparse') {
+        var data = new Float32Array(bytes.buffer);
+        var indptr = new Int32Array(decode(encoded.indptr).buffer);
+        var indices = new Int32Array(decode(encoded.indices).buffer);
+        values = new Float32Array(rows * columns);
+        for (var row = 0; row < rows; row++) {
+            for (var k = indptr[row]; k < indptr[row + 1]; k++) {
+                values[row * columns + indices[k]] = data[k];
+            }
+        }
+    } else {
+        // quantised in colour space, mapped back to values for the hover text
+        var transform = encoded.transform;
+        var toValue = function(t) {
+            if (transform.type === 'log10') {
+                var magnitude = transform.pseudo_count * (Math.pow(10, Math.abs(t)) - 1);
+                return t < 0 ? -magnitude : magnitude;
+            }
+            if (transform.type === 'quantile') {
+                var knots = transform.knots;
+                var segment = Math.min(Math.floor(t), knots.length - 2);
+                return knots[segment] + (t - segment) * (knots[segment + 1] - knots[segment]);
+            }
+            return t;
+        };
+        var quantized = encoded.dtype === 'uint16' ? new Uint16Array(bytes.buffer) : bytes;
+        var step = encoded.levels > 0 ? (encoded.tmax - encoded.tmin) / encoded.levels : 0;
+        values = new Float32Array(quantized.length);
+        for (var j = 0; j < quantized.length; j++) {
+            values[j] = toValue(encoded.tmin + quantized[j] * step);
+        }
+    }
+    var z = new Array(rows);
+    for (var r = 0; r < rows; r++) {
+        z[r] = Array.prototype.slice.call(values.subarray(r * columns, (r + 1) * columns));
+    }
+    Plotly.restyle('{plot_id}', {z: [z]}, [%d]);
+})();
+"""
+
+
+def _color_space(values, zmin, zmax, transform):
+    """
+    _color_space: (values mapped to colour positions, transform shipped to the decoder)
+
+    log10 uses sign(v) * log10(1 + |v| / pseudo_count), which spaces the values >= 0 as
+    log10(v + pseudo_count) does and stays invertible below 0. quantile maps the breaks,
+    widened to the minimum and maximum, to consecutive integers and interpolates in between
+    """
+    if transform['type'] == LOG10_SCALE:
+        pseudo_count = transform['pseudo_count']
+        return (np.sign(values) * np.log10(1 + np.abs(values) / pseudo_count),
+                {'type': LOG10_SCALE, 'pseudo_count': pseudo_count})
+
+    if transform['type'] == QUANTILE_SCALE:
+        knots = np.unique(np.clip(np.concatenate([[zmin], transform['breaks'], [zmax]]),
+                                  zmin, zmax))
+        if knots.size > 1:
+            return (np.interp(values, knots, np.arange(knots.size, dtype=np.float64)),
+                    {'type': QUANTILE_SCALE, 'knots': knots.tolist()})
+
+    return values, {'type': LINEAR_TRANSFORM}
+
+
+def encode_z(values, z_encoding, transform=None):
+    """
+    encode_z: base64 encoded typed array payload of the heatmap z values
+
+    float32 keeps the values, uint16/uint8 quantise them evenly over the colour positions of
+    transform (the 'transform' of compute_color_scale, linear in the values if None), so the
+    levels go where the colours change; the decoder maps them back to values for the hover.
+    sparse ships the non-zero float32 values in CSR layout, for mostly zero matrices
+
+    values: dense array or, for sparse, a scipy sparse matrix which is never densified
+    """
+    if z_encoding == SPARSE_Z_ENCODING:
+        return _encode_sparse_z(values)
+
+    values = np.asarray(values, dtype=np.float64)
+    zmin = float(values.min()) if values.size else 0.
+    zmax = float(values.max()) if values.size else 0.
+    dtype = np.dtype(Z_ENCODINGS[z_encoding])
+
+    encoded = {'dtype': z_encoding,
+               'shape': list(values.shape),
+               'zmin': zmin,
+               'zmax': zmax,
+               'levels': 0}
+    if dtype.kind == 'f':
+        payload = values.astype(dtype)
+    else:
+        positions, encoded['transform'] = _color_space(
+            values, zmin, zmax, transform or {'type': LINEAR_TRANSFORM})
+        tmin = float(positions.min()) if positions.size else 0.
+        tmax = float(positions.max()) if positions.size else 0.
+        levels = int(np.iinfo(dtype).max) if tmax > tmin else 0
+        scale = levels / (tmax - tmin) if levels else 0.
+        payload = np.rint((positions - tmin) * scale).astype(dtype)
+        encoded.update(levels=levels, tmin=tmin, tmax=tmax)
+
+    encoded['data'] = base64.b64encode(np.ascontiguousarray(payload).tobytes()).decode('ascii')
+
+    return encoded
+
+
+def _b64(array, dtype):
+    return base64.b64encode(np.ascontiguousarray(array, dtype=dtype).tobytes()).decode('ascii')
+
+
+def _encode_sparse_z(values):
+    from scipy import sparse
+
+    if sparse.issparse(values):
+        matrix = values.tocsr(copy=True)
+    else:
+        matrix = sparse.csr_matrix(np.asarray(values, dtype=np.float64))
+    matrix.sum_duplicates()
+    matrix.eliminate_zeros()
+
+    zmin = zmax = 0.
+    if matrix.nnz:
+        zmin, zmax = float(matrix.data.min()), float(matrix.data.max())
+        # implicit zeros take part unless every cell is stored
+        if matrix.nnz < matrix.shape[0] * matrix.shape[1]:
+            zmin, zmax = min(zmin, 0.), max(zmax, 0.)
+
+    return {'dtype': SPARSE_Z_ENCODING,
+            'shape': list(matrix.shape),
+            'zmin': zmin,
+            'zmax': zmax,
+            'levels': 0,
+            'indptr': _b64(matrix.indptr, SPARSE_INDEX_DTYPE),
+            'indices': _b64(matrix.indices, SPARSE_INDEX_DTYPE),
+            'data': _b64(matrix.data, Z_ENCODINGS[SPARSE_Z_ENCODING])}
+
+
+def decode_z_script(encoded_z, trace_index):
+    """
+    decode_z_script: post_script restoring the encoded z values of trace_index client-side
+    """
+    return DECODE_Z_SCRIPT % (json.dumps(encoded_z), trace_index)
@@ -1,19 +1,68 @@
 
 import errno
+import gzip
+import html
 import os
 import logging
-import pandas as pd
-from xlrd.biffh import XLRDError
+import numpy as np
 import uuid
-from scipy.cluster.hierarchy import linkage, leaves_list
-from scipy.spatial.distance import pdist
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 import json
-import sys
-from matplotlib import pyplot as plt
-import plotly.graph_objects as go
-from plotly.offline import plot
-import plotly.express as px
-import plotly.figure_factory as ff
+import shutil
+import time
+
+# plotly, scipy, matplotlib and pandas are imported on first use in the Utils modules, so
+# service start-up and status calls do not pay for them
+from kb_GenericsReport.Utils.ClusterUtil import (COLLAPSE_AGGREGATIONS,
+                                                 DEFAULT_OPTIMAL_LEAF_ORDERING_MAX_LEAVES,
+                                                 EXACT_STRATEGY, LEAF_ORDERINGS, NO_LEAF_ORDERING,
+                                                 TWO_STAGE_STRATEGY, ClusterResult, collapse_rows,
+                                                 compute_linkage, linkage_memory, max_exact_leaves,
+                                                 select_cluster_strategy, select_leaf_ordering,
+                                                 truncate_linkage)
+from kb_GenericsReport.Utils.ColorScaleUtil import (COLOR_SCALES, DEFAULT_PSEUDO_COUNT,
+                                                    DIVERGING_SCALE, LOG10_SCALE, MAX_CLIP_PERCENT,
+                                                    compute_color_scale)
+from kb_GenericsReport.Utils.DendrogramUtil import build_dendrogram
+from kb_GenericsReport.Utils.EncodingUtil import (SPARSE_Z_ENCODING, Z_ENCODINGS,
+                                                  decode_z_script, encode_z)
+from kb_GenericsReport.Utils.LinkageCacheUtil import LinkageCache
+from kb_GenericsReport.Utils.MatrixCacheUtil import MatrixCache
+from kb_GenericsReport.Utils.MetricsUtil import PipelineMetrics, paused_samplers, stage
+from kb_GenericsReport.Utils.ProfileUtil import (PROFILE_STACKS_FILE, PROFILE_STATS_FILE,
+                                                 CallProfiler, profile_enabled_by_env)
+from kb_GenericsReport.Utils.MatrixUtil import (TEXT_FORMAT, detect_file_format, read_matrix,
+                                                read_sparse_matrix, read_top_rows)
+from kb_GenericsReport.Utils.RasterUtil import (MAX_TICKS, RASTER_AGGREGATIONS, RASTER_MAX_HEIGHT,
+                                                RASTER_MAX_WIDTH, build_raster_heatmap,
+                                                downsample_ticks, label_ranges)
+from kb_GenericsReport.Utils.TileUtil import (TILE_DIR, TILE_SIZE, build_tile_pyramid,
+                                              tile_viewer_script)
+from kb_GenericsReport.Utils.SketchUtil import QuantileSketch, matrix_sketch
+from kb_GenericsReport.Utils.SparseUtil import (dense_values, is_sparse_frame, matrix_values,
+                                                to_sparse_frame)
+from kb_GenericsReport.Utils.SelectionUtil import (ROW_SCORE_FUNCTIONS, row_scores,
+                                                   top_k_indices, top_row_count)
+
+DEFAULT_CLUSTER_MEMORY_BUDGET_MB = 4096
+# plotlyjs_mode -> include_plotlyjs argument of plotly.offline.plot
+PLOTLYJS_MODES = {'inline': True,
+                  'directory': 'directory',
+                  'cdn': 'cdn'}
+DEFAULT_MATRIX_CACHE_SIZE_MB = 10240
+DEFAULT_LINKAGE_CACHE_ENTRIES = 16
+DEFAULT_LINKAGE_CACHE_SIZE_MB = 1024
+DEFAULT_RASTER_CELL_THRESHOLD = 1000000
+# one worker per axis
+DEFAULT_CLUSTER_WORKERS = 2
+# shortest axis worth clustering in a worker process of its own
+DEFAULT_CLUSTER_PARALLEL_MIN_LEAVES = 2000
+DEFAULT_BATCH_WORKERS = 4
+PROFILE_FILES = [PROFILE_STATS_FILE, PROFILE_STACKS_FILE]
+# precision -> numeric type the matrix is loaded, clustered and serialised in
+PRECISIONS = {'float64': np.float64,
+              'float32': np.float32}
 
 
 class HeatmapUtil:
@@ -32,56 +81,228 @@ class HeatmapUtil:
             else:
                 raise
 
-    def _compute_cluster_label_order(self, values, labels,
-                                     dist_metric='euclidean',
-                                     linkage_method='ward'):
+    def _compute_cluster_label_orders(self, axes,
+                                      dist_metric='euclidean',
+                                      linkage_method='ward',
+                                      memory_budget=None,
+                                      leaf_ordering=NO_LEAF_ORDERING,
+                                      metrics=None,
+                                      stage_names=None):
+        """
+        _compute_cluster_label_orders: (linkage, ordered_label, strategy) of every axis
+
+        axes: list of (values, labels) to cluster independently
+        linkages are reused from the linkage cache, the remaining axes are clustered
+        concurrently in a pool of up to cluster_workers processes if at least two of them have
+        cluster_parallel_min_leaves observations and together they fit into memory_budget
+        leaf_ordering: requested leaf ordering, optimal is applied to axes of up to
+                       optimal_leaf_ordering_max_leaves and greedy to longer ones
+        metrics/stage_names: PipelineMetrics the clustering time of every axis is added to as a
+                             part of the enclosing stage, under the name of the axis
+        """
+        if memory_budget is None:
+            memory_budget = self.cluster_memory_budget
+
+        results = [None] * len(axes)
+        pending = list()
+        for i, (values, labels) in enumerate(axes):
+            if len(labels) == 1:
+                results[i] = (None, labels, EXACT_STRATEGY)
+                continue
+
+            strategy = select_cluster_strategy(len(labels), memory_budget)
+            logging.info('Clustering {} observations with {} strategy'.format(len(labels),
+                                                                              strategy))
+
+            axis_leaf_ordering = select_leaf_ordering(leaf_ordering, len(labels), strategy,
+                                                      self.optimal_leaf_ordering_max_leaves)
+            if axis_leaf_ordering != leaf_ordering:
+                logging.info('Ordering {} leaves with {} leaf ordering'.format(
+                                                            len(labels), axis_leaf_ordering))
+
+            # the two-stage linkage depends on the budget through its k-means cluster count
+            cluster_count = (max_exact_leaves(memory_budget)
+                             if strategy == TWO_STAGE_STRATEGY else None)
+            cache_key = LinkageCache.key(values, dist_metric, linkage_method, strategy,
+                                         leaf_ordering=axis_leaf_ordering,
+                                         cluster_count=cluster_count)
+            cached = self.linkage_cache.get(cache_key)
+            if cached is not None:
+                logging.info('Reusing cached linkage {}'.format(cache_key))
+                if metrics is not None:
+                    metrics.add_part(stage_names[i], 0.)
+                linkage_matrix, ordered_index = cached
+                results[i] = (linkage_matrix, [labels[idx] for idx in ordered_index], strategy)
+            else:
+                pending.append((i, cache_key, strategy, axis_leaf_ordering))
+
+        tasks = [(axes[i][0], dist_metric, linkage_method, strategy, memory_budget,
+                  axis_leaf_ordering)
+                 for i, _, strategy, axis_leaf_ordering in pending]
+        observation_counts = [len(axes[i][1]) for i, _, _, _ in pending]
+        parallel_axes = len([count for count in observation_counts
+                             if count >= self.cluster_parallel_min_leaves])
+        concurrent_memory = sum(linkage_memory(count, memory_budget)
+                                for count in observation_counts)
+        workers = min(self.cluster_workers, parallel_axes)
+        if workers > 1 and concurrent_memory <= memory_budget:
+            # scipy linkage holds the GIL, so axes are clustered in separate processes. They
+            # are forked with the tasks of this call in a module global, so the values are
+            # shared with the workers instead of pickled
+            logging.info('Clustering {} axes in {} worker processes'.format(len(tasks), workers))
+            call_id = str(uuid.uuid4())
+            _cluster_tasks[call_id] = tasks
+            try:
+                # the workers are forked on submit, while no sampler thread holds a lock
+                with paused_samplers():
+                    executor = ProcessPoolExecutor(
+                                            max_workers=workers,
+                                            mp_context=multiprocessing.get_context('fork'))
+                    futures = [executor.submit(_timed_compute_cluster_task, call_id, task_index)
+                               for task_index in range(len(tasks))]
+                with executor:
+                    linkages = [future.result() for future in futures]
+            finally:
+                del _cluster_tasks[call_id]
+        else:
+            linkages = [_timed_compute_linkage(*task) for task in tasks]
+
+        for (i, cache_key, strategy, _), linkage_result in zip(pending, linkages):
+            linkage_matrix, ordered_index, seconds = linkage_result
+            if metrics is not None:
+                metrics.add_part(stage_names[i], seconds)
+            # dn = dendrogram(linkage_matrix, labels=labels, distance_sort='ascending')
+            # ordered_label = dn['ivl']
+            self.linkage_cache.put(cache_key, linkage_matrix, ordered_index)
+            labels = axes[i][1]
+            results[i] = (linkage_matrix, [labels[idx] for idx in ordered_index], strategy)
+
+        return results
+
+    def _read_csv_file(self, file_path, top_percent=100, top_by='sum', sketch=None,
+                       sparse=False, dtype=np.float64, metrics=None):
+        """
+        _read_csv_file: read the matrix file, missing values filled with 0
+
+        parsed matrices are memory-mapped from the matrix cache when enabled; with
+        top_percent < 100 text is only added to it if it surely fits. Otherwise, with
+        top_percent < 100, delimited text is streamed keeping only the top rows so the full
+        matrix is never held in memory
+
+        sketch: optional QuantileSketch filled with the values while loading; only filled when
+                all rows are kept
+        sparse: read the matrix into sparse columns; the matrix cache, which holds dense
+                values, is skipped
+        dtype: numeric type the values are parsed into
+        metrics: optional PipelineMetrics, top row selection of a loaded matrix is timed as
+                 select; streamed selection and filling missing values are part of reading
+        """
+        logging.info('Start reading data file: {}'.format(file_path))
 
-        if len(labels) == 1:
-            return labels
-        dist_matrix = pdist(values, metric=dist_metric)
-        linkage_matrix = linkage(dist_matrix, method=linkage_method)
+        if top_percent < 100:
+            sketch = None
 
-        # dn = dendrogram(linkage_matrix, labels=labels, distance_sort='ascending')
-        # ordered_label = dn['ivl']
+        df = None
+        if sparse:
+            df = read_sparse_matrix(file_path, dtype=dtype, sketch=sketch)
+        elif self.matrix_cache is not None:
+            # text that may not fit is only ingested when all rows are needed, a failed ingest
+            # would come on top of the two passes of read_top_rows
+            ingest = top_percent >= 100 or self.matrix_cache.fits(file_path, dtype=dtype)
+            df = self.matrix_cache.load(file_path, dtype=dtype, sketch=sketch, ingest=ingest)
 
-        ordered_index = leaves_list(linkage_matrix)
-        ordered_label = [labels[idx] for idx in ordered_index]
+        if df is None:
+            if top_percent < 100 and detect_file_format(file_path) == TEXT_FORMAT:
+                return read_top_rows(file_path, top_percent, top_by=top_by, dtype=dtype)
+            df = read_matrix(file_path, dtype=dtype, sketch=sketch)
 
-        return ordered_label
+        if top_percent < 100:
+            with stage(metrics, 'select'):
+                df = self._select_top_rows(df, top_percent, top_by)
 
-    def _read_csv_file(self, file_path):
-        logging.info('Start reading data file: {}'.format(file_path))
+        return df
 
-        try:
-            df = pd.read_excel(file_path, dtype='str',  index_col=0)
-        except XLRDError:
-            reader = pd.read_csv(file_path, sep=None, iterator=True)
-            inferred_sep = reader._engine.data.dialect.delimiter
-            df = pd.read_csv(file_path, sep=inferred_sep, index_col=0)
+    def _select_top_rows(self, df, top_percent, top_by):
+        """
+        _select_top_rows: keep the top_percent rows ranked by top_by, in their original order
+        """
+        logging.info('Start selecting top {} percent rows by {}'.format(top_percent, top_by))
 
-        df.fillna(0, inplace=True)
+        scores = row_scores(matrix_values(df), top_by=top_by)
+        top_idx = top_k_indices(scores, top_row_count(df.index.size, top_percent))
 
-        return df
+        return df.iloc[top_idx]
 
-    def _cluster_data(self, df, dist_metric, linkage_method):
+    def _cluster_data(self, df, dist_metric, linkage_method, memory_budget=None,
+                      leaf_ordering=NO_LEAF_ORDERING, metrics=None):
 
         logging.info('Start clustering data with distance metric {} and linkage method {}'.format(
                                                                     dist_metric, linkage_method))
 
-        col_ordered_label = self._compute_cluster_label_order(df.T.values.tolist(),
-                                                              df.T.index.tolist(),
-                                                              dist_metric=dist_metric,
-                                                              linkage_method=linkage_method)
-
-        idx_ordered_label = self._compute_cluster_label_order(df.values.tolist(),
-                                                              df.index.tolist(),
-                                                              dist_metric=dist_metric,
-                                                              linkage_method=linkage_method
-                                                              )
+        if is_sparse_frame(df):
+            # rows and columns stay sparse, see ClusterUtil.exact_linkage
+            values = matrix_values(df)
+            axes = [(values.T.tocsr(), df.columns.tolist()), (values, df.index.tolist())]
+        else:
+            # contiguous float buffers (float32 kept, anything else float64) instead of lists of
+            # Python floats. pandas usually hands out .values column-major (a view of its block,
+            # also after iloc/reindex), so the columns are a view and the rows the single copy;
+            # row-major values are the other way round
+            values = df.values
+            values = values.astype(np.result_type(values.dtype, np.float32), copy=False)
+            axes = [(np.ascontiguousarray(values.T), df.columns.tolist()),
+                    (np.ascontiguousarray(values), df.index.tolist())]
+
+        # columns and rows are independent and clustered concurrently
+        col_result, idx_result = self._compute_cluster_label_orders(
+                                                axes,
+                                                dist_metric=dist_metric,
+                                                linkage_method=linkage_method,
+                                                memory_budget=memory_budget,
+                                                leaf_ordering=leaf_ordering,
+                                                metrics=metrics,
+                                                stage_names=['cluster_columns', 'cluster_rows'])
+        col_linkage, col_ordered_label, col_strategy = col_result
+        idx_linkage, idx_ordered_label, idx_strategy = idx_result
 
         df = df.reindex(index=idx_ordered_label, columns=col_ordered_label)
 
-        return df
+        cluster_result = ClusterResult(idx_linkage, idx_ordered_label,
+                                       col_linkage, col_ordered_label,
+                                       row_strategy=idx_strategy, col_strategy=col_strategy)
+
+        return df, cluster_result
+
+    def _truncate_rows(self, df, cluster_result, levels=None, distance=None, how='mean'):
+        """
+        _truncate_rows: cut the row dendrogram to its top merges and collapse the rows of
+                        every cut off cluster into one row, combined with how
+
+        df: matrix in the row order of cluster_result
+        collapsed rows are labelled 'first … last (row count)'
+        """
+        import pandas as pd
+
+        truncated_linkage, group_sizes = truncate_linkage(cluster_result.row_linkage,
+                                                          levels=levels, distance=distance)
+        logging.info('Collapsed {} rows into {} clusters by {}'.format(df.index.size,
+                                                                       group_sizes.size, how))
+
+        starts = np.concatenate([[0], np.cumsum(group_sizes)[:-1]])
+        labels = ['{} ({})'.format(label, size) if size > 1 else label
+                  for label, size in zip(label_ranges(df.index.tolist(), starts), group_sizes)]
+        values = collapse_rows(matrix_values(df), group_sizes, how=how)
+        if is_sparse_frame(df):
+            df = to_sparse_frame(values, index=labels, columns=df.columns)
+        else:
+            df = pd.DataFrame(values, index=labels, columns=df.columns)
+
+        cluster_result = ClusterResult(truncated_linkage, labels,
+                                       cluster_result.col_linkage, cluster_result.col_order,
+                                       row_strategy=cluster_result.row_strategy,
+                                       col_strategy=cluster_result.col_strategy)
+
+        return df, cluster_result
 
     def _build_heatmap_data(self, data_df):
 
@@ -95,10 +316,161 @@ class HeatmapUtil:
 
         return heatmap_data
 
-    def _generate_heatmap_html(self, data_df, centered_by, cluster_data, dist_metric,
-                               linkage_method):
+    def _gzip_file(self, file_path):
+        """
+        _gzip_file: write a gzip precompressed copy (file_path.gz) next to file_path
+        """
+        with open(file_path, 'rb') as source_file:
+            with gzip.open(file_path + '.gz', 'wb') as gzip_file:
+                shutil.copyfileobj(source_file, gzip_file)
+
+    def _link_shared_plotlyjs(self, output_directory):
+        """
+        _link_shared_plotlyjs: hard link the shared plotly.min.js asset into output_directory
+
+        the asset is written to scratch once per plotly version and plotly.offline.plot leaves an
+        existing plotly.min.js in place. The link costs no space in scratch, but every report
+        directory has to carry plotly.min.js itself: html_dir is uploaded as a report of its
+        own, and a report cannot reference files of another upload. Reports collected under a
+        batch index page share a single copy instead (see _share_batch_plotlyjs)
+        """
+        import plotly
+        from plotly.offline import get_plotlyjs
+
+        asset_dir = os.path.join(self.scratch, 'plotlyjs', plotly.__version__)
+        asset_path = os.path.join(asset_dir, 'plotly.min.js')
+        if not os.path.exists(asset_path):
+            self._mkdir_p(asset_dir)
+            tmp_path = '{}.{}'.format(asset_path, uuid.uuid4())
+            with open(tmp_path, 'w', encoding='utf-8') as asset_file:
+                asset_file.write(get_plotlyjs())
+            os.rename(tmp_path, asset_path)
+
+        bundle_path = os.path.join(output_directory, 'plotly.min.js')
+        try:
+            os.link(asset_path, bundle_path)
+        except OSError:
+            shutil.copyfile(asset_path, bundle_path)
+
+    def _rasterize_heatmap(self, fig, heatmap, data_df, scale, width, height,
+                           raster_aggregation):
+        """
+        _rasterize_heatmap: replace heatmap by a server-side rendered image of the matrix
+
+        returns the invisible hover trace to add in place of heatmap
+        """
+        logging.info('Start rasterizing {} heatmap cells by {}'.format(data_df.size,
+                                                                       raster_aggregation))
+
+        hover_trace, layout_image = build_raster_heatmap(matrix_values(data_df),
+                                                         heatmap['x'], heatmap['y'],
+                                                         data_df.columns.tolist(),
+                                                         data_df.index.tolist(),
+                                                         scale['colorscale'],
+                                                         scale['cmin'], scale['cmax'],
+                                                         width, height,
+                                                         how=raster_aggregation)
+        fig.add_layout_image(layout_image)
+
+        # thousands of tick labels are unreadable and slow down the browser
+        for axis in ['xaxis', 'yaxis']:
+            tickvals, ticktext = downsample_ticks(fig['layout'][axis]['tickvals'],
+                                                  fig['layout'][axis]['ticktext'])
+            fig['layout'][axis]['tickvals'] = tickvals
+            fig['layout'][axis]['ticktext'] = ticktext
+
+        return hover_trace
+
+    def _tile_heatmap(self, fig, heatmap, data_df, output_directory, trace_index,
+                      raster_aggregation):
+        """
+        _tile_heatmap: write a zoom pyramid of the matrix and show its overview level
+
+        returns the heatmap trace holding the overview and the post_script loading finer tiles
+        on zoom
+        """
+        logging.info('Start building tile pyramid of {} heatmap cells'.format(data_df.size))
+
+        manifest, overview = build_tile_pyramid(matrix_values(data_df),
+                                                os.path.join(output_directory, TILE_DIR),
+                                                how=raster_aggregation)
+        overview_level = manifest['levels'][-1]
+        logging.info('Built {} tile levels'.format(len(manifest['levels'])))
+
+        axes = dict()
+        for dim, axis, labels, factor in [
+                ('x', 'xaxis', data_df.columns.tolist(), overview_level['col_factor']),
+                ('y', 'yaxis', data_df.index.tolist(), overview_level['row_factor'])]:
+            positions = heatmap[dim]
+            tickvals, ticktext = downsample_ticks(fig['layout'][axis]['tickvals'],
+                                                  fig['layout'][axis]['ticktext'])
+            fig['layout'][axis]['tickvals'] = tickvals
+            fig['layout'][axis]['ticktext'] = ticktext
+
+            # cell positions are evenly spaced on both branches
+            step = positions[1] - positions[0] if len(positions) > 1 else 1
+            axes[axis] = {'count': len(labels),
+                          'start': float(positions[0]),
+                          'step': float(step),
+                          'labels': [str(label) for label in labels],
+                          'tickvals': [float(tickval) for tickval in tickvals],
+                          'ticktext': [str(text) for text in ticktext]}
+
+            starts = np.arange(0, len(labels), factor)
+            ends = np.minimum(starts + factor, len(labels)) - 1
+            heatmap[dim] = float(positions[0]) + float(step) * (starts + ends) / 2
+            axes[axis]['overview_labels'] = label_ranges(labels, starts)
+
+        heatmap['z'] = overview
+        heatmap['text'] = [['row: {}<br>column: {}'.format(row_label, col_label)
+                            for col_label in axes['xaxis']['overview_labels']]
+                           for row_label in axes['yaxis']['overview_labels']]
+        heatmap['hovertemplate'] = '%{text}<br>value: %{z}<extra></extra>'
+        for axis in axes.values():
+            del axis['overview_labels']
+
+        post_script = tile_viewer_script(manifest, trace_index, axes['xaxis'], axes['yaxis'],
+                                         MAX_TICKS)
+
+        return heatmap, post_script
+
+    def _generate_heatmap_html(self, data_df, centered_by, cluster_result,
+                               plotlyjs_mode='inline', gzip_html=False, z_encoding='json',
+                               raster_cell_threshold=None, raster_aggregation='mean',
+                               tile_pyramid=False, color_scale=None,
+                               pseudo_count=DEFAULT_PSEUDO_COUNT, color_clip_percent=0,
+                               sketch=None, metrics=None):
+        """
+        _generate_heatmap_html: write the heatmap report into a new scratch directory
+
+        sketch: QuantileSketch of the data_df values the colour scale is computed from,
+                built from data_df if not given
+        metrics: optional PipelineMetrics the dendrogram and write stages are timed in
+        """
         logging.info('Start generating heatmap report')
 
+        import plotly.graph_objects as go
+        import plotly.io as pio
+
+        if raster_cell_threshold is None:
+            raster_cell_threshold = self.raster_cell_threshold
+        if color_scale is None:
+            color_scale = DIVERGING_SCALE if centered_by is not None else LOG10_SCALE
+        # a zoom pyramid replaces the plotly heatmap once the matrix exceeds a single tile
+        tiled = tile_pyramid and max(data_df.shape) > TILE_SIZE
+        # above the threshold the matrix is drawn as an image instead of a plotly heatmap
+        raster = not tiled and 0 < raster_cell_threshold < data_df.size
+
+        width = max(15 * data_df.columns.size, 1400)
+        height = max(10 * data_df.index.size, 1000)
+        if raster or tiled:
+            width = min(width, RASTER_MAX_WIDTH)
+            height = min(height, RASTER_MAX_HEIGHT)
+        # sparse z is encoded straight from the sparse matrix, the trace starts out empty; raster
+        # and tile z are reduced from the matrix, which is only densified for a plain heatmap
+        sparse_z = z_encoding == SPARSE_Z_ENCODING and not (raster or tiled)
+        z = [] if sparse_z or raster or tiled else dense_values(data_df)
+
         output_directory = os.path.join(self.scratch, str(uuid.uuid4()))
         logging.info('Start building report files in dir: {}'.format(output_directory))
         self._mkdir_p(output_directory)
@@ -107,31 +479,26 @@ class HeatmapUtil:
                                                                                 str(uuid.uuid4())))
 
         heatmap = go.Heatmap(
-                       z=data_df.values,
+                       z=z,
                        x=data_df.columns,
                        y=data_df.index,
                        hoverongaps=False,
                        coloraxis='coloraxis')
 
-        if cluster_data:
-            # Initialize figure by creating upper dendrogram
-            fig = ff.create_dendrogram(data_df.T.values,
-                                       orientation='bottom',
-                                       labels=data_df.columns,
-                                       colorscale=px.colors.qualitative.Set2,
-                                       distfun=lambda x: pdist(x, metric=dist_metric),
-                                       linkagefun=lambda x: linkage(x, method=linkage_method))
+        if cluster_result is not None:
+            with stage(metrics, 'dendrogram'):
+                # Initialize figure by creating upper dendrogram from the precomputed linkage
+                fig = build_dendrogram(cluster_result.col_linkage,
+                                       cluster_result.col_order,
+                                       orientation='bottom')
+
+                # Create Side Dendrogram
+                dendro_side = build_dendrogram(cluster_result.row_linkage,
+                                               cluster_result.row_order,
+                                               orientation='left')
+
             for i in range(len(fig['data'])):
                 fig['data'][i]['yaxis'] = 'y2'
-
-            # Create Side Dendrogram
-            dendro_side = ff.create_dendrogram(data_df.values,
-                                               orientation='left',
-                                               labels=data_df.index,
-                                               colorscale=px.colors.qualitative.Set2,
-                                               distfun=lambda x: pdist(x, metric=dist_metric),
-                                               linkagefun=lambda x: linkage(x,
-                                                                            method=linkage_method))
             for i in range(len(dendro_side['data'])):
                 dendro_side['data'][i]['xaxis'] = 'x2'
 
@@ -139,20 +506,11 @@ class HeatmapUtil:
             for data in dendro_side['data']:
                 fig.add_trace(data)
 
-            idx_ordered_label = dendro_side['layout']['yaxis']['ticktext']
-            col_ordered_label = fig['layout']['xaxis']['ticktext']
-
-            data_df = data_df.reindex(index=idx_ordered_label, columns=col_ordered_label)
-
+            # data_df is already in leaf order of both dendrograms
             heatmap['x'] = fig['layout']['xaxis']['tickvals']
             heatmap['y'] = dendro_side['layout']['yaxis']['tickvals']
-            heatmap['z'] = data_df.values
+            heatmap['z'] = z
 
-            # Add Heatmap Data to Figure
-            fig.add_trace(heatmap)
-
-            width = max(15 * data_df.columns.size, 1400)
-            height = max(10 * data_df.index.size, 1000)
             y2_height = 100
             x2_width = 150
             y2_offset = y2_height / height
@@ -206,13 +564,25 @@ class HeatmapUtil:
                                       'ticks': ""})
 
         else:
-            layout = go.Layout(xaxis={'type': 'category'},
-                               yaxis={'type': 'category'})
-
-            fig = go.Figure(data=heatmap, layout=layout)
+            if raster or tiled:
+                # the image is placed on numeric axes, labelled like the categorical ones
+                heatmap['x'] = np.arange(data_df.columns.size)
+                heatmap['y'] = np.arange(data_df.index.size)
+                layout = go.Layout(xaxis={'type': 'linear',
+                                          'ticktext': data_df.columns.tolist(),
+                                          'tickvals': heatmap['x'],
+                                          'showgrid': False,
+                                          'zeroline': False},
+                                   yaxis={'type': 'linear',
+                                          'ticktext': data_df.index.tolist(),
+                                          'tickvals': heatmap['y'],
+                                          'showgrid': False,
+                                          'zeroline': False})
+            else:
+                layout = go.Layout(xaxis={'type': 'category'},
+                                   yaxis={'type': 'category'})
 
-            width = max(15 * data_df.columns.size, 1400)
-            height = max(10 * data_df.index.size, 1000)
+            fig = go.Figure(layout=layout)
 
             fig.update_layout(xaxis={'automargin': True,
                                      'tickangle': 45,
@@ -226,32 +596,47 @@ class HeatmapUtil:
                               autosize=True,
                               showlegend=False)
 
-        if centered_by is not None:
-            colors = px.colors.sequential.RdBu
-            colorscale = [[0.0, colors[10]],
-                          [0.1, colors[9]],
-                          [0.2, colors[8]],
-                          [0.3, colors[7]],
-                          [0.4, colors[6]],
-                          [0.5, colors[5]],
-                          [0.6, colors[4]],
-                          [0.7, colors[3]],
-                          [0.8, colors[2]],
-                          [0.9, colors[1]],
-                          [1.0, colors[0]]]
-            fig.update_layout(coloraxis=dict(cmid=centered_by, colorscale=colorscale))
-        else:
-            # Logarithmic Color scale
-            colors = px.colors.sequential.OrRd
-            colorscale = [[0, colors[1]],         # 0
-                          [1./10000, colors[2]],  # 10
-                          [1./1000, colors[3]],   # 100
-                          [1./100, colors[4]],    # 1000
-                          [1./10, colors[5]],     # 10000
-                          [1., colors[6]]]
-            fig.update_layout(coloraxis=dict(colorscale=colorscale))
-
-        plot(fig, filename=heatmap_path)
+        # the colour range is fixed to the full matrix, also for rasterised and tiled heatmaps
+        if sketch is None:
+            sketch = matrix_sketch(matrix_values(data_df))
+        logging.info('Start computing {} colour scale'.format(color_scale))
+        scale = compute_color_scale(sketch, color_scale, centered_by=centered_by,
+                                    pseudo_count=pseudo_count, clip_percent=color_clip_percent)
+        fig.update_layout(coloraxis=dict(colorscale=scale['colorscale'],
+                                         cmin=scale['cmin'],
+                                         cmax=scale['cmax']))
+
+        post_script = list()
+        if raster:
+            heatmap = self._rasterize_heatmap(fig, heatmap, data_df, scale, width, height,
+                                              raster_aggregation)
+        elif tiled:
+            heatmap, tile_script = self._tile_heatmap(fig, heatmap, data_df, output_directory,
+                                                      len(fig['data']), raster_aggregation)
+            post_script.append(tile_script)
+        # Add Heatmap Data to Figure
+        fig.add_trace(heatmap)
+
+        if z_encoding != 'json':
+            # ship z as a base64 typed array decoded client-side instead of JSON number text
+            heatmap_index = len(fig['data']) - 1
+            z_values = matrix_values(data_df) if sparse_z else fig['data'][heatmap_index]['z']
+            encoded_z = encode_z(z_values, z_encoding, transform=scale['transform'])
+            fig['data'][heatmap_index]['z'] = []
+            post_script.append(decode_z_script(encoded_z, heatmap_index))
+
+        # 'directory' references plotly.min.js next to the report instead of inlining ~3.5 MB
+        if plotlyjs_mode == 'directory':
+            self._link_shared_plotlyjs(output_directory)
+        with stage(metrics, 'write'):
+            pio.write_html(fig, file=heatmap_path,
+                           include_plotlyjs=PLOTLYJS_MODES[plotlyjs_mode],
+                           post_script=post_script, auto_open=False)
+
+            if gzip_html:
+                for root, _, file_names in os.walk(output_directory):
+                    for file_name in file_names:
+                        self._gzip_file(os.path.join(root, file_name))
 
         return output_directory
 
@@ -280,6 +665,68 @@ class HeatmapUtil:
 
         return output_directory
 
+    def _share_batch_plotlyjs(self, index_directory, report_directory, report_file):
+        """
+        _share_batch_plotlyjs: replace the plotly.min.js of a report collected under
+                               index_directory by a single copy in index_directory
+
+        the index directory is uploaded as a whole, so its reports load plotly.js from there
+        instead of carrying ~3.5 MB each
+        """
+        bundle_path = os.path.join(report_directory, 'plotly.min.js')
+        if not os.path.exists(bundle_path):
+            # inline or cdn plotlyjs_mode
+            return
+
+        for suffix in ['', '.gz']:
+            shared_path = os.path.join(index_directory, 'plotly.min.js' + suffix)
+            if os.path.exists(bundle_path + suffix) and not os.path.exists(shared_path):
+                shutil.move(bundle_path + suffix, shared_path)
+            elif os.path.exists(bundle_path + suffix):
+                os.remove(bundle_path + suffix)
+
+        report_path = os.path.join(report_directory, report_file)
+        with open(report_path, 'r', encoding='utf-8') as report_html:
+            content = report_html.read()
+        with open(report_path, 'w', encoding='utf-8') as report_html:
+            report_html.write(content.replace('src="plotly.min.js"', 'src="../plotly.min.js"'))
+        if os.path.exists(report_path + '.gz'):
+            self._gzip_file(report_path)
+
+    def _generate_batch_index(self, params_list, results):
+        """
+        _generate_batch_index: move the report directories into one directory with an index.html
+
+        updates the html_dir of every result to its new location; reports of the directory
+        plotlyjs_mode share one plotly.min.js next to index.html
+        """
+        index_directory = os.path.join(self.scratch, str(uuid.uuid4()))
+        logging.info('Start building batch index in dir: {}'.format(index_directory))
+        self._mkdir_p(index_directory)
+
+        index_rows = list()
+        for i, (params, result) in enumerate(zip(params_list, results)):
+            report_dir_name = 'heatmap_{}'.format(i)
+            report_directory = os.path.join(index_directory, report_dir_name)
+            shutil.move(result['html_dir'], report_directory)
+            result['html_dir'] = report_directory
+
+            report_file = [name for name in os.listdir(report_directory)
+                           if name.startswith('heatmap_report_') and name.endswith('.html')][0]
+            index_rows.append('<tr><td>{}</td><td><a href="{}/{}">{}</a></td></tr>'.format(
+                                    i, report_dir_name, report_file,
+                                    html.escape(os.path.basename(params['tsv_file_path']))))
+            self._share_batch_plotlyjs(index_directory, report_directory, report_file)
+
+        with open(os.path.join(os.path.dirname(__file__),
+                               'templates', 'batch_index_template.html'),
+                  'r') as index_template_file:
+            index_template = index_template_file.read()
+        with open(os.path.join(index_directory, 'index.html'), 'w') as index_html:
+            index_html.write(index_template.replace('heatmap_index_rows', '\n'.join(index_rows)))
+
+        return index_directory
+
     @staticmethod
     def _is_numeric(number):
         try:
@@ -289,6 +736,7 @@ class HeatmapUtil:
             return False
 
     def __init__(self, config):
+        self.config = config
         self.callback_url = config['SDK_CALLBACK_URL']
         self.endpoint = config['kbase-endpoint']
         self.scratch = config['scratch']
@@ -298,53 +746,371 @@ class HeatmapUtil:
                             level=logging.INFO)
         self.obj_cache = dict()
 
-        plt.switch_backend('agg')
-        sys.setrecursionlimit(150000)
-
-    def build_heatmap_html(self, params):
-
+        # memory (in bytes) the exact clustering path may spend on its condensed distance matrix
+        self.cluster_memory_budget = int(config.get('cluster-memory-budget-mb',
+                                                    DEFAULT_CLUSTER_MEMORY_BUDGET_MB)) * 1024 ** 2
+
+        # parsed input matrices are cached in scratch, a size of 0 disables the cache
+        matrix_cache_size = int(config.get('matrix-cache-size-mb',
+                                           DEFAULT_MATRIX_CACHE_SIZE_MB)) * 1024 ** 2
+        self.matrix_cache = None
+        if matrix_cache_size > 0:
+            self.matrix_cache = MatrixCache(os.path.join(self.scratch, 'matrix_cache'),
+                                            matrix_cache_size)
+
+        # linkage results are kept in memory and written through to scratch,
+        # a size of 0 keeps them in memory only
+        linkage_cache_entries = int(config.get('linkage-cache-entries',
+                                               DEFAULT_LINKAGE_CACHE_ENTRIES))
+        linkage_cache_size = int(config.get('linkage-cache-size-mb',
+                                            DEFAULT_LINKAGE_CACHE_SIZE_MB)) * 1024 ** 2
+        self.linkage_cache = LinkageCache(os.path.join(self.scratch, 'linkage_cache'),
+                                          linkage_cache_entries, linkage_cache_size)
+
+        # matrices with more cells are rasterised server-side, 0 disables rasterising
+        self.raster_cell_threshold = int(config.get('raster-cell-threshold',
+                                                    DEFAULT_RASTER_CELL_THRESHOLD))
+
+        # longer axes fall back from the cubic optimal leaf ordering to the greedy one
+        self.optimal_leaf_ordering_max_leaves = int(config.get(
+                                                    'optimal-leaf-ordering-max-leaves',
+                                                    DEFAULT_OPTIMAL_LEAF_ORDERING_MAX_LEAVES))
+
+        # worker processes clustering rows and columns concurrently, 1 clusters them in turn
+        self.cluster_workers = max(1, int(config.get('cluster-workers', DEFAULT_CLUSTER_WORKERS)))
+        self.cluster_parallel_min_leaves = int(config.get('cluster-parallel-min-leaves',
+                                                          DEFAULT_CLUSTER_PARALLEL_MIN_LEAVES))
+
+        # worker processes building the heatmaps of a batch call, 1 builds them in turn
+        self.batch_workers = max(1, int(config.get('batch-workers', DEFAULT_BATCH_WORKERS)))
+
+    def _parse_heatmap_params(self, params):
+        """
+        _parse_heatmap_params: validated build_heatmap_html arguments of params, with defaults
+        """
         tsv_file_path = params.get('tsv_file_path')
 
         cluster_data = params.get('cluster_data', True)
         sort_by_sum = params.get('sort_by_sum', False)
         top_percent = params.get('top_percent', 100)
+        top_by = params.get('top_by', 'sum')
         centered_by = params.get('centered_by')
         dist_metric = params.get('dist_metric', 'euclidean')
         linkage_method = params.get('linkage_method', 'ward')
+        leaf_ordering = params.get('leaf_ordering', NO_LEAF_ORDERING)
+        cluster_memory_budget_mb = params.get('cluster_memory_budget_mb')
+        plotlyjs_mode = params.get('plotlyjs_mode', 'inline')
+        gzip_html = params.get('gzip_html', False)
+        z_encoding = params.get('z_encoding', 'json')
+        raster_cell_threshold = params.get('raster_cell_threshold')
+        raster_aggregation = params.get('raster_aggregation', 'mean')
+        tile_pyramid = params.get('tile_pyramid', False)
+        color_scale = params.get('color_scale')
+        pseudo_count = params.get('pseudo_count', DEFAULT_PSEUDO_COUNT)
+        color_clip_percent = params.get('color_clip_percent', 0)
+        sparse = params.get('sparse', False)
+        precision = params.get('precision', 'float64')
+        truncate_levels = params.get('truncate_levels')
+        truncate_distance = params.get('truncate_distance')
+        truncate_aggregation = params.get('truncate_aggregation', 'mean')
+        profile = params.get('profile', profile_enabled_by_env())
 
         if not self._is_numeric(top_percent) or top_percent > 100:
             raise ValueError('Please provide a numeric (<100) top_percent argument')
 
+        if top_by not in ROW_SCORE_FUNCTIONS:
+            raise ValueError('Please provide a top_by argument from: {}'.format(
+                                                        ', '.join(sorted(ROW_SCORE_FUNCTIONS))))
+
         if centered_by is not None and not self._is_numeric(centered_by):
             raise ValueError('Please provide a numeric centered_by argument')
 
-        data_df = self._read_csv_file(tsv_file_path)
+        if leaf_ordering not in LEAF_ORDERINGS:
+            raise ValueError('Please provide a leaf_ordering argument from: {}'.format(
+                                                                    ', '.join(LEAF_ORDERINGS)))
+
+        if plotlyjs_mode not in PLOTLYJS_MODES:
+            raise ValueError('Please provide a plotlyjs_mode argument from: {}'.format(
+                                                                ', '.join(PLOTLYJS_MODES)))
+
+        if z_encoding != 'json' and z_encoding not in Z_ENCODINGS:
+            raise ValueError('Please provide a z_encoding argument from: json, {}'.format(
+                                                                    ', '.join(Z_ENCODINGS)))
+
+        if (raster_cell_threshold is not None and
+                (not self._is_numeric(raster_cell_threshold) or int(raster_cell_threshold) < 0)):
+            raise ValueError('Please provide a non-negative numeric raster_cell_threshold '
+                             'argument')
+        if raster_cell_threshold is not None:
+            raster_cell_threshold = int(raster_cell_threshold)
+
+        if raster_aggregation not in RASTER_AGGREGATIONS:
+            raise ValueError('Please provide a raster_aggregation argument from: {}'.format(
+                                                                ', '.join(RASTER_AGGREGATIONS)))
+
+        if color_scale is not None and color_scale not in COLOR_SCALES:
+            raise ValueError('Please provide a color_scale argument from: {}'.format(
+                                                                    ', '.join(COLOR_SCALES)))
+
+        if not self._is_numeric(pseudo_count) or float(pseudo_count) <= 0:
+            raise ValueError('Please provide a positive numeric pseudo_count argument')
+        pseudo_count = float(pseudo_count)
+
+        if (not self._is_numeric(color_clip_percent) or
+                not 0 <= float(color_clip_percent) < MAX_CLIP_PERCENT):
+            raise ValueError('Please provide a numeric color_clip_percent argument from 0 to '
+                             'below {}'.format(MAX_CLIP_PERCENT))
+        color_clip_percent = float(color_clip_percent)
+
+        if precision not in PRECISIONS:
+            raise ValueError('Please provide a precision argument from: {}'.format(
+                                                                    ', '.join(PRECISIONS)))
+        if precision == 'float32' and z_encoding == 'json':
+            # JSON would print every float32 value with float64 digits
+            z_encoding = 'float32'
+
+        if truncate_levels is not None and truncate_distance is not None:
+            raise ValueError('Please provide either a truncate_levels or a truncate_distance '
+                             'argument, not both')
+        if truncate_levels is not None:
+            if not self._is_numeric(truncate_levels) or int(truncate_levels) < 0:
+                raise ValueError('Please provide a non-negative numeric truncate_levels argument')
+            truncate_levels = int(truncate_levels)
+        if truncate_distance is not None:
+            if not self._is_numeric(truncate_distance) or float(truncate_distance) < 0:
+                raise ValueError('Please provide a non-negative numeric truncate_distance '
+                                 'argument')
+            truncate_distance = float(truncate_distance)
+        if truncate_aggregation not in COLLAPSE_AGGREGATIONS:
+            raise ValueError('Please provide a truncate_aggregation argument from: {}'.format(
+                                                            ', '.join(COLLAPSE_AGGREGATIONS)))
+
+        memory_budget = None
+        if cluster_memory_budget_mb is not None:
+            if (not self._is_numeric(cluster_memory_budget_mb) or
+                    int(cluster_memory_budget_mb) <= 0):
+                raise ValueError('Please provide a positive numeric cluster_memory_budget_mb '
+                                 'argument')
+            memory_budget = int(cluster_memory_budget_mb) * 1024 ** 2
+
+        return {'tsv_file_path': tsv_file_path,
+                'cluster_data': cluster_data,
+                'sort_by_sum': sort_by_sum,
+                'top_percent': top_percent,
+                'top_by': top_by,
+                'centered_by': centered_by,
+                'dist_metric': dist_metric,
+                'linkage_method': linkage_method,
+                'leaf_ordering': leaf_ordering,
+                'plotlyjs_mode': plotlyjs_mode,
+                'gzip_html': gzip_html,
+                'z_encoding': z_encoding,
+                'raster_cell_threshold': raster_cell_threshold,
+                'raster_aggregation': raster_aggregation,
+                'tile_pyramid': tile_pyramid,
+                'color_scale': color_scale,
+                'pseudo_count': pseudo_count,
+                'color_clip_percent': color_clip_percent,
+                'sparse': sparse,
+                'precision': precision,
+                'truncate_levels': truncate_levels,
+                'truncate_distance': truncate_distance,
+                'truncate_aggregation': truncate_aggregation,
+                'profile': profile,
+                'memory_budget': memory_budget}
 
-        data_shape = data_df.shape
-        if 1 in data_shape:
-            logging.info('Turnning of clustering due to data size: {}'.format(data_shape))
-            cluster_data = False
+    def build_heatmap_html(self, params):
 
-        if cluster_data and int(top_percent) == 100:
-            try:
-                logging.info('Start clustering the whole data set')
-                data_df = self._cluster_data(data_df, dist_metric, linkage_method)
-            except Exception:
-                logging.warning('matrix is too large to be clustered')
-        if sort_by_sum:
-            sum_order = data_df.sum(axis=1).sort_values(ascending=False).index
-            data_df = data_df.reindex(sum_order)
-            top_index = data_df.index[:int(data_df.index.size * top_percent / 100)]
-            data_df = data_df.loc[top_index]
+        return self._build_heatmap_html(**self._parse_heatmap_params(params))
+
+    def _build_heatmap_html(self, tsv_file_path, cluster_data, sort_by_sum, top_percent, top_by,
+                            centered_by, dist_metric, linkage_method, leaf_ordering, plotlyjs_mode,
+                            gzip_html, z_encoding, raster_cell_threshold, raster_aggregation,
+                            tile_pyramid, color_scale, pseudo_count, color_clip_percent, sparse,
+                            precision, truncate_levels, truncate_distance, truncate_aggregation,
+                            profile, memory_budget):
+        """
+        _build_heatmap_html: build_heatmap_html of arguments checked by _parse_heatmap_params
+        """
+        profiler = None
+        if profile:
+            profiler = CallProfiler()
+            profiler.start()
+
+        heatmap_html_dir = None
+        metrics = PipelineMetrics()
+        try:
+            # top rows are selected while reading, before any sorting or clustering;
+            # those only reorder values, so the sketch filled while loading holds
+            sketch = QuantileSketch()
+            with metrics.stage('read'):
+                data_df = self._read_csv_file(tsv_file_path, top_percent=top_percent,
+                                              top_by=top_by, sketch=sketch, sparse=sparse,
+                                              dtype=PRECISIONS[precision], metrics=metrics)
+            metrics.set('rows', data_df.index.size)
+            metrics.set('columns', data_df.columns.size)
+
+            if sketch.count != data_df.size:
+                # top rows selected, or a matrix cache entry written without a sketch
+                with metrics.stage('sketch'):
+                    sketch = matrix_sketch(matrix_values(data_df))
+
+            data_shape = data_df.shape
+            if 1 in data_shape:
+                logging.info('Turnning of clustering due to data size: {}'.format(data_shape))
+                cluster_data = False
+
+            if sort_by_sum:
+                with metrics.stage('sort'):
+                    sum_order = data_df.sum(axis=1).sort_values(ascending=False).index
+                    data_df = data_df.reindex(sum_order)
+
+            # cluster once; the linkage matrices are reused to draw the dendrograms
+            cluster_result = None
             if cluster_data:
                 try:
-                    logging.info('Start clustering the {} top percent data set'.format(top_percent))
-                    data_df = self._cluster_data(data_df, dist_metric, linkage_method)
+                    logging.info('Start clustering the {} top percent data set'.format(
+                                                                                top_percent))
+                    with metrics.stage('cluster'):
+                        data_df, cluster_result = self._cluster_data(data_df, dist_metric,
+                                                                     linkage_method,
+                                                                     memory_budget=memory_budget,
+                                                                     leaf_ordering=leaf_ordering,
+                                                                     metrics=metrics)
                 except Exception:
-                    logging.warning('matrix is too large to be clustered')
-        # heatmap_data = self._build_heatmap_data(data_df)
-        # heatmap_html_dir = self._generate_heatmap_report(heatmap_data)
-        heatmap_html_dir = self._generate_heatmap_html(data_df, centered_by, cluster_data,
-                                                       dist_metric, linkage_method)
+                    logging.warning('matrix is too large to be clustered', exc_info=True)
+
+            # the colour scale follows the collapsed values, value_summary the input matrix
+            color_sketch = sketch
+            if (cluster_result is not None and cluster_result.row_linkage is not None and
+                    (truncate_levels is not None or truncate_distance is not None)):
+                with metrics.stage('truncate'):
+                    data_df, cluster_result = self._truncate_rows(data_df, cluster_result,
+                                                                  levels=truncate_levels,
+                                                                  distance=truncate_distance,
+                                                                  how=truncate_aggregation)
+                    color_sketch = matrix_sketch(matrix_values(data_df))
+                metrics.set('heatmap_rows', data_df.index.size)
+            # heatmap_data = self._build_heatmap_data(data_df)
+            # heatmap_html_dir = self._generate_heatmap_report(heatmap_data)
+            with metrics.stage('figure'):
+                heatmap_html_dir = self._generate_heatmap_html(
+                                                    data_df, centered_by, cluster_result,
+                                                    plotlyjs_mode=plotlyjs_mode,
+                                                    gzip_html=gzip_html,
+                                                    z_encoding=z_encoding,
+                                                    raster_cell_threshold=raster_cell_threshold,
+                                                    raster_aggregation=raster_aggregation,
+                                                    tile_pyramid=tile_pyramid,
+                                                    color_scale=color_scale,
+                                                    pseudo_count=pseudo_count,
+                                                    color_clip_percent=color_clip_percent,
+                                                    sketch=color_sketch,
+                                                    metrics=metrics)
+        finally:
+            metrics.close()
+            if profiler is not None:
+                profiler.stop()
+                # a failed call keeps its profile in scratch, that is where it is needed most
+                profile_dir = heatmap_html_dir
+                if profile_dir is None:
+                    profile_dir = os.path.join(self.scratch, 'profile_' + str(uuid.uuid4()))
+                    self._mkdir_p(profile_dir)
+                logging.info('Wrote profile: {}'.format(', '.join(profiler.write(profile_dir))))
+
+        metrics.set('output_bytes', sum(os.path.getsize(os.path.join(root, file_name))
+                                        for root, _, file_names in os.walk(heatmap_html_dir)
+                                        for file_name in file_names
+                                        if file_name not in PROFILE_FILES))
+        metrics = metrics.as_dict()
+        logging.info('Heatmap metrics: {}'.format(json.dumps(metrics, sort_keys=True)))
+
+        returnVal = {'html_dir': heatmap_html_dir,
+                     'value_summary': sketch.summary(),
+                     'metrics': metrics}
+        if cluster_result is not None:
+            logging.info('Clustering strategy: {}'.format(cluster_result.strategy))
+            returnVal['cluster_strategy'] = cluster_result.strategy
+
+        return returnVal
+
+    def build_heatmap_html_batch(self, params):
+        """
+        build_heatmap_html_batch: build_heatmap_html for every parameter set of params_list
+
+        heatmaps are built in a pool of up to batch_workers processes, each process set up once
+        and reused for many heatmaps
+        """
+        params_list = params.get('params_list')
+        index_page = params.get('index_page', False)
+
+        if not isinstance(params_list, list) or not params_list:
+            raise ValueError('Please provide a non-empty params_list argument')
+
+        # every entry is checked before any heatmap is built, so a bad one fails the call at once
+        for i, item_params in enumerate(params_list):
+            if not isinstance(item_params, dict) or not item_params.get('tsv_file_path'):
+                raise ValueError('Please provide a tsv_file_path in params_list entry '
+                                 '{}'.format(i))
+            try:
+                self._parse_heatmap_params(item_params)
+            except ValueError as e:
+                raise ValueError('{} in params_list entry {}'.format(e, i))
+
+        workers = min(self.batch_workers, len(params_list))
+        logging.info('Start building {} heatmaps with {} workers'.format(len(params_list),
+                                                                         workers))
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_batch_worker,
+                                     initargs=(self.config,)) as executor:
+                futures = [executor.submit(_build_batch_heatmap, item_params)
+                           for item_params in params_list]
+                results = list()
+                for i, future in enumerate(futures):
+                    try:
+                        results.append(future.result())
+                    except Exception as e:
+                        raise ValueError('Failed to build heatmap of params_list entry '
+                                         '{}: {}'.format(i, e))
+        else:
+            results = [self.build_heatmap_html(item_params) for item_params in params_list]
+
+        returnVal = {'results': results}
+        if index_page:
+            returnVal['index_dir'] = self._generate_batch_index(params_list, results)
+
+        return returnVal
+
+
+# HeatmapUtil of a batch worker process, set up once by _init_batch_worker
+_batch_heatmap_util = None
+
+
+def _init_batch_worker(config):
+    global _batch_heatmap_util
+    _batch_heatmap_util = HeatmapUtil(config)
+    # every batch item has a process of its own already
+    _batch_heatmap_util.cluster_workers = 1
+
+
+def _build_batch_heatmap(params):
+    return _batch_heatmap_util.build_heatmap_html(params)
+
+
+def _timed_compute_linkage(*task):
+    """
+    _timed_compute_linkage: compute_linkage(*task) and the seconds it took
+    """
+    start = time.perf_counter()
+    linkage_matrix, ordered_index = compute_linkage(*task)
+
+    return linkage_matrix, ordered_index, time.perf_counter() - start
+
+
+# compute_linkage arguments of the axes clustered in worker processes by call id, inherited on
+# fork; every call adds and removes its own entry, so concurrent calls do not mix up their tasks
+_cluster_tasks = dict()
+
 
-        return {'html_dir': heatmap_html_dir}
+def _timed_compute_cluster_task(call_id, task_index):
+    return _timed_compute_linkage(*_cluster_tasks[call_id][task_index])
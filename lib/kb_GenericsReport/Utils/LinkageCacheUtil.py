@@ -0,0 +1,127 @@
+import errno
+import hashlib
+import logging
+import os
+import uuid
+from collections import OrderedDict
+
+import numpy as np
+
+
+class LinkageCache:
+    """
+    LinkageCache: cache of linkage matrices and leaf orders
+
+    Clustering is deterministic for given values, distance metric, linkage method,
+    clustering strategy, leaf ordering and, for the two-stage strategy, the number of k-means
+    clusters (which follows the memory budget), so the result is keyed by a hash of all of them.
+    Recent results are kept in memory (LRU, max_entries) and written through to cache_dir as
+    .npz files so other processes and later jobs on the same scratch reuse them. The on-disk
+    part is bounded to max_bytes and evicts least recently used files.
+    """
+
+    def __init__(self, cache_dir, max_entries, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._memory = OrderedDict()
+
+        try:
+            os.makedirs(cache_dir)
+        except OSError as exc:
+            if exc.errno != errno.EEXIST:
+                raise
+
+    @staticmethod
+    def key(values, dist_metric, linkage_method, strategy, leaf_ordering='none',
+            cluster_count=None):
+        # float32 values are hashed as they are, anything else as float64
+        if hasattr(values, 'tocsr'):
+            # scipy sparse matrix, hashed by its canonical CSR arrays
+            values = values.tocsr().astype(np.result_type(values.dtype, np.float32))
+            values.sum_duplicates()
+            blocks = [values.indptr, values.indices, values.data]
+            layout = 'csr{}{}'.format(values.shape, values.dtype.str)
+        else:
+            values = np.ascontiguousarray(values)
+            values = values.astype(np.result_type(values.dtype, np.float32), copy=False)
+            blocks = [values]
+            layout = '{}{}'.format(values.shape, values.dtype.str)
+
+        digest = hashlib.blake2b(digest_size=20)
+        digest.update('{}|{}|{}|{}|{}|{}'.format(layout, dist_metric, linkage_method, strategy,
+                                                 leaf_ordering, cluster_count).encode())
+        for block in blocks:
+            digest.update(np.ascontiguousarray(block))
+
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, '{}.npz'.format(key))
+
+    def get(self, key):
+        """
+        get: (linkage_matrix, ordered_index) for key, or None
+        """
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            return self._memory[key]
+
+        path = self._path(key)
+        try:
+            with np.load(path) as cached:
+                entry = (cached['linkage'], cached['ordered_index'])
+            os.utime(path, None)
+        except (IOError, OSError, KeyError, ValueError):
+            return None
+
+        logging.info('Loaded linkage from cache file {}'.format(path))
+        self._remember(key, entry)
+
+        return entry
+
+    def put(self, key, linkage_matrix, ordered_index):
+        entry = (linkage_matrix, ordered_index)
+        self._remember(key, entry)
+
+        if self.max_bytes <= 0:
+            return
+
+        # write to a temporary name first, so readers never see a partial file
+        tmp_path = os.path.join(self.cache_dir, '.tmp-{}.npz'.format(uuid.uuid4()))
+        np.savez(tmp_path, linkage=linkage_matrix, ordered_index=ordered_index)
+        os.rename(tmp_path, self._path(key))
+
+        self._evict(keep=key)
+
+    def _remember(self, key, entry):
+        self._memory[key] = entry
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def _evict(self, keep=None):
+        files = list()
+        total_bytes = 0
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name.startswith('.'):
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                # evicted concurrently
+                continue
+            files.append((stat.st_mtime, name, stat.st_size))
+            total_bytes += stat.st_size
+
+        for _, name, size in sorted(files):
+            if total_bytes <= self.max_bytes:
+                break
+            if name == '{}.npz'.format(keep):
+                continue
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except OSError:
+                pass
+            total_bytes -= size
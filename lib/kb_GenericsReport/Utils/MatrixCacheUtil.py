@@ -0,0 +1,245 @@
+import errno
+import hashlib
+import json
+import logging
+import os
+import shutil
+import struct
+import uuid
+
+import numpy as np
+
+from kb_GenericsReport.Utils.MatrixUtil import (TEXT_FORMAT, detect_file_format, fill_missing,
+                                                iter_matrix_chunks, read_matrix)
+from kb_GenericsReport.Utils.SketchUtil import QuantileSketch, matrix_sketch
+
+VALUES_FILE = 'values.npy'
+LABELS_FILE = 'labels.json'
+SKETCH_FILE = 'sketch.npz'
+
+HASH_BLOCK_SIZE = 8 * 1024 ** 2
+# .npy header size of streamed entries, reserved up front and rewritten with the final shape
+NPY_HEADER_BYTES = 128
+
+
+def _npy_header(dtype, shape):
+    """
+    _npy_header: .npy (version 1.0) header of exactly NPY_HEADER_BYTES bytes
+    """
+    header = "{{'descr': {!r}, 'fortran_order': False, 'shape': {!r}, }}".format(
+                                    np.lib.format.dtype_to_descr(np.dtype(dtype)), tuple(shape))
+    prefix = np.lib.format.magic(1, 0)
+    header_size = NPY_HEADER_BYTES - len(prefix) - 2
+    return (prefix + struct.pack('<H', header_size) +
+            header.ljust(header_size - 1).encode('latin1') + b'\n')
+
+
+class MatrixCache:
+    """
+    MatrixCache: content-hash keyed on-disk cache of parsed input matrices
+
+    Every entry is a directory holding the numeric values as a .npy file, the row/column
+    labels as JSON and a QuantileSketch of the values. Entries are memory-mapped on load, so a
+    repeated call on the same file skips text parsing entirely and pages in only the data it
+    touches. The cache is bounded to max_bytes and evicts least recently used entries.
+    """
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+        try:
+            os.makedirs(cache_dir)
+        except OSError as exc:
+            if exc.errno != errno.EEXIST:
+                raise
+
+    @staticmethod
+    def file_key(file_path, dtype):
+        """
+        file_key: hash of the file content and the numeric type it is parsed into
+        """
+        digest = hashlib.blake2b(np.dtype(dtype).str.encode(), digest_size=20)
+        with open(file_path, 'rb') as data_file:
+            for block in iter(lambda: data_file.read(HASH_BLOCK_SIZE), b''):
+                digest.update(block)
+
+        return digest.hexdigest()
+
+    def fits(self, file_path, dtype=np.float64):
+        """
+        fits: True if the parsed values of file_path surely fit into the cache
+
+        every value takes at least two bytes of text, a digit and a delimiter
+        """
+        return os.path.getsize(file_path) // 2 * np.dtype(dtype).itemsize <= self.max_bytes
+
+    def load(self, file_path, dtype=np.float64, sketch=None, ingest=True):
+        """
+        load: parsed matrix of file_path, read from the cache or added to it
+
+        sketch: optional QuantileSketch the sketch of the matrix values is merged into; left
+                untouched for entries cached without one
+        ingest: False to only return cached entries of delimited text instead of parsing it
+
+        returns None if the matrix does not fit into the cache or is not ingested
+        """
+        key = self.file_key(file_path, dtype)
+
+        df = self._get(key)
+        if df is not None:
+            logging.info('Loaded matrix of {} from cache entry {}'.format(file_path, key))
+        elif detect_file_format(file_path) == TEXT_FORMAT:
+            df = self._ingest(key, file_path, dtype) if ingest else None
+        else:
+            df = read_matrix(file_path, dtype=dtype)
+            self._put(key, df)
+
+        if df is not None and sketch is not None:
+            self._merge_sketch(key, sketch)
+
+        return df
+
+    def _merge_sketch(self, key, sketch):
+        try:
+            sketch.merge(QuantileSketch.load(os.path.join(self._entry_dir(key), SKETCH_FILE)))
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+
+    def _entry_dir(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def _get(self, key):
+        entry_dir = self._entry_dir(key)
+        try:
+            with open(os.path.join(entry_dir, LABELS_FILE)) as labels_file:
+                labels = json.load(labels_file)
+            values = np.load(os.path.join(entry_dir, VALUES_FILE), mmap_mode='r')
+        except (IOError, OSError, ValueError):
+            return None
+
+        # mark as most recently used
+        os.utime(entry_dir, None)
+
+        return self._to_dataframe(values[:labels['row_count']], labels)
+
+    @staticmethod
+    def _to_dataframe(values, labels):
+        import pandas as pd
+
+        index = pd.Index(labels['index'], name=labels['index_name'])
+        return pd.DataFrame(values, index=index, columns=labels['columns'], copy=False)
+
+    def _new_entry_dir(self):
+        return os.path.join(self.cache_dir, '.tmp-{}'.format(uuid.uuid4()))
+
+    def _commit(self, key, tmp_dir, labels, sketch):
+        sketch.save(os.path.join(tmp_dir, SKETCH_FILE))
+        with open(os.path.join(tmp_dir, LABELS_FILE), 'w') as labels_file:
+            json.dump(labels, labels_file)
+
+        try:
+            os.rename(tmp_dir, self._entry_dir(key))
+        except OSError:
+            # another process cached the same content first
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        self._evict(keep=key)
+
+    def _put(self, key, df):
+        if df.values.nbytes > self.max_bytes:
+            return
+
+        tmp_dir = self._new_entry_dir()
+        os.makedirs(tmp_dir)
+        np.save(os.path.join(tmp_dir, VALUES_FILE), np.ascontiguousarray(df.values))
+
+        self._commit(key, tmp_dir, {'index': df.index.tolist(),
+                                    'index_name': df.index.name,
+                                    'columns': df.columns.tolist(),
+                                    'row_count': df.index.size},
+                     matrix_sketch(df.values))
+
+    def _ingest(self, key, file_path, dtype):
+        """
+        _ingest: stream a delimited text file straight into a new cache entry
+
+        parsed chunks are appended to the .npy file behind a fixed size header, which is
+        rewritten with the parsed row count at the end, so the matrix is never held in memory
+        and its size never relies on counting line breaks; the sketch is built along the way
+        """
+        tmp_dir = None
+        sketch = QuantileSketch()
+        values_file = None
+        labels = {'index': list(), 'row_count': 0}
+        try:
+            for chunk in iter_matrix_chunks(file_path, dtype=dtype):
+                if values_file is None:
+                    tmp_dir = self._new_entry_dir()
+                    os.makedirs(tmp_dir)
+                    values_file = open(os.path.join(tmp_dir, VALUES_FILE), 'wb')
+                    values_file.write(_npy_header(dtype, (0, chunk.columns.size)))
+                    labels['columns'] = chunk.columns.tolist()
+                    labels['index_name'] = chunk.index.name
+
+                row_count = labels['row_count'] + chunk.index.size
+                if row_count * chunk.columns.size * np.dtype(dtype).itemsize > self.max_bytes:
+                    logging.info('Matrix of {} is too large to be cached'.format(file_path))
+                    values_file.close()
+                    shutil.rmtree(tmp_dir, ignore_errors=True)
+                    return None
+
+                chunk_values = fill_missing(np.array(chunk.values, dtype=dtype))
+                sketch.update(chunk_values)
+                values_file.write(chunk_values.tobytes())
+
+                labels['index'].extend(chunk.index)
+                labels['row_count'] = row_count
+
+            if values_file is not None:
+                values_file.seek(0)
+                values_file.write(_npy_header(dtype, (labels['row_count'],
+                                                      len(labels['columns']))))
+                values_file.close()
+        except Exception:
+            if values_file is not None:
+                values_file.close()
+            if tmp_dir is not None:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+
+        if values_file is None:
+            raise ValueError('Matrix file {} is empty'.format(file_path))
+
+        self._commit(key, tmp_dir, labels, sketch)
+        logging.info('Cached matrix of {} as entry {}'.format(file_path, key))
+
+        return self._get(key)
+
+    def _evict(self, keep=None):
+        """
+        _evict: remove least recently used entries until the cache fits into max_bytes
+        """
+        entries = list()
+        total_bytes = 0
+        for key in os.listdir(self.cache_dir):
+            entry_dir = self._entry_dir(key)
+            if key.startswith('.') or not os.path.isdir(entry_dir):
+                continue
+            try:
+                entry_bytes = sum(os.path.getsize(os.path.join(entry_dir, name))
+                                  for name in os.listdir(entry_dir))
+                entries.append((os.path.getmtime(entry_dir), key, entry_bytes))
+            except OSError:
+                # evicted concurrently
+                continue
+            total_bytes += entry_bytes
+
+        for _, key, entry_bytes in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            logging.info('Evicting matrix cache entry {}'.format(key))
+            shutil.rmtree(self._entry_dir(key), ignore_errors=True)
+            total_bytes -= entry_bytes
@@ -0,0 +1,272 @@
+import csv
+import logging
+import os
+
+import numpy as np
+
+from kb_GenericsReport.Utils.SelectionUtil import row_statistics, top_k_indices, top_row_count
+from kb_GenericsReport.Utils.SparseUtil import to_sparse_frame
+
+EXCEL_FORMAT = 'excel'
+TEXT_FORMAT = 'text'
+
+# xlsx files are zip archives, legacy xls files are OLE2 compound documents
+EXCEL_MAGIC_BYTES = [b'PK\x03\x04', b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1']
+EXCEL_EXTENSIONS = ['.xls', '.xlsx', '.xlsm']
+
+CANDIDATE_DELIMITERS = '\t,;|'
+
+# bytes read from the head of the file for format detection and delimiter sniffing
+HEAD_BUFFER_SIZE = 64 * 1024
+
+# approximate size of the numeric block of one streamed chunk
+CHUNK_BYTES = 64 * 1024 ** 2
+MIN_CHUNK_ROWS = 1000
+
+
+def _read_head(file_path):
+    with open(file_path, 'rb') as data_file:
+        return data_file.read(HEAD_BUFFER_SIZE)
+
+
+def detect_file_format(file_path, head=None):
+    """
+    detect_file_format: EXCEL_FORMAT or TEXT_FORMAT, from magic bytes or file extension
+    """
+    if head is None:
+        head = _read_head(file_path)
+
+    if any(head.startswith(magic) for magic in EXCEL_MAGIC_BYTES):
+        return EXCEL_FORMAT
+
+    if os.path.splitext(file_path)[1].lower() in EXCEL_EXTENSIONS:
+        return EXCEL_FORMAT
+
+    return TEXT_FORMAT
+
+
+def sniff_delimiter(head):
+    """
+    sniff_delimiter: infer the delimiter of a delimited text file from its head buffer
+    """
+    text = head.decode('utf-8', errors='replace')
+    if len(head) == HEAD_BUFFER_SIZE and '\n' in text:
+        # drop the last, possibly truncated, line
+        text = text[:text.rindex('\n')]
+
+    try:
+        return csv.Sniffer().sniff(text, delimiters=CANDIDATE_DELIMITERS).delimiter
+    except csv.Error:
+        # sniffer needs consistent rows; fall back to the most frequent header delimiter
+        header = text.splitlines()[0] if text else ''
+        counts = [(header.count(delimiter), delimiter) for delimiter in CANDIDATE_DELIMITERS]
+        count, delimiter = max(counts)
+        return delimiter if count else '\t'
+
+
+def _read_header(head, delimiter):
+    text = head.decode('utf-8', errors='replace')
+    return next(csv.reader(text.splitlines()[:1], delimiter=delimiter), [])
+
+
+def _grow(values, filled_rows, row_count):
+    # a buffer of at least row_count rows holding the first filled_rows rows of values;
+    # capacity doubles, and pages never written to are never backed by memory
+    if values.shape[0] >= row_count:
+        return values
+    grown = np.empty((max(row_count, 2 * values.shape[0]), values.shape[1]), dtype=values.dtype)
+    grown[:filled_rows] = values[:filled_rows]
+    return grown
+
+
+def fill_missing(values):
+    # in place, so missing values never cost a copy of the matrix
+    values[np.isnan(values)] = 0
+    return values
+
+
+def _read_excel(file_path, dtype):
+    import pandas as pd
+
+    df = pd.read_excel(file_path, index_col=0)
+    try:
+        df = df.astype(dtype)
+    except ValueError as e:
+        raise ValueError('Matrix file contains non-numeric values: {}'.format(e))
+
+    return df.fillna(0)
+
+
+def iter_matrix_chunks(file_path, dtype=np.float64, head=None):
+    """
+    iter_matrix_chunks: stream a delimited text matrix as DataFrame row chunks
+
+    The delimiter is sniffed from a small head buffer and the file is parsed exactly once by
+    the pandas C engine with the first column as row labels and every other column as dtype.
+    Chunks are sized to roughly CHUNK_BYTES of numeric data and still contain missing values.
+    """
+    import pandas as pd
+
+    if head is None:
+        head = _read_head(file_path)
+
+    delimiter = sniff_delimiter(head)
+    column_count = len(_read_header(head, delimiter))
+    logging.info('Detected delimiter {!r} with {} columns'.format(delimiter, column_count))
+
+    # dtype keyed by column position, the row label column stays as text
+    column_dtypes = {i: dtype for i in range(1, column_count)}
+    column_dtypes[0] = str
+
+    chunk_rows = max(MIN_CHUNK_ROWS,
+                     CHUNK_BYTES // (np.dtype(dtype).itemsize * max(1, column_count - 1)))
+
+    reader = pd.read_csv(file_path, sep=delimiter, engine='c', index_col=0,
+                         dtype=column_dtypes, chunksize=chunk_rows)
+    try:
+        for chunk in reader:
+            yield chunk
+    except ValueError as e:
+        raise ValueError('Matrix file contains non-numeric values: {}'.format(e))
+    finally:
+        reader.close()
+
+
+def read_matrix(file_path, dtype=np.float64, sketch=None):
+    """
+    read_matrix: read a matrix file (TSV/CSV or Excel) into a numeric DataFrame
+
+    The file format is detected from its magic bytes (or extension). Delimited text is streamed
+    into a single array, grown as chunks are parsed, filling missing values with 0 chunk by
+    chunk; the buffer is sized from the rows the parser produced, never from line breaks.
+
+    sketch: optional QuantileSketch updated with every chunk of values
+    """
+    import pandas as pd
+
+    head = _read_head(file_path)
+    file_format = detect_file_format(file_path, head)
+    logging.info('Detected {} file format'.format(file_format))
+
+    if file_format == EXCEL_FORMAT:
+        df = _read_excel(file_path, dtype)
+        if sketch is not None:
+            sketch.update(df.values)
+        return df
+
+    values = None
+    labels = list()
+    filled_rows = 0
+    for chunk in iter_matrix_chunks(file_path, dtype=dtype, head=head):
+        if values is None:
+            columns = chunk.columns
+            index_name = chunk.index.name
+            values = np.empty((chunk.index.size, columns.size), dtype=dtype)
+        values = _grow(values, filled_rows, filled_rows + chunk.index.size)
+
+        chunk_values = values[filled_rows:filled_rows + chunk.index.size]
+        chunk_values[:] = chunk.values
+        fill_missing(chunk_values)
+        if sketch is not None:
+            sketch.update(chunk_values)
+
+        labels.extend(chunk.index)
+        filled_rows += chunk.index.size
+
+    if values is None:
+        raise ValueError('Matrix file {} is empty'.format(file_path))
+
+    index = pd.Index(labels, name=index_name)
+    return pd.DataFrame(values[:filled_rows], index=index, columns=columns, copy=False)
+
+
+def read_sparse_matrix(file_path, dtype=np.float64, sketch=None):
+    """
+    read_sparse_matrix: read a matrix file into a DataFrame of sparse columns
+
+    Delimited text is streamed chunk by chunk and every chunk is compressed to CSR after its
+    missing values are filled with 0, so peak memory is the sparse matrix plus one dense
+    chunk. Meant for mostly zero matrices like amplicon/OTU tables.
+
+    sketch: optional QuantileSketch updated with every chunk of values
+    """
+    import pandas as pd
+    from scipy import sparse
+
+    head = _read_head(file_path)
+    if detect_file_format(file_path, head) == EXCEL_FORMAT:
+        df = _read_excel(file_path, dtype)
+        if sketch is not None:
+            sketch.update(df.values)
+        return to_sparse_frame(sparse.csr_matrix(df.values), df.index, df.columns)
+
+    blocks = list()
+    labels = list()
+    columns = index_name = None
+    for chunk in iter_matrix_chunks(file_path, dtype=dtype, head=head):
+        columns = chunk.columns
+        index_name = chunk.index.name
+        chunk_values = fill_missing(np.array(chunk.values, dtype=dtype))
+        if sketch is not None:
+            sketch.update(chunk_values)
+
+        blocks.append(sparse.csr_matrix(chunk_values))
+        labels.extend(chunk.index)
+
+    if not blocks:
+        raise ValueError('Matrix file {} is empty'.format(file_path))
+
+    matrix = sparse.vstack(blocks, format='csr')
+    logging.info('Read {} non-zero values of a {} matrix'.format(matrix.nnz, matrix.shape))
+
+    return to_sparse_frame(matrix, pd.Index(labels, name=index_name), columns)
+
+
+def read_top_rows(file_path, top_percent, top_by='sum', dtype=np.float64, statistics=None):
+    """
+    read_top_rows: stream a delimited text matrix and keep only its top_percent rows
+
+    A first pass computes the row statistics (sum, mean, max and variance) chunk by chunk,
+    keeping only those; the rows kept are then picked by top_by exactly like
+    HeatmapUtil._select_top_rows does, and a second pass copies only those rows. Rows are
+    returned in their original order.
+
+    The file is parsed twice on purpose: top_percent is relative to the row count, which is
+    only known at the end of the file, so a single pass could not bound a heap of candidate
+    rows and would have to hold them all. Two passes keep memory at the selected rows plus
+    one chunk and a few floats per row.
+
+    statistics: optional dict filled with every statistic of every row of the file
+    """
+    import pandas as pd
+
+    chunk_statistics = [row_statistics(fill_missing(np.array(chunk.values, dtype=dtype)))
+                        for chunk in iter_matrix_chunks(file_path, dtype=dtype)]
+    if not chunk_statistics:
+        raise ValueError('Matrix file {} is empty'.format(file_path))
+    file_statistics = {name: np.concatenate([chunk[name] for chunk in chunk_statistics])
+                       for name in chunk_statistics[0]}
+    if statistics is not None:
+        statistics.update(file_statistics)
+    scores = file_statistics[top_by]
+
+    k = top_row_count(scores.size, top_percent)
+    logging.info('Streaming top {} of {} rows by {} from {}'.format(
+                                                        k, scores.size, top_by, file_path))
+    top_idx = top_k_indices(scores, k)
+
+    blocks = list()
+    labels = list()
+    position = 0
+    for chunk in iter_matrix_chunks(file_path, dtype=dtype):
+        columns = chunk.columns
+        index_name = chunk.index.name
+        start, end = np.searchsorted(top_idx, [position, position + chunk.index.size])
+        chunk_idx = top_idx[start:end] - position
+        blocks.append(fill_missing(np.array(chunk.values[chunk_idx], dtype=dtype)))
+        labels.extend(chunk.index[chunk_idx])
+        position += chunk.index.size
+
+    index = pd.Index(labels, name=index_name)
+
+    return pd.DataFrame(np.vstack(blocks), index=index, columns=columns)
@@ -0,0 +1,169 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# seconds between two RSS samples
+RSS_SAMPLE_INTERVAL = 0.05
+
+# held by the sampler threads while they sample, see paused_samplers
+sampling_lock = threading.RLock()
+
+
+@contextmanager
+def paused_samplers():
+    """
+    paused_samplers: context in which no sampler thread (RssSampler, ProfileUtil.StackSampler)
+                     is sampling, so a process forked inside it copies no lock they hold
+    """
+    with sampling_lock:
+        yield
+
+
+class _Window:
+    # compared by identity, so equal peaks never mix up two windows
+    def __init__(self):
+        self.peak = 0
+
+
+class RssSampler:
+    """
+    RssSampler: background thread sampling the resident memory of this process and its children
+
+    psutil only reports the current RSS on Linux, so peaks are taken over the samples. Every
+    open window (see open_window) keeps its own peak.
+    """
+
+    def __init__(self, interval=RSS_SAMPLE_INTERVAL):
+        import psutil
+
+        self._process = psutil.Process(os.getpid())
+        self._no_such_process = psutil.NoSuchProcess
+        self._interval = interval
+        self._windows = list()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self.peak = 0
+        self.sample()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def sample(self):
+        rss = self._process.memory_info().rss
+        for child in self._process.children(recursive=True):
+            try:
+                rss += child.memory_info().rss
+            except self._no_such_process:
+                # worker exited between listing and sampling
+                pass
+
+        with self._lock:
+            self.peak = max(self.peak, rss)
+            for window in self._windows:
+                window.peak = max(window.peak, rss)
+
+        return rss
+
+    def _run(self):
+        while not self._stopped.wait(self._interval):
+            with sampling_lock:
+                self.sample()
+
+    def open_window(self):
+        window = _Window()
+        with self._lock:
+            self._windows.append(window)
+        self.sample()
+        return window
+
+    def close_window(self, window):
+        self.sample()
+        with self._lock:
+            self._windows.remove(window)
+        return window.peak
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+        self.sample()
+
+
+class PipelineMetrics:
+    """
+    PipelineMetrics: per stage durations and memory of one build_heatmap_html call
+
+    Stages may nest: the time of a stage excludes the time of stages opened inside it, so the
+    stage durations add up to the time spent in stages. A stage entered more than once adds up.
+    Parts (add_part) break the time of a stage down, e.g. per clustered axis, and are already
+    contained in it. Values (shapes, sizes) are recorded with set. as_dict flattens everything
+    into <stage>_s, <part>_s, <stage>_peak_rss_mb and the values.
+    """
+
+    def __init__(self, sample_memory=True):
+        self.durations = dict()
+        self.parts = dict()
+        self.peak_rss = dict()
+        self.values = dict()
+        self._open = list()
+        self._start = time.perf_counter()
+        self._sampler = RssSampler() if sample_memory else None
+
+    @contextmanager
+    def stage(self, name):
+        frame = {'start': time.perf_counter(), 'children': 0.}
+        window = self._sampler.open_window() if self._sampler else None
+        self._open.append(frame)
+        try:
+            yield
+        finally:
+            self._open.pop()
+            elapsed = time.perf_counter() - frame['start']
+            if self._open:
+                self._open[-1]['children'] += elapsed
+            self.add(name, elapsed - frame['children'])
+            if window is not None:
+                self.peak_rss[name] = max(self.peak_rss.get(name, 0),
+                                          self._sampler.close_window(window))
+
+    def add(self, name, seconds):
+        """
+        add: add seconds spent in stage name
+        """
+        self.durations[name] = self.durations.get(name, 0.) + seconds
+
+    def add_part(self, name, seconds):
+        """
+        add_part: add seconds spent in part name of an open stage, e.g. measured in a worker
+                  process; parts running concurrently may add up to more than their stage
+        """
+        self.parts[name] = self.parts.get(name, 0.) + seconds
+
+    def set(self, name, value):
+        self.values[name] = value
+
+    def close(self):
+        if self._sampler is not None:
+            self._sampler.stop()
+            self.values['peak_rss_mb'] = self._sampler.peak / 1024. ** 2
+        self.values['total_s'] = time.perf_counter() - self._start
+
+    def as_dict(self):
+        metrics = dict(self.values)
+        for name, seconds in list(self.durations.items()) + list(self.parts.items()):
+            metrics['{}_s'.format(name)] = seconds
+        for name, peak in self.peak_rss.items():
+            metrics['{}_peak_rss_mb'.format(name)] = peak / 1024. ** 2
+
+        return metrics
+
+
+@contextmanager
+def _no_stage():
+    yield
+
+
+def stage(metrics, name):
+    """
+    stage: metrics.stage(name), or a context doing nothing if metrics is None
+    """
+    return metrics.stage(name) if metrics is not None else _no_stage()
@@ -0,0 +1,97 @@
+import cProfile
+import os
+import sys
+import threading
+from collections import Counter
+
+from kb_GenericsReport.Utils.MetricsUtil import sampling_lock
+
+# environment variable turning profiling on for every build_heatmap_html call
+PROFILE_ENV = 'KB_GENERICSREPORT_PROFILE'
+PROFILE_STATS_FILE = 'profile.pstats'
+PROFILE_STACKS_FILE = 'profile.collapsed'
+# seconds between two stack samples
+STACK_SAMPLE_INTERVAL = 0.01
+
+
+def profile_enabled_by_env():
+    """
+    profile_enabled_by_env: True if PROFILE_ENV is set to anything but empty, 0 or false
+    """
+    return os.environ.get(PROFILE_ENV, '').strip().lower() not in ['', '0', 'false', 'no']
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return '{}:{}'.format(os.path.basename(code.co_filename), code.co_name)
+
+
+class StackSampler:
+    """
+    StackSampler: background thread sampling the Python stack of one thread
+
+    Samples are counted per stack, root first, in the collapsed format flamegraph.pl,
+    speedscope and inferno read. Time spent in C extensions (scipy, numpy) is attributed to
+    the Python frame that called into them.
+    """
+
+    def __init__(self, thread_id, interval=STACK_SAMPLE_INTERVAL):
+        self._thread_id = thread_id
+        self._interval = interval
+        self.stacks = Counter()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stopped.wait(self._interval):
+            with sampling_lock:
+                frame = sys._current_frames().get(self._thread_id)
+                names = list()
+                while frame is not None:
+                    names.append(_frame_name(frame))
+                    frame = frame.f_back
+                if names:
+                    self.stacks[';'.join(reversed(names))] += 1
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def write(self, file_path):
+        with open(file_path, 'w') as stacks_file:
+            for stack, count in sorted(self.stacks.items()):
+                stacks_file.write('{} {}\n'.format(stack, count))
+
+
+class CallProfiler:
+    """
+    CallProfiler: deterministic (cProfile) and sampling profile of the calling thread
+
+    Both run from start to stop; write stores the cProfile statistics as PROFILE_STATS_FILE
+    (read with pstats or snakeviz) and the sampled stacks as PROFILE_STACKS_FILE. Work done in
+    clustering worker processes shows up as the time spent waiting for them.
+    """
+
+    def __init__(self):
+        self._profiler = cProfile.Profile()
+        self._sampler = None
+
+    def start(self):
+        self._sampler = StackSampler(threading.get_ident())
+        self._profiler.enable()
+
+    def stop(self):
+        self._profiler.disable()
+        self._sampler.stop()
+
+    def write(self, output_directory):
+        """
+        write: write the profile files into output_directory, returns their paths
+        """
+        stats_path = os.path.join(output_directory, PROFILE_STATS_FILE)
+        stacks_path = os.path.join(output_directory, PROFILE_STACKS_FILE)
+        self._profiler.dump_stats(stats_path)
+        self._sampler.write(stacks_path)
+
+        return [stats_path, stacks_path]
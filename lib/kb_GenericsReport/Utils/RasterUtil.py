@@ -0,0 +1,175 @@
+import base64
+import io
+
+import numpy as np
+
+from kb_GenericsReport.Utils.ColorScaleUtil import parse_color
+
+RASTER_AGGREGATIONS = ['mean', 'max']
+
+# rasterised figures no longer grow with the matrix
+RASTER_MAX_WIDTH = 2000
+RASTER_MAX_HEIGHT = 2000
+
+# resolution of the invisible heatmap providing hover text over the image
+HOVER_BINS = 200
+
+MAX_TICKS = 100
+
+
+def bin_starts(size, bins):
+    """
+    bin_starts: start index of each of (at most) bins contiguous, near equal sized bins
+    """
+    bins = max(1, min(size, bins))
+    return np.linspace(0, size, bins + 1).astype(int)[:-1]
+
+
+def block_reduce(values, row_starts, col_starts, how='mean'):
+    """
+    block_reduce: aggregate values into blocks starting at row_starts x col_starts
+
+    values: dense array or scipy sparse matrix, which is reduced without densifying it
+    """
+    if hasattr(values, 'tocoo'):
+        return _sparse_block_reduce(values, row_starts, col_starts, how=how)
+
+    ufunc = np.add if how == 'mean' else np.maximum
+    reduced = ufunc.reduceat(ufunc.reduceat(values, row_starts, axis=0), col_starts, axis=1)
+
+    if how == 'mean':
+        row_counts = np.diff(np.append(row_starts, values.shape[0]))
+        col_counts = np.diff(np.append(col_starts, values.shape[1]))
+        reduced = reduced / np.outer(row_counts, col_counts)
+
+    return reduced
+
+
+def _sparse_block_reduce(values, row_starts, col_starts, how='mean'):
+    values = values.tocsr()
+    values.sum_duplicates()
+    coo = values.tocoo()
+    shape = (len(row_starts), len(col_starts))
+    blocks = (np.searchsorted(row_starts, coo.row, side='right') - 1) * shape[1] + (
+              np.searchsorted(col_starts, coo.col, side='right') - 1)
+    block_sizes = np.outer(np.diff(np.append(row_starts, values.shape[0])),
+                           np.diff(np.append(col_starts, values.shape[1])))
+
+    if how == 'mean':
+        sums = np.bincount(blocks, weights=coo.data, minlength=shape[0] * shape[1])
+        return sums.reshape(shape) / block_sizes
+
+    # the maximum of the stored values, or 0 where a block has implicit zeros
+    reduced = np.full(shape[0] * shape[1], -np.inf)
+    np.maximum.at(reduced, blocks, coo.data)
+    reduced = reduced.reshape(shape)
+    stored = np.bincount(blocks, minlength=shape[0] * shape[1]).reshape(shape)
+    has_zeros = stored < block_sizes
+    reduced[has_zeros] = np.maximum(reduced[has_zeros], 0)
+
+    return reduced
+
+
+def apply_colorscale(values, colorscale, cmin, cmax):
+    """
+    apply_colorscale: RGB uint8 image of values, interpolated like plotly between colorscale stops
+    """
+    stops = np.array([stop for stop, _ in colorscale], dtype=float)
+    colors = np.array([parse_color(color) for _, color in colorscale], dtype=float)
+
+    normalized = (values - cmin) / (cmax - cmin) if cmax > cmin else np.zeros_like(values)
+    normalized = np.clip(normalized, 0, 1)
+
+    rgb = np.stack([np.interp(normalized, stops, colors[:, channel]) for channel in range(3)],
+                   axis=-1)
+
+    return np.rint(rgb).astype(np.uint8)
+
+
+def _png_data_uri(rgb):
+    # matplotlib.image writes the PNG without loading pyplot or a drawing backend
+    from matplotlib import image
+
+    buffer = io.BytesIO()
+    image.imsave(buffer, rgb, format='png')
+    return 'data:image/png;base64,{}'.format(base64.b64encode(buffer.getvalue()).decode('ascii'))
+
+
+def _extent(positions):
+    spacing = abs(positions[1] - positions[0]) if len(positions) > 1 else 1.
+    return min(positions) - spacing / 2, max(positions) + spacing / 2
+
+
+def label_ranges(labels, starts):
+    """
+    label_ranges: 'first … last' label of each block of labels starting at starts
+    """
+    ends = np.append(starts[1:], len(labels)) - 1
+    return ['{} … {}'.format(labels[start], labels[end]) if end > start else str(labels[start])
+            for start, end in zip(starts, ends)]
+
+
+def downsample_ticks(tickvals, ticktext, max_ticks=MAX_TICKS):
+    """
+    downsample_ticks: keep at most max_ticks evenly spaced ticks
+    """
+    if len(tickvals) <= max_ticks:
+        return list(tickvals), list(ticktext)
+    keep = bin_starts(len(tickvals), max_ticks)
+    return [tickvals[i] for i in keep], [ticktext[i] for i in keep]
+
+
+def build_raster_heatmap(values, x_positions, y_positions, x_labels, y_labels,
+                         colorscale, cmin, cmax, width, height, how='mean'):
+    """
+    build_raster_heatmap: server-side rendered heatmap layers for a matrix too big for the browser
+
+    The matrix is block reduced (how: mean or max) to at most width x height pixels and drawn
+    as a PNG layout image over the heatmap area. An invisible, coarser heatmap trace on top
+    provides hover text (label ranges and aggregated value) and the colour bar.
+
+    values: dense array or scipy sparse matrix
+    x_positions/y_positions: numeric axis position of every column/row, in matrix order
+    returns (hover_trace, layout_image)
+    """
+    import plotly.graph_objects as go
+
+    if not hasattr(values, 'tocoo'):
+        values = np.asarray(values, dtype=float)
+
+    image = block_reduce(values, bin_starts(values.shape[0], height),
+                         bin_starts(values.shape[1], width), how=how)
+    rgb = apply_colorscale(image, colorscale, cmin, cmax)
+    if y_positions[-1] > y_positions[0]:
+        # image rows are drawn top down, the first matrix row sits at the bottom of the axis
+        rgb = rgb[::-1]
+
+    x0, x1 = _extent(x_positions)
+    y0, y1 = _extent(y_positions)
+    layout_image = dict(source=_png_data_uri(rgb),
+                        xref='x', yref='y',
+                        x=x0, y=y1, sizex=x1 - x0, sizey=y1 - y0,
+                        xanchor='left', yanchor='top',
+                        sizing='stretch', layer='below')
+
+    row_starts = bin_starts(values.shape[0], HOVER_BINS)
+    col_starts = bin_starts(values.shape[1], HOVER_BINS)
+    row_ranges = label_ranges(y_labels, row_starts)
+    col_ranges = label_ranges(x_labels, col_starts)
+    hover_text = [['row: {}<br>column: {}'.format(row_range, col_range)
+                   for col_range in col_ranges] for row_range in row_ranges]
+
+    x_positions = np.asarray(x_positions, dtype=float)
+    y_positions = np.asarray(y_positions, dtype=float)
+    hover_trace = go.Heatmap(
+                       z=block_reduce(values, row_starts, col_starts, how=how),
+                       x=np.add.reduceat(x_positions, col_starts) / np.diff(
+                                                    np.append(col_starts, x_positions.size)),
+                       y=np.add.reduceat(y_positions, row_starts) / np.diff(
+                                                    np.append(row_starts, y_positions.size)),
+                       text=hover_text,
+                       hovertemplate='%{text}<br>' + how + ': %{z}<extra></extra>',
+                       opacity=0,
+                       coloraxis='coloraxis')
+
+    return hover_trace, layout_image
@@ -0,0 +1,60 @@
+import numpy as np
+
+ROW_SCORE_FUNCTIONS = {'sum': np.sum,
+                       'mean': np.mean,
+                       'max': np.max,
+                       'variance': np.var}
+
+
+def row_scores(values, top_by='sum'):
+    """
+    row_scores: per row statistic used to rank rows for the top percent view
+
+    values: dense array or scipy sparse matrix, which is never densified
+    """
+    if hasattr(values, 'tocsr'):
+        return _sparse_row_scores(values.tocsr(), top_by)
+    return ROW_SCORE_FUNCTIONS[top_by](values, axis=1)
+
+
+def row_statistics(values):
+    """
+    row_statistics: dict of every ROW_SCORE_FUNCTIONS statistic per row of values
+    """
+    return {top_by: row_scores(values, top_by=top_by) for top_by in ROW_SCORE_FUNCTIONS}
+
+
+def _sparse_row_scores(values, top_by):
+    if top_by == 'max':
+        return values.max(axis=1).toarray().ravel()
+    if top_by == 'sum':
+        return np.asarray(values.sum(axis=1)).ravel()
+
+    means = np.asarray(values.mean(axis=1)).ravel()
+    if top_by == 'mean':
+        return means
+
+    # variance
+    return np.asarray(values.multiply(values).mean(axis=1)).ravel() - means ** 2
+
+
+def top_row_count(row_count, top_percent):
+    """
+    top_row_count: number of rows kept for top_percent (at least one)
+    """
+    return max(1, int(row_count * top_percent / 100))
+
+
+def top_k_indices(scores, k):
+    """
+    top_k_indices: positions of the k highest scores, in their original order
+
+    uses partial selection (O(n)) instead of sorting all scores
+    """
+    if k >= scores.size:
+        return np.arange(scores.size)
+
+    top_idx = np.argpartition(scores, scores.size - k)[scores.size - k:]
+    top_idx.sort()
+
+    return top_idx
@@ -0,0 +1,154 @@
+import numpy as np
+
+# items kept per compactor level; rank error shrinks with 1 / capacity
+DEFAULT_SKETCH_CAPACITY = 1024
+SKETCH_SEED = 1234
+# values added per update when sketching a matrix held in memory or memory-mapped
+SKETCH_BATCH_VALUES = 8 * 1024 ** 2
+
+
+class QuantileSketch:
+    """
+    QuantileSketch: mergeable approximate quantile sketch (KLL style compactors)
+
+    Values are added in batches to level 0. A level holding more than capacity items is
+    sorted and every other item, from a random offset, is promoted to the next level with
+    twice the weight. Memory grows with log2(count / capacity) levels only, so a matrix of any
+    size streamed chunk by chunk is summarised in constant memory. Count, minimum, maximum and
+    sum are kept exactly.
+    """
+
+    def __init__(self, capacity=DEFAULT_SKETCH_CAPACITY, seed=SKETCH_SEED):
+        self.capacity = capacity
+        self.levels = list()
+        self.count = 0
+        self.min = np.inf
+        self.max = -np.inf
+        self.sum = 0.
+        self._random = np.random.RandomState(seed)
+
+    def update(self, values):
+        """
+        update: add a batch (any shape) of values
+        """
+        values = np.asarray(values, dtype=float).ravel()
+        if not values.size:
+            return
+
+        self.count += values.size
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+        self.sum += float(values.sum())
+
+        level = 0
+        if values.size > self.capacity:
+            # a large batch is compacted in one go: sorted once, every 2 ** level-th item kept
+            level = int(np.ceil(np.log2(values.size / self.capacity)))
+            step = 2 ** level
+            values = np.sort(values)[self._random.randint(step)::step]
+
+        self._add(level, values)
+
+    def merge(self, other):
+        """
+        merge: add everything summarised by other
+        """
+        if not other.count:
+            return
+
+        self.count += other.count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.sum += other.sum
+
+        for level, items in enumerate(other.levels):
+            self._add(level, items)
+
+    def _add(self, level, items):
+        while True:
+            while level >= len(self.levels):
+                self.levels.append(np.empty(0))
+
+            items = np.concatenate([self.levels[level], items])
+            if items.size <= self.capacity:
+                self.levels[level] = items
+                return
+
+            # compact: keep every other sorted item at twice the weight on the next level;
+            # an odd item out stays on this level so no weight is lost
+            items.sort()
+            if items.size % 2:
+                self.levels[level] = items[-1:]
+                items = items[:-1]
+            else:
+                self.levels[level] = np.empty(0)
+            items = items[self._random.randint(2)::2]
+            level += 1
+
+    def quantiles(self, qs):
+        """
+        quantiles: approximate values at quantiles qs (0 to 1), exact at 0 and 1
+        """
+        qs = np.asarray(qs, dtype=float)
+        if not self.count:
+            return np.zeros(qs.shape)
+
+        items = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(level_items.size, 2. ** level)
+                                  for level, level_items in enumerate(self.levels)])
+        order = np.argsort(items, kind='stable')
+        items = items[order]
+        # rank of the middle of each item's weight, scaled to 0 to 1
+        cumulative = np.cumsum(weights[order])
+        ranks = (cumulative - weights[order] / 2) / cumulative[-1]
+
+        result = np.interp(qs, ranks, items)
+        result[qs <= 0] = self.min
+        result[qs >= 1] = self.max
+
+        return result
+
+    def summary(self):
+        """
+        summary: count, min, max, mean and approximate median
+        """
+        if not self.count:
+            return {'count': 0}
+
+        return {'count': self.count,
+                'min': self.min,
+                'max': self.max,
+                'mean': self.sum / self.count,
+                'median': float(self.quantiles([0.5])[0])}
+
+    def save(self, path):
+        stats = np.array([self.capacity, self.count, self.min, self.max, self.sum])
+        np.savez(path, stats, *self.levels)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as saved:
+            capacity, count, min_value, max_value, total = saved['arr_0']
+            sketch = cls(capacity=int(capacity))
+            sketch.levels = [saved['arr_{}'.format(i)] for i in range(1, len(saved.files))]
+        sketch.count = int(count)
+        sketch.min = float(min_value)
+        sketch.max = float(max_value)
+        sketch.sum = float(total)
+
+        return sketch
+
+
+def matrix_sketch(values):
+    """
+    matrix_sketch: QuantileSketch of a 2D matrix, added in row batches so no copy is made
+
+    values: dense array or scipy sparse matrix, densified one row batch at a time
+    """
+    sketch = QuantileSketch()
+    batch_rows = max(1, SKETCH_BATCH_VALUES // max(1, values.shape[1]))
+    for start in range(0, values.shape[0], batch_rows):
+        batch = values[start:start + batch_rows]
+        sketch.update(batch.toarray() if hasattr(batch, 'toarray') else batch)
+
+    return sketch
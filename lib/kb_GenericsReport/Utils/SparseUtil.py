@@ -0,0 +1,181 @@
+import numpy as np
+
+# distance metrics computed straight from the sparse matrix, others densify the axis
+SPARSE_METRICS = ['cosine', 'jaccard', 'braycurtis']
+
+
+def is_sparse_frame(df):
+    """
+    is_sparse_frame: True if every column of df holds pandas sparse values
+    """
+    import pandas as pd
+
+    return df.columns.size > 0 and all(isinstance(dtype, pd.SparseDtype) for dtype in df.dtypes)
+
+
+def to_sparse_frame(matrix, index, columns):
+    """
+    to_sparse_frame: DataFrame of sparse columns backed by the scipy sparse matrix
+
+    the columns are given a fill value of 0, newer pandas leave it at NaN and so read every
+    implicit zero as missing
+    """
+    import pandas as pd
+
+    df = pd.DataFrame.sparse.from_spmatrix(matrix, index=index, columns=columns)
+    dtype = pd.SparseDtype(matrix.dtype, 0)
+    if all(column_dtype == dtype for column_dtype in df.dtypes):
+        return df
+
+    arrays = [pd.arrays.SparseArray(array.sp_values, sparse_index=array.sp_index, dtype=dtype)
+              for array in (df.iloc[:, i].array for i in range(df.columns.size))]
+    zero_filled = pd.DataFrame(dict(enumerate(arrays)), index=df.index)
+    zero_filled.columns = df.columns
+
+    return zero_filled
+
+
+def matrix_values(df):
+    """
+    matrix_values: CSR matrix of a sparse DataFrame, the dense values of any other DataFrame
+    """
+    if is_sparse_frame(df):
+        return df.sparse.to_coo().tocsr()
+    return df.values
+
+
+def dense_values(df):
+    """
+    dense_values: values of df as a dense array, the implicit zeros of a sparse DataFrame as 0
+    """
+    values = matrix_values(df)
+    return values.toarray() if is_sparse_frame(df) else values
+
+
+# dense distances computed at once by sparse_pdist, rows x remaining rows of one block
+PDIST_BLOCK_ENTRIES = 2 ** 20
+
+
+def _cosine(matrix):
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    # all-zero rows are at distance 1 from everything instead of undefined
+    norms[norms == 0] = 1
+    rest = matrix.T.tocsc()
+
+    def block_distances(start, stop):
+        similarity = (matrix[start:stop] @ rest[:, start:]).toarray()
+        similarity /= norms[start:stop, None]
+        similarity /= norms[None, start:]
+        return 1 - similarity
+
+    return block_distances
+
+
+def _jaccard(matrix):
+    """
+    _jaccard: scipy's jaccard, the share of unequal entries among those non-zero in either row
+    """
+    from scipy import sparse
+
+    matrix = matrix.tocoo()
+    presence = sparse.csr_matrix((np.ones(matrix.nnz), (matrix.row, matrix.col)),
+                                 shape=matrix.shape)
+    # one column per (column, value) pair, so products count equal non-zero entries
+    value_columns = np.zeros(matrix.nnz, dtype=np.intp)
+    if matrix.nnz:
+        _, value_columns = np.unique(np.stack([matrix.col.astype(float), matrix.data]), axis=1,
+                                     return_inverse=True)
+    values = sparse.csr_matrix((np.ones(matrix.nnz), (matrix.row, value_columns.ravel())),
+                               shape=(matrix.shape[0], value_columns.max(initial=0) + 1))
+    nonzero = np.asarray(presence.sum(axis=1)).ravel()
+    presence_rest = presence.T.tocsc()
+    values_rest = values.T.tocsc()
+
+    def block_distances(start, stop):
+        union = (nonzero[start:stop, None] + nonzero[None, start:] -
+                 (presence[start:stop] @ presence_rest[:, start:]).toarray())
+        equal = (values[start:stop] @ values_rest[:, start:]).toarray()
+        with np.errstate(invalid='ignore', divide='ignore'):
+            distances = (union - equal) / union
+        distances[union == 0] = 0
+        return distances
+
+    return block_distances
+
+
+def _braycurtis(matrix):
+    """
+    _braycurtis: 1 - 2 * sum(min(u, v)) / (sum(u) + sum(v)), only valid for non-negative values
+    """
+    columns = matrix.tocsc()
+    row_sums = np.asarray(matrix.sum(axis=1)).ravel()
+    row_count = matrix.shape[0]
+
+    def block_distances(start, stop):
+        shared = np.empty((stop - start, row_count - start))
+        for i in range(start, stop):
+            row = matrix.getrow(i)
+            # entries of the other rows in the columns row i is non-zero in
+            sub = columns[:, row.indices]
+            row_values = np.repeat(row.data, np.diff(sub.indptr))
+            shared[i - start] = np.bincount(sub.indices,
+                                            weights=np.minimum(sub.data, row_values),
+                                            minlength=row_count)[start:]
+
+        totals = row_sums[start:stop, None] + row_sums[None, start:]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            distances = 1 - 2 * shared / totals
+        distances[totals == 0] = 0
+        return distances
+
+    return block_distances
+
+
+def sparse_pdist(matrix, metric):
+    """
+    sparse_pdist: condensed pairwise distances between the rows of a scipy sparse matrix
+
+    Same values as scipy.spatial.distance.pdist for metrics in SPARSE_METRICS (braycurtis
+    needs non-negative values) without densifying the matrix. Distances are computed in row
+    blocks of at most PDIST_BLOCK_ENTRIES against the rows that follow and written straight
+    into the condensed vector, so peak memory is the condensed vector plus one block, like
+    pdist.
+    """
+    # float32 matrices stay float32, anything else is computed in float64
+    dtype = np.result_type(matrix.dtype, np.float32)
+    matrix = matrix.tocsr().astype(dtype)
+    matrix.sum_duplicates()
+    matrix.eliminate_zeros()
+
+    if metric == 'cosine':
+        block_distances = _cosine(matrix)
+    elif metric == 'jaccard':
+        block_distances = _jaccard(matrix)
+    elif metric == 'braycurtis':
+        block_distances = _braycurtis(matrix)
+    else:
+        raise ValueError('Unsupported sparse distance metric: {}'.format(metric))
+
+    row_count = matrix.shape[0]
+    condensed = np.empty(row_count * (row_count - 1) // 2, dtype=dtype)
+    start = 0
+    while start < row_count - 1:
+        stop = min(row_count - 1, start + max(1, PDIST_BLOCK_ENTRIES // (row_count - start)))
+        distances = block_distances(start, stop)
+        np.clip(distances, 0, None, out=distances)
+        for i in range(start, stop):
+            # pairs (i, j > i) are contiguous in the condensed vector
+            offset = i * (2 * row_count - i - 1) // 2
+            condensed[offset:offset + row_count - i - 1] = distances[i - start, i - start + 1:]
+        start = stop
+
+    return condensed
+
+
+def supports_sparse_pdist(matrix, metric):
+    """
+    supports_sparse_pdist: True if sparse_pdist can compute metric for matrix
+    """
+    if metric not in SPARSE_METRICS:
+        return False
+    return metric != 'braycurtis' or not matrix.nnz or matrix.data.min() >= 0
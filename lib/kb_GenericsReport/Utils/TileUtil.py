@@ -0,0 +1,231 @@
+import json
+import os
+
+import numpy as np
+
+from kb_GenericsReport.Utils.RasterUtil import block_reduce
+
+# cells per tile side; also the most cells per axis the report shows at once
+TILE_SIZE = 256
+TILE_DIR = 'tiles'
+MANIFEST_FILE = 'pyramid.json'
+# tiles are raw little endian float32 arrays in row major order
+TILE_DTYPE = '<f4'
+
+# fetches the tiles covering the zoomed range from the finest level showing at most TILE_SIZE
+# cells per axis, and swaps them into the heatmap trace;
+# {plot_id} is filled in by plotly.io.write_html
+TILE_VIEWER_SCRIPT = """
+(function() {
+    var config = %s;
+    var traceIndex = %d;
+    var gd = document.getElementById('{plot_id}');
+    var tiles = {};
+    var request = 0;
+
+    function fetchTile(level, tileRow, tileColumn) {
+        var key = level + '/' + tileRow + '_' + tileColumn;
+        if (!(key in tiles)) {
+            tiles[key] = fetch(config.tile_dir + '/' + key + '.bin').then(function(response) {
+                if (!response.ok) {
+                    throw new Error('Failed to load heatmap tile ' + key);
+                }
+                return response.arrayBuffer();
+            }).then(function(buffer) {
+                return {row: tileRow, column: tileColumn, values: new Float32Array(buffer)};
+            });
+        }
+        return tiles[key];
+    }
+
+    function visibleCells(range, axis) {
+        if (!range) {
+            return [0, axis.count];
+        }
+        var a = (range[0] - axis.start) / axis.step, b = (range[1] - axis.start) / axis.step;
+        var lo = Math.max(0, Math.min(axis.count - 1, Math.floor(Math.min(a, b) + 0.5)));
+        var hi = Math.min(axis.count, Math.ceil(Math.max(a, b) + 0.5));
+        return [lo, Math.max(lo + 1, hi)];
+    }
+
+    function cellPositions(lo, hi, factor, axis) {
+        var positions = [];
+        for (var j = lo; j < hi; j++) {
+            var last = Math.min((j + 1) * factor, axis.count) - 1;
+            positions.push(axis.start + axis.step * (j * factor + last) / 2);
+        }
+        return positions;
+    }
+
+    function cellLabels(lo, hi, factor, axis) {
+        var labels = [];
+        for (var j = lo; j < hi; j++) {
+            var last = Math.min((j + 1) * factor, axis.count) - 1;
+            var label = axis.labels[j * factor];
+            labels.push(last > j * factor ? label + ' … ' + axis.labels[last] : label);
+        }
+        return labels;
+    }
+
+    function axisTicks(lo, hi, factor, axis) {
+        if (factor > 1 || hi - lo > config.max_ticks) {
+            return {tickvals: axis.tickvals, ticktext: axis.ticktext};
+        }
+        return {tickvals: cellPositions(lo, hi, 1, axis), ticktext: axis.labels.slice(lo, hi)};
+    }
+
+    function loadView(xRange, yRange) {
+        var columns = visibleCells(xRange, config.x), rows = visibleCells(yRange, config.y);
+        var size = config.tile_size, l = 0;
+        while (l < config.levels.length - 1 &&
+               ((rows[1] - rows[0]) / config.levels[l].row_factor > size ||
+                (columns[1] - columns[0]) / config.levels[l].col_factor > size)) {
+            l++;
+        }
+        var level = config.levels[l], rf = level.row_factor, cf = level.col_factor;
+        var r0 = Math.floor(rows[0] / rf), r1 = Math.ceil(rows[1] / rf);
+        var c0 = Math.floor(columns[0] / cf), c1 = Math.ceil(columns[1] / cf);
+
+        var pending = [];
+        for (var tr = Math.floor(r0 / size); tr * size < r1; tr++) {
+            for (var tc = Math.floor(c0 / size); tc * size < c1; tc++) {
+                pending.push(fetchTile(level.level, tr, tc));
+            }
+        }
+
+        var current = ++request;
+        Promise.all(pending).then(function(loaded) {
+            if (current !== request) {
+                // superseded by a later zoom
+                return;
+            }
+            var z = [];
+            for (var r = r0; r < r1; r++) {
+                z.push(new Array(c1 - c0));
+            }
+            loaded.forEach(function(tile) {
+                var width = Math.min(size, level.shape[1] - tile.column * size);
+                var rowStart = Math.max(r0, tile.row * size);
+                var rowEnd = Math.min(r1, (tile.row + 1) * size);
+                var colStart = Math.max(c0, tile.column * size);
+                var colEnd = Math.min(c1, (tile.column + 1) * size);
+                for (var r = rowStart; r < rowEnd; r++) {
+                    var offset = (r - tile.row * size) * width - tile.column * size;
+                    for (var c = colStart; c < colEnd; c++) {
+                        z[r - r0][c - c0] = tile.values[offset + c];
+                    }
+                }
+            });
+            var xLabels = cellLabels(c0, c1, cf, config.x);
+            var yLabels = cellLabels(r0, r1, rf, config.y);
+            var text = yLabels.map(function(yLabel) {
+                return xLabels.map(function(xLabel) {
+                    return 'row: ' + yLabel + '<br>column: ' + xLabel;
+                });
+            });
+            Plotly.restyle(gd, {z: [z],
+                                x: [cellPositions(c0, c1, cf, config.x)],
+                                y: [cellPositions(r0, r1, rf, config.y)],
+                                text: [text]}, [traceIndex]);
+
+            var xTicks = axisTicks(columns[0], columns[1], cf, config.x);
+            var yTicks = axisTicks(rows[0], rows[1], rf, config.y);
+            Plotly.relayout(gd, {'xaxis.tickvals': xTicks.tickvals,
+                                 'xaxis.ticktext': xTicks.ticktext,
+                                 'yaxis.tickvals': yTicks.tickvals,
+                                 'yaxis.ticktext': yTicks.ticktext});
+        }).catch(function(error) {
+            console.error(error);
+        });
+    }
+
+    gd.on('plotly_relayout', function(event) {
+        var zoomed = Object.keys(event).some(function(key) {
+            return /^[xy]axis\\.(range|autorange)/.test(key);
+        });
+        if (zoomed) {
+            loadView(gd.layout.xaxis.autorange ? null : gd.layout.xaxis.range,
+                     gd.layout.yaxis.autorange ? null : gd.layout.yaxis.range);
+        }
+    });
+})();
+"""
+
+
+def _write_tiles(values, level_dir, tile_size):
+    os.makedirs(level_dir)
+
+    tile_rows = -(-values.shape[0] // tile_size)
+    tile_cols = -(-values.shape[1] // tile_size)
+    for tile_row in range(tile_rows):
+        rows = slice(tile_row * tile_size, (tile_row + 1) * tile_size)
+        for tile_col in range(tile_cols):
+            cols = slice(tile_col * tile_size, (tile_col + 1) * tile_size)
+            tile_path = os.path.join(level_dir, '{}_{}.bin'.format(tile_row, tile_col))
+            tile = values[rows, cols]
+            if hasattr(tile, 'toarray'):
+                tile = tile.toarray()
+            np.ascontiguousarray(tile, dtype=TILE_DTYPE).tofile(tile_path)
+
+    return tile_rows, tile_cols
+
+
+def build_tile_pyramid(values, output_dir, tile_size=TILE_SIZE, how='mean'):
+    """
+    build_tile_pyramid: write values as a multi-resolution tile set into output_dir
+
+    Level 0 holds the matrix itself, every further level halves each axis still longer than
+    tile_size by combining pairs of cells (how: mean or max), until the matrix fits into a
+    single tile. Every level is cut into tile_size x tile_size tiles stored as
+    <level>/<tile row>_<tile column>.bin, described by the MANIFEST_FILE written next to them.
+
+    values: dense array or scipy sparse matrix; a sparse matrix is only densified one tile at a
+            time, the levels reduced from it are dense
+    returns (manifest, overview), overview being the values of the coarsest level
+    """
+    levels = list()
+    level_values = values if hasattr(values, 'tocsr') else np.asarray(values, dtype=float)
+    if hasattr(level_values, 'tocsr'):
+        level_values = level_values.tocsr()
+    row_factor = col_factor = 1
+    while True:
+        level = len(levels)
+        tile_rows, tile_cols = _write_tiles(level_values, os.path.join(output_dir, str(level)),
+                                            tile_size)
+        levels.append({'level': level,
+                       'row_factor': row_factor,
+                       'col_factor': col_factor,
+                       'shape': list(level_values.shape),
+                       'tile_rows': tile_rows,
+                       'tile_cols': tile_cols})
+
+        if max(level_values.shape) <= tile_size:
+            break
+
+        row_step = 2 if level_values.shape[0] > tile_size else 1
+        col_step = 2 if level_values.shape[1] > tile_size else 1
+        level_values = block_reduce(level_values,
+                                    np.arange(0, level_values.shape[0], row_step),
+                                    np.arange(0, level_values.shape[1], col_step), how=how)
+        row_factor *= row_step
+        col_factor *= col_step
+
+    manifest = {'tile_size': tile_size,
+                'dtype': 'float32',
+                'aggregation': how,
+                'levels': levels}
+    with open(os.path.join(output_dir, MANIFEST_FILE), 'w') as manifest_file:
+        json.dump(manifest, manifest_file)
+
+    return manifest, level_values
+
+
+def tile_viewer_script(manifest, trace_index, x_axis, y_axis, max_ticks):
+    """
+    tile_viewer_script: post_script loading finer tiles into trace_index on zoom
+
+    x_axis/y_axis: dict of the axis count, start and step (position of cell i is
+                   start + i * step), labels and the overview tickvals/ticktext
+    """
+    config = dict(manifest, tile_dir=TILE_DIR, x=x_axis, y=y_axis, max_ticks=max_ticks)
+    return TILE_VIEWER_SCRIPT % (json.dumps(config), trace_index)
@@ -22,11 +22,20 @@ class kb_GenericsReport:
     # state. A method could easily clobber the state set by another while
     # the latter method is running.
     ######################################### noqa
-    VERSION = "1.0.1"
+    VERSION = "1.1.0"
     GIT_URL = "git@github.com:Tianhao-Gu/kb_GenericsReport.git"
     GIT_COMMIT_HASH = "8000b96b25db8975a5e63b92dcf26ca0cda8de3e"
 
     #BEGIN_CLASS_HEADER
+    # optional build_heatmap_html parameters, also of every build_heatmap_html_batch entry
+    HEATMAP_OPT_PARAMS = ['cluster_data', 'sort_by_sum', 'top_percent', 'top_by', 'dist_metric',
+                          'linkage_method', 'centered_by', 'cluster_memory_budget_mb',
+                          'plotlyjs_mode', 'gzip_html', 'z_encoding', 'raster_cell_threshold',
+                          'raster_aggregation', 'tile_pyramid', 'color_scale', 'pseudo_count',
+                          'color_clip_percent', 'sparse', 'precision', 'profile',
+                          'leaf_ordering', 'truncate_levels', 'truncate_distance',
+                          'truncate_aggregation']
+
     @staticmethod
     def validate_params(params, expected, opt_param=set()):
         """Validates that required parameters are present. Warns if unexpected parameters appear"""
@@ -63,29 +72,108 @@ class kb_GenericsReport:
            cluster_data: True if data should be clustered. Default: True
            sort_by_sum: True if data should be sorted by sum of values.
            Default: False top_percent: Only display top x percent of data.
-           Default: 100 centered_by: set midpoint of color range. Default:
-           None dist_metric: distance metric used for clustering. Default:
-           euclidean
-           (https://docs.scipy.org/doc/scipy/reference/generated/scipy.spatial
-           .distance.pdist.html) linkage_method: linkage method used for
-           clustering. Default: ward
-           (https://docs.scipy.org/doc/scipy/reference/generated/scipy.cluster
-           .hierarchy.linkage.html)) -> structure: parameter "tsv_file_path"
-           of String, parameter "cluster_data" of type "boolean" (A boolean -
-           0 for false, 1 for true.), parameter "sort_by_sum" of type
+           Default: 100 top_by: row statistic used to select the top_percent
+           rows (sum, mean, max or variance). Default: sum centered_by: set
+           midpoint of color range. Default: None dist_metric: distance metric
+           used for clustering. Default: euclidean (https://docs.scipy.org/doc
+           /scipy/reference/generated/scipy.spatial.distance.pdist.html)
+           linkage_method: linkage method used for clustering. Default: ward (
+           https://docs.scipy.org/doc/scipy/reference/generated/scipy.cluster.
+           hierarchy.linkage.html) leaf_ordering: order of the dendrogram
+           leaves among the equivalent flips of the tree. none: as merged by
+           the linkage, optimal: adjacent leaves as close as possible (exact
+           up to optimal-leaf-ordering-max-leaves leaves, greedy above),
+           greedy: each merge flips its sub-trees so the leaves meeting at the
+           junction are closest. Default: none cluster_memory_budget_mb:
+           memory (in MB) exact clustering may use for its distance matrix.
+           Larger matrices are clustered with k-means pre-aggregation followed
+           by hierarchical clustering of the centroids. Default:
+           cluster-memory-budget-mb in deploy.cfg (4096) plotlyjs_mode: how
+           the report loads plotly.js. inline: embedded in the report html,
+           directory: written once as plotly.min.js next to the report html (a
+           batch index_page shares one copy next to index.html between its
+           reports), cdn: loaded from the plotly CDN. Default: inline
+           gzip_html: True if gzip precompressed copies (.gz) of the report
+           files should be written next to them. Default: False z_encoding:
+           how heatmap values are stored in the report html. json: plain JSON
+           numbers, float32: base64 encoded float32 array, uint16/uint8:
+           base64 encoded values quantised evenly over the color_scale,
+           sparse: base64 encoded CSR arrays of the non-zero float32 values.
+           Binary encodings are decoded in the browser. Default: json
+           raster_cell_threshold: matrices with more cells are drawn as a
+           server-side rendered image with a coarse hover layer instead of a
+           plotly heatmap, 0 disables rasterising. Default:
+           raster-cell-threshold of the module config (1000000)
+           raster_aggregation: how cells sharing an image pixel or a zoom
+           pyramid cell are combined, one of mean or max. Default: mean
+           tile_pyramid: store matrices longer than 256 cells on either axis
+           as a zoom pyramid of binary tiles in html_dir; the report shows the
+           overview level and fetches finer tiles on zoom, so html_dir has to
+           be served over http. Default: False color_scale: how colours are
+           spread over the values, computed from the data. quantile: evenly
+           over the value quantiles, log10: evenly over log10(value +
+           pseudo_count), diverging: symmetric around centered_by. Default:
+           diverging if centered_by is set, log10 otherwise pseudo_count:
+           added to the values of the log10 color_scale. Default: 1
+           color_clip_percent: values below this percentile and above 100 -
+           color_clip_percent share the end colours (0 to below 50). Default:
+           0 sparse: True if the matrix is mostly zeros (e.g. amplicon/OTU
+           tables). It is then kept as a sparse matrix while loading,
+           selecting top rows and clustering with the cosine, jaccard or
+           braycurtis dist_metric. Default: False precision: numeric type the
+           matrix is loaded, clustered and serialised in (float64 or float32).
+           float32 halves memory and payload size; the json z_encoding is then
+           replaced by float32. Default: float64 truncate_levels: cut the row
+           dendrogram to the merges up to this many levels below the root; the
+           rows of every cluster cut off are collapsed into one heatmap row
+           labelled with its first and last row and row count
+           truncate_distance: cut the row dendrogram to the merges above this
+           distance instead, collapsing rows the same way
+           truncate_aggregation: how collapsed rows are combined: mean, max or
+           sum. Default: mean profile: True to profile the call; html_dir then
+           also holds profile.pstats (cProfile statistics) and
+           profile.collapsed (sampled stacks for flame graphs). Setting the
+           KB_GENERICSREPORT_PROFILE environment variable profiles every call.
+           Default: False) -> structure: parameter "tsv_file_path" of String,
+           parameter "cluster_data" of type "boolean" (A boolean - 0 for
+           false, 1 for true.), parameter "sort_by_sum" of type "boolean" (A
+           boolean - 0 for false, 1 for true.), parameter "top_percent" of
+           Long, parameter "top_by" of String, parameter "centered_by" of
+           Double, parameter "dist_metric" of String, parameter
+           "linkage_method" of String, parameter "leaf_ordering" of String,
+           parameter "cluster_memory_budget_mb" of Long, parameter
+           "plotlyjs_mode" of String, parameter "gzip_html" of type "boolean"
+           (A boolean - 0 for false, 1 for true.), parameter "z_encoding" of
+           String, parameter "raster_cell_threshold" of Long, parameter
+           "raster_aggregation" of String, parameter "tile_pyramid" of type
            "boolean" (A boolean - 0 for false, 1 for true.), parameter
-           "top_percent" of Long, parameter "centered_by" of Double,
-           parameter "dist_metric" of String, parameter "linkage_method" of
-           String
-        :returns: instance of type "build_heatmap_html_result" -> structure:
-           parameter "html_dir" of String
+           "color_scale" of String, parameter "pseudo_count" of Double,
+           parameter "color_clip_percent" of Double, parameter "sparse" of
+           type "boolean" (A boolean - 0 for false, 1 for true.), parameter
+           "precision" of String, parameter "profile" of type "boolean" (A
+           boolean - 0 for false, 1 for true.), parameter "truncate_levels" of
+           Long, parameter "truncate_distance" of Double, parameter
+           "truncate_aggregation" of String
+        :returns: instance of type "build_heatmap_html_result" (html_dir:
+           directory of the generated heatmap report cluster_strategy:
+           clustering path taken for 'rows' and 'columns' (exact or
+           kmeans_two_stage). Only set when the data was clustered
+           value_summary: count, min, max, mean and approximate median of the
+           heatmap values metrics: seconds spent in every stage (<stage>_s:
+           read, select, sort, cluster, truncate, dendrogram, figure, write)
+           and in the parts of cluster spent on cluster_rows and
+           cluster_columns (which may run concurrently), with the peak RSS
+           (MB) during each stage (<stage>_peak_rss_mb), total_s, peak_rss_mb,
+           the rows and columns of the matrix, heatmap_rows after truncation
+           and output_bytes of html_dir) -> structure: parameter "html_dir" of
+           String, parameter "cluster_strategy" of mapping from String to
+           String, parameter "value_summary" of mapping from String to Double,
+           parameter "metrics" of mapping from String to Double
         """
         # ctx is the context object
         # return variables are: output
         #BEGIN build_heatmap_html
-        self.validate_params(params, ['tsv_file_path'],
-                             opt_param=['cluster_data', 'sort_by_sum', 'top_percent',
-                                        'dist_metric', 'linkage_method', 'centered_by'])
+        self.validate_params(params, ['tsv_file_path'], opt_param=self.HEATMAP_OPT_PARAMS)
         output = self.heatmap_util.build_heatmap_html(params)
         #END build_heatmap_html
 
@@ -95,6 +183,142 @@ class kb_GenericsReport:
                              'output is not type dict as required.')
         # return the results
         return [output]
+
+    def build_heatmap_html_batch(self, ctx, params):
+        """
+        :param params: instance of type "build_heatmap_html_batch_params"
+           (required params: params_list: build_heatmap_html parameter sets,
+           one heatmap per entry optional params: index_page: True if the
+           report directories should be collected under one directory with an
+           index.html linking every heatmap. Default: False) -> structure:
+           parameter "params_list" of list of type "build_heatmap_html_params"
+           (required params: tsv_file_path: matrix data in tsv format optional
+           params: cluster_data: True if data should be clustered. Default:
+           True sort_by_sum: True if data should be sorted by sum of values.
+           Default: False top_percent: Only display top x percent of data.
+           Default: 100 top_by: row statistic used to select the top_percent
+           rows (sum, mean, max or variance). Default: sum centered_by: set
+           midpoint of color range. Default: None dist_metric: distance metric
+           used for clustering. Default: euclidean (https://docs.scipy.org/doc
+           /scipy/reference/generated/scipy.spatial.distance.pdist.html)
+           linkage_method: linkage method used for clustering. Default: ward (
+           https://docs.scipy.org/doc/scipy/reference/generated/scipy.cluster.
+           hierarchy.linkage.html) leaf_ordering: order of the dendrogram
+           leaves among the equivalent flips of the tree. none: as merged by
+           the linkage, optimal: adjacent leaves as close as possible (exact
+           up to optimal-leaf-ordering-max-leaves leaves, greedy above),
+           greedy: each merge flips its sub-trees so the leaves meeting at the
+           junction are closest. Default: none cluster_memory_budget_mb:
+           memory (in MB) exact clustering may use for its distance matrix.
+           Larger matrices are clustered with k-means pre-aggregation followed
+           by hierarchical clustering of the centroids. Default:
+           cluster-memory-budget-mb in deploy.cfg (4096) plotlyjs_mode: how
+           the report loads plotly.js. inline: embedded in the report html,
+           directory: written once as plotly.min.js next to the report html (a
+           batch index_page shares one copy next to index.html between its
+           reports), cdn: loaded from the plotly CDN. Default: inline
+           gzip_html: True if gzip precompressed copies (.gz) of the report
+           files should be written next to them. Default: False z_encoding:
+           how heatmap values are stored in the report html. json: plain JSON
+           numbers, float32: base64 encoded float32 array, uint16/uint8:
+           base64 encoded values quantised evenly over the color_scale,
+           sparse: base64 encoded CSR arrays of the non-zero float32 values.
+           Binary encodings are decoded in the browser. Default: json
+           raster_cell_threshold: matrices with more cells are drawn as a
+           server-side rendered image with a coarse hover layer instead of a
+           plotly heatmap, 0 disables rasterising. Default:
+           raster-cell-threshold of the module config (1000000)
+           raster_aggregation: how cells sharing an image pixel or a zoom
+           pyramid cell are combined, one of mean or max. Default: mean
+           tile_pyramid: store matrices longer than 256 cells on either axis
+           as a zoom pyramid of binary tiles in html_dir; the report shows the
+           overview level and fetches finer tiles on zoom, so html_dir has to
+           be served over http. Default: False color_scale: how colours are
+           spread over the values, computed from the data. quantile: evenly
+           over the value quantiles, log10: evenly over log10(value +
+           pseudo_count), diverging: symmetric around centered_by. Default:
+           diverging if centered_by is set, log10 otherwise pseudo_count:
+           added to the values of the log10 color_scale. Default: 1
+           color_clip_percent: values below this percentile and above 100 -
+           color_clip_percent share the end colours (0 to below 50). Default:
+           0 sparse: True if the matrix is mostly zeros (e.g. amplicon/OTU
+           tables). It is then kept as a sparse matrix while loading,
+           selecting top rows and clustering with the cosine, jaccard or
+           braycurtis dist_metric. Default: False precision: numeric type the
+           matrix is loaded, clustered and serialised in (float64 or float32).
+           float32 halves memory and payload size; the json z_encoding is then
+           replaced by float32. Default: float64 truncate_levels: cut the row
+           dendrogram to the merges up to this many levels below the root; the
+           rows of every cluster cut off are collapsed into one heatmap row
+           labelled with its first and last row and row count
+           truncate_distance: cut the row dendrogram to the merges above this
+           distance instead, collapsing rows the same way
+           truncate_aggregation: how collapsed rows are combined: mean, max or
+           sum. Default: mean profile: True to profile the call; html_dir then
+           also holds profile.pstats (cProfile statistics) and
+           profile.collapsed (sampled stacks for flame graphs). Setting the
+           KB_GENERICSREPORT_PROFILE environment variable profiles every call.
+           Default: False) -> structure: parameter "tsv_file_path" of String,
+           parameter "cluster_data" of type "boolean" (A boolean - 0 for
+           false, 1 for true.), parameter "sort_by_sum" of type "boolean" (A
+           boolean - 0 for false, 1 for true.), parameter "top_percent" of
+           Long, parameter "top_by" of String, parameter "centered_by" of
+           Double, parameter "dist_metric" of String, parameter
+           "linkage_method" of String, parameter "leaf_ordering" of String,
+           parameter "cluster_memory_budget_mb" of Long, parameter
+           "plotlyjs_mode" of String, parameter "gzip_html" of type "boolean"
+           (A boolean - 0 for false, 1 for true.), parameter "z_encoding" of
+           String, parameter "raster_cell_threshold" of Long, parameter
+           "raster_aggregation" of String, parameter "tile_pyramid" of type
+           "boolean" (A boolean - 0 for false, 1 for true.), parameter
+           "color_scale" of String, parameter "pseudo_count" of Double,
+           parameter "color_clip_percent" of Double, parameter "sparse" of
+           type "boolean" (A boolean - 0 for false, 1 for true.), parameter
+           "precision" of String, parameter "profile" of type "boolean" (A
+           boolean - 0 for false, 1 for true.), parameter "truncate_levels" of
+           Long, parameter "truncate_distance" of Double, parameter
+           "truncate_aggregation" of String, parameter "index_page" of type
+           "boolean" (A boolean - 0 for false, 1 for true.)
+        :returns: instance of type "build_heatmap_html_batch_result" (results:
+           build_heatmap_html result of every parameter set, in params_list
+           order index_dir: directory holding index.html and the report
+           directories. Only set with index_page) -> structure: parameter
+           "results" of list of type "build_heatmap_html_result" (html_dir:
+           directory of the generated heatmap report cluster_strategy:
+           clustering path taken for 'rows' and 'columns' (exact or
+           kmeans_two_stage). Only set when the data was clustered
+           value_summary: count, min, max, mean and approximate median of the
+           heatmap values metrics: seconds spent in every stage (<stage>_s:
+           read, select, sort, cluster, truncate, dendrogram, figure, write)
+           and in the parts of cluster spent on cluster_rows and
+           cluster_columns (which may run concurrently), with the peak RSS
+           (MB) during each stage (<stage>_peak_rss_mb), total_s, peak_rss_mb,
+           the rows and columns of the matrix, heatmap_rows after truncation
+           and output_bytes of html_dir) -> structure: parameter "html_dir" of
+           String, parameter "cluster_strategy" of mapping from String to
+           String, parameter "value_summary" of mapping from String to Double,
+           parameter "metrics" of mapping from String to Double, parameter
+           "index_dir" of String
+        """
+        # ctx is the context object
+        # return variables are: output
+        #BEGIN build_heatmap_html_batch
+        self.validate_params(params, ['params_list'], opt_param=['index_page'])
+        # a missing tsv_file_path is reported with its params_list entry by
+        # build_heatmap_html_batch
+        for item_params in params.get('params_list') or []:
+            if isinstance(item_params, dict):
+                self.validate_params(item_params, [],
+                                     opt_param=['tsv_file_path'] + self.HEATMAP_OPT_PARAMS)
+        output = self.heatmap_util.build_heatmap_html_batch(params)
+        #END build_heatmap_html_batch
+
+        # At some point might do deeper type checking...
+        if not isinstance(output, dict):
+            raise ValueError('Method build_heatmap_html_batch return value ' +
+                             'output is not type dict as required.')
+        # return the results
+        return [output]
     def status(self, ctx):
         #BEGIN_STATUS
         returnVal = {'state': "OK",
@@ -342,6 +342,10 @@ class Application(object):
                              name='kb_GenericsReport.build_heatmap_html',
                              types=[dict])
         self.method_authentication['kb_GenericsReport.build_heatmap_html'] = 'required'  # noqa
+        self.rpc_service.add(impl_kb_GenericsReport.build_heatmap_html_batch,
+                             name='kb_GenericsReport.build_heatmap_html_batch',
+                             types=[dict])
+        self.method_authentication['kb_GenericsReport.build_heatmap_html_batch'] = 'required'  # noqa
         self.rpc_service.add(impl_kb_GenericsReport.status,
                              name='kb_GenericsReport.status',
                              types=[dict])
@@ -0,0 +1,82 @@
+"""
+benchmark_clustering: cost of handing a matrix to the clustering path as lists vs arrays
+
+Every run starts a fresh interpreter which clusters the rows and the columns of a synthetic
+matrix with the exact strategy, once passing them as lists of Python floats (the former
+_cluster_data behaviour) and once as contiguous float64 arrays. It reports the time spent
+preparing the axes and clustering, the memory blocks allocated while preparing them and the
+peak RSS of the run.
+
+usage: python scripts/benchmark_clustering.py [--rows N] [--columns N] [--repeat N]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+LIB_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'lib')
+
+MODES = ['lists', 'arrays']
+
+RUN_SCRIPT = """
+import json
+import resource
+import sys
+import time
+
+import numpy as np
+
+from kb_GenericsReport.Utils.ClusterUtil import EXACT_STRATEGY, compute_linkage
+
+rows, columns, mode = %d, %d, %r
+values = np.random.RandomState(0).lognormal(size=(rows, columns))
+
+blocks = sys.getallocatedblocks()
+start = time.perf_counter()
+if mode == 'lists':
+    axes = [values.T.tolist(), values.tolist()]
+else:
+    axes = [np.ascontiguousarray(values.T), values]
+prepared = time.perf_counter()
+allocated_blocks = sys.getallocatedblocks() - blocks
+
+for axis in axes:
+    compute_linkage(axis, 'euclidean', 'ward', EXACT_STRATEGY, None)
+clustered = time.perf_counter()
+
+print(json.dumps({'prepare_s': prepared - start,
+                  'cluster_s': clustered - prepared,
+                  'allocated_blocks': allocated_blocks,
+                  'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.}))
+"""
+
+
+def run_once(rows, columns, mode):
+    env = dict(os.environ,
+               PYTHONPATH=os.pathsep.join([LIB_DIR, os.environ.get('PYTHONPATH', '')]))
+    output = subprocess.check_output([sys.executable, '-c', RUN_SCRIPT % (rows, columns, mode)],
+                                     env=env)
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare list and array input of clustering')
+    parser.add_argument('--rows', type=int, default=5000, help='matrix rows')
+    parser.add_argument('--columns', type=int, default=1000, help='matrix columns')
+    parser.add_argument('--repeat', type=int, default=3, help='fresh interpreters per mode')
+    args = parser.parse_args()
+
+    summary = {'rows': args.rows, 'columns': args.columns, 'repeat': args.repeat}
+    for mode in MODES:
+        runs = [run_once(args.rows, args.columns, mode) for _ in range(args.repeat)]
+        summary[mode] = {key: statistics.median(run[key] for run in runs)
+                         for key in ['prepare_s', 'cluster_s', 'allocated_blocks',
+                                     'peak_rss_mb']}
+
+    print(json.dumps(summary, indent=2))
+
+
+if __name__ == '__main__':
+    main()
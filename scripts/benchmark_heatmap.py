@@ -0,0 +1,193 @@
+"""
+benchmark_heatmap: stage timings, peak memory and output size of build_heatmap_html
+
+Every case builds one heatmap from a synthetic matrix in a fresh interpreter, in-process and
+without any KBase service. Matrices are written once as TSV files into the work directory and
+reused by later runs. Dense matrices are log-normal abundances, sparse ones keep 5% of them
+and are read with the sparse param. Every shape and kind is run with every parameter set of
+--params, and the results are written as JSON so runs of different releases can be compared.
+
+Stages (seconds), taken from the metrics build_heatmap_html returns:
+  load        reading and parsing the matrix file, streamed top row selection included
+  filter      selecting the top_percent rows of a loaded matrix
+  cluster     clustering rows and columns
+  dendrogram  building the dendrogram figures
+  figure      building the plotly figure (colour scale, raster or tiles, encoding)
+  write       writing the report html
+  total       the whole build_heatmap_html call
+
+usage: python scripts/benchmark_heatmap.py [--shapes 100x10,1000x100] [--kinds dense,sparse]
+                                           [--params '[{}, {"z_encoding": "float32"}]']
+                                           [--repeat N] [--work-dir DIR] [--output FILE]
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+
+LIB_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'lib')
+
+DEFAULT_SHAPES = '100x10,1000x100,10000x500,100000x2000'
+# kind -> (share of non-zero values, build_heatmap_html params)
+KINDS = {'dense': (1., {}),
+         'sparse': (0.05, {'sparse': True})}
+STAGES = ['load', 'filter', 'cluster', 'dendrogram', 'figure', 'write', 'total']
+# benchmark stage -> build_heatmap_html metrics stage, where the names differ
+STAGE_METRICS = {'load': 'read',
+                 'filter': 'select'}
+
+SEED = 1234
+WRITE_BLOCK_ROWS = 10000
+
+
+def write_matrix(file_path, rows, columns, density):
+    """
+    write_matrix: synthetic abundance matrix as TSV, written in row blocks
+    """
+    import numpy as np
+
+    random_state = np.random.RandomState(SEED)
+    with open(file_path, 'w') as matrix_file:
+        matrix_file.write('\t'.join(['id'] + ['column_{}'.format(i) for i in range(columns)]))
+        matrix_file.write('\n')
+        for start in range(0, rows, WRITE_BLOCK_ROWS):
+            block_rows = min(WRITE_BLOCK_ROWS, rows - start)
+            values = np.rint(random_state.lognormal(mean=2, sigma=1.5,
+                                                    size=(block_rows, columns)))
+            if density < 1:
+                values[random_state.rand(block_rows, columns) >= density] = 0
+            for i, row in enumerate(values.astype(np.int64)):
+                matrix_file.write('row_{}\t'.format(start + i))
+                matrix_file.write('\t'.join(map(str, row)))
+                matrix_file.write('\n')
+
+
+def matrix_path(work_dir, rows, columns, kind):
+    file_path = os.path.join(work_dir, '{}_{}x{}.tsv'.format(kind, rows, columns))
+    if not os.path.exists(file_path):
+        tmp_path = '{}.tmp'.format(file_path)
+        write_matrix(tmp_path, rows, columns, KINDS[kind][0])
+        os.rename(tmp_path, file_path)
+
+    return file_path
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def run_case(case):
+    """
+    run_case: run one case in this interpreter, returns its measurements
+    """
+    sys.path.insert(0, LIB_DIR)
+    from kb_GenericsReport.Utils.HeatmapUtil import HeatmapUtil
+
+    scratch = tempfile.mkdtemp(prefix='benchmark_heatmap_')
+    # caches are disabled so every run parses and clusters
+    heatmap_util = HeatmapUtil({'SDK_CALLBACK_URL': 'http://localhost',
+                                'KB_AUTH_TOKEN': 'benchmark',
+                                'kbase-endpoint': 'http://localhost',
+                                'scratch': scratch,
+                                'matrix-cache-size-mb': 0,
+                                'linkage-cache-size-mb': 0})
+
+    params = dict(KINDS[case['kind']][1], tsv_file_path=case['file_path'], **case['params'])
+    result = heatmap_util.build_heatmap_html(params)
+    shutil.rmtree(scratch, ignore_errors=True)
+
+    # stage names of the metrics returned by build_heatmap_html
+    metrics = result['metrics']
+    stage_metrics = {stage: STAGE_METRICS.get(stage, stage) for stage in STAGES}
+    return {'stages_s': {stage: metrics.get('{}_s'.format(name), 0.)
+                         for stage, name in stage_metrics.items()},
+            'stage_peak_rss_mb': {stage: metrics['{}_peak_rss_mb'.format(name)]
+                                  for stage, name in stage_metrics.items()
+                                  if '{}_peak_rss_mb'.format(name) in metrics},
+            'peak_rss_mb': peak_rss_mb(),
+            'output_bytes': metrics['output_bytes'],
+            'cluster_strategy': result.get('cluster_strategy')}
+
+
+def run_isolated(case):
+    output = subprocess.check_output([sys.executable, os.path.abspath(__file__),
+                                      '--case', json.dumps(case)])
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def summarize(runs):
+    summary = {'stages_s': {stage: statistics.median(run['stages_s'][stage] for run in runs)
+                            for stage in STAGES},
+               'peak_rss_mb': max(run['peak_rss_mb'] for run in runs),
+               'output_bytes': runs[-1]['output_bytes'],
+               'cluster_strategy': runs[-1]['cluster_strategy'],
+               'stage_peak_rss_mb': runs[-1]['stage_peak_rss_mb']}
+    return summary
+
+
+def environment():
+    import numpy
+    import pandas
+    import plotly
+    import scipy
+
+    return {'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'numpy': numpy.__version__,
+            'pandas': pandas.__version__,
+            'scipy': scipy.__version__,
+            'plotly': plotly.__version__}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the build_heatmap_html pipeline')
+    parser.add_argument('--shapes', default=DEFAULT_SHAPES,
+                        help='comma separated ROWSxCOLUMNS matrix shapes')
+    parser.add_argument('--kinds', default=','.join(KINDS),
+                        help='comma separated matrix kinds ({})'.format(', '.join(KINDS)))
+    parser.add_argument('--params', default='[{}]',
+                        help='JSON list of build_heatmap_html parameter sets run on every matrix')
+    parser.add_argument('--repeat', type=int, default=3, help='fresh interpreters per case')
+    parser.add_argument('--work-dir', default=os.path.join(tempfile.gettempdir(),
+                                                           'benchmark_heatmap'),
+                        help='directory the synthetic matrices are kept in')
+    parser.add_argument('--output', help='JSON result file, printed if not set')
+    parser.add_argument('--case', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case:
+        print(json.dumps(run_case(json.loads(args.case))))
+        return
+
+    if not os.path.isdir(args.work_dir):
+        os.makedirs(args.work_dir)
+
+    results = {'environment': environment(), 'repeat': args.repeat, 'cases': list()}
+    for shape in args.shapes.split(','):
+        rows, columns = [int(size) for size in shape.lower().split('x')]
+        for kind in args.kinds.split(','):
+            file_path = matrix_path(args.work_dir, rows, columns, kind)
+            for params in json.loads(args.params):
+                case = {'file_path': file_path, 'kind': kind, 'params': params}
+                print('Running {} {} {}'.format(shape, kind, json.dumps(params)), file=sys.stderr)
+                runs = [run_isolated(case) for _ in range(args.repeat)]
+                results['cases'].append(dict(summarize(runs), shape=[rows, columns], kind=kind,
+                                             params=params))
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
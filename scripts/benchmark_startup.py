@@ -0,0 +1,79 @@
+"""
+benchmark_startup: cold start cost of the kb_GenericsReport service
+
+Every run starts a fresh interpreter which imports kb_GenericsReportImpl, constructs it and
+answers status, like a health check or a cold async job. It then imports the plotting and
+clustering stacks a first build_heatmap_html call loads on demand.
+
+usage: python scripts/benchmark_startup.py [--repeat N]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+LIB_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'lib')
+
+HEAVY_MODULES = ['pandas', 'scipy', 'matplotlib', 'plotly']
+
+RUN_SCRIPT = """
+import json
+import sys
+import time
+
+start = time.perf_counter()
+from kb_GenericsReport.kb_GenericsReportImpl import kb_GenericsReport
+imported = time.perf_counter()
+impl = kb_GenericsReport({'kbase-endpoint': 'https://kbase.us/services', 'scratch': %r})
+constructed = time.perf_counter()
+impl.status(None)
+status = time.perf_counter()
+loaded = [name for name in %r if name in sys.modules]
+
+import pandas
+import plotly.graph_objects
+import plotly.express
+import scipy.cluster.hierarchy
+first_use = time.perf_counter()
+
+print(json.dumps({'import_s': imported - start,
+                  'construct_s': constructed - imported,
+                  'status_s': status - constructed,
+                  'startup_s': status - start,
+                  'first_use_imports_s': first_use - status,
+                  'heavy_modules_at_startup': loaded}))
+"""
+
+
+def run_once(scratch):
+    env = dict(os.environ,
+               PYTHONPATH=os.pathsep.join([LIB_DIR, os.environ.get('PYTHONPATH', '')]),
+               SDK_CALLBACK_URL=os.environ.get('SDK_CALLBACK_URL', 'http://localhost'),
+               KB_AUTH_TOKEN=os.environ.get('KB_AUTH_TOKEN', 'benchmark'))
+    output = subprocess.check_output([sys.executable, '-c', RUN_SCRIPT % (scratch, HEAVY_MODULES)],
+                                     env=env)
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure kb_GenericsReport cold start time')
+    parser.add_argument('--repeat', type=int, default=5, help='number of fresh interpreters')
+    args = parser.parse_args()
+
+    scratch = tempfile.mkdtemp(prefix='benchmark_startup_')
+    runs = [run_once(scratch) for _ in range(args.repeat)]
+
+    summary = {key: statistics.median(run[key] for run in runs)
+               for key in ['import_s', 'construct_s', 'status_s', 'startup_s',
+                           'first_use_imports_s']}
+    summary['heavy_modules_at_startup'] = runs[-1]['heavy_modules_at_startup']
+    summary['repeat'] = args.repeat
+
+    print(json.dumps(summary, indent=2))
+
+
+if __name__ == '__main__':
+    main()
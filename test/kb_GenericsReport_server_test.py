@@ -1,12 +1,33 @@
 # -*- coding: utf-8 -*-
+import base64
 import os
+import pstats
+import re
 import time
 import unittest
 from configparser import ConfigParser
 
+import numpy as np
+import pandas as pd
+
 from kb_GenericsReport.kb_GenericsReportImpl import kb_GenericsReport
 from kb_GenericsReport.kb_GenericsReportServer import MethodContext
 from kb_GenericsReport.authclient import KBaseAuth as _KBaseAuth
+from kb_GenericsReport.Utils.ClusterUtil import (EXACT_STRATEGY, OPTIMAL_LEAF_ORDERING,
+                                                 collapse_rows, compute_linkage,
+                                                 greedy_leaf_ordering, truncate_linkage)
+from kb_GenericsReport.Utils.ColorScaleUtil import compute_color_scale
+from kb_GenericsReport.Utils.DendrogramUtil import build_dendrogram, dendrogram_segments
+from kb_GenericsReport.Utils.EncodingUtil import encode_z
+from kb_GenericsReport.Utils.HeatmapUtil import HeatmapUtil
+from kb_GenericsReport.Utils.MatrixCacheUtil import MatrixCache
+from kb_GenericsReport.Utils.MatrixUtil import read_matrix, read_top_rows
+from kb_GenericsReport.Utils.MetricsUtil import PipelineMetrics
+from kb_GenericsReport.Utils.ProfileUtil import PROFILE_STACKS_FILE, PROFILE_STATS_FILE
+from kb_GenericsReport.Utils.RasterUtil import bin_starts, block_reduce
+from kb_GenericsReport.Utils.SketchUtil import QuantileSketch, matrix_sketch
+from kb_GenericsReport.Utils.SparseUtil import is_sparse_frame, matrix_values, sparse_pdist
+from kb_GenericsReport.Utils.TileUtil import build_tile_pyramid
 
 from installed_clients.WorkspaceClient import Workspace
 
@@ -99,6 +120,19 @@ class kb_GenericsReportTest(unittest.TestCase):
 
         self.assertEqual(1, len(html_report_files))
 
+        metrics = returnVal['metrics']
+        self.assertEqual((metrics['rows'], metrics['columns']), (5, 8))
+        for stage in ['read', 'sort', 'cluster', 'cluster_rows', 'cluster_columns',
+                      'dendrogram', 'figure', 'write']:
+            self.assertGreaterEqual(metrics['{}_s'.format(stage)], 0)
+        # the per axis parts are contained in cluster, the stages add up to at most the total
+        stage_seconds = [seconds for name, seconds in metrics.items() if name.endswith('_s') and
+                         name not in ['total_s', 'cluster_rows_s', 'cluster_columns_s']]
+        self.assertLessEqual(sum(stage_seconds), metrics['total_s'])
+        self.assertGreater(metrics['peak_rss_mb'], 0)
+        self.assertEqual(metrics['output_bytes'],
+                         os.path.getsize(os.path.join(html_dir, html_report_files[0])))
+
         params = {'tsv_file_path': os.path.join('data', 'single_line.tsv')}
         returnVal = self.serviceImpl.build_heatmap_html(self.ctx, params)[0]
 
@@ -108,3 +142,514 @@ class kb_GenericsReportTest(unittest.TestCase):
         html_report_files = os.listdir(html_dir)
 
         self.assertEqual(1, len(html_report_files))
+
+    def test_cluster_data(self):
+        heatmap_util = self.serviceImpl.heatmap_util
+        data_df = heatmap_util._read_csv_file(os.path.join('data', 'amplicon_test.tsv'))
+
+        clustered_df, cluster_result = heatmap_util._cluster_data(data_df, 'euclidean', 'ward')
+
+        self.assertEqual(clustered_df.index.tolist(), cluster_result.row_order)
+        self.assertEqual(clustered_df.columns.tolist(), cluster_result.col_order)
+        self.assertEqual(cluster_result.row_linkage.shape, (data_df.index.size - 1, 4))
+        self.assertEqual(cluster_result.col_linkage.shape, (data_df.columns.size - 1, 4))
+
+        # both axes clustered in worker processes match the axes clustered in turn
+        parallel_util = HeatmapUtil(dict(heatmap_util.config,
+                                         **{'cluster-parallel-min-leaves': 1,
+                                            'linkage-cache-size-mb': 0}))
+        # forked while the RSS sampler thread of the metrics runs
+        metrics = PipelineMetrics()
+        _, parallel_result = parallel_util._cluster_data(data_df, 'cosine', 'average',
+                                                         metrics=metrics)
+        metrics.close()
+        self.assertCountEqual(metrics.parts, ['cluster_rows', 'cluster_columns'])
+        for values, linkage_matrix in [(data_df.values, parallel_result.row_linkage),
+                                       (data_df.values.T, parallel_result.col_linkage)]:
+            expected_linkage, _ = compute_linkage(values, 'cosine', 'average', EXACT_STRATEGY,
+                                                  heatmap_util.cluster_memory_budget)
+            np.testing.assert_allclose(linkage_matrix, expected_linkage)
+
+    def test_cluster_data_memory_budget(self):
+        heatmap_util = self.serviceImpl.heatmap_util
+        data_df = heatmap_util._read_csv_file(os.path.join('data', 'amplicon_test.tsv'))
+
+        # a budget too small for any distance matrix forces k-means pre-aggregation
+        clustered_df, cluster_result = heatmap_util._cluster_data(data_df, 'euclidean', 'ward',
+                                                                  memory_budget=1)
+
+        self.assertEqual(cluster_result.strategy, {'rows': 'kmeans_two_stage',
+                                                   'columns': 'kmeans_two_stage'})
+        self.assertCountEqual(clustered_df.index.tolist(), data_df.index.tolist())
+        self.assertEqual(cluster_result.row_linkage.shape, (data_df.index.size - 1, 4))
+
+    def test_build_dendrogram(self):
+        from scipy.cluster.hierarchy import dendrogram, linkage
+
+        values = np.random.RandomState(0).normal(size=(50, 4))
+        linkage_matrix = linkage(values, 'average')
+
+        # same links as scipy's recursive dendrogram
+        xs, ys = dendrogram_segments(linkage_matrix)
+        self.assertTrue(np.isnan(xs[4::5]).all())
+        links = np.column_stack([xs.reshape(-1, 5)[:, :4], ys.reshape(-1, 5)[:, :4]])
+        dn = dendrogram(linkage_matrix, no_plot=True)
+        expected = np.column_stack([dn['icoord'], dn['dcoord']])
+        np.testing.assert_allclose(links[np.lexsort(links.T)], expected[np.lexsort(expected.T)])
+
+        fig = build_dendrogram(linkage_matrix, list(range(50)), orientation='left')
+        self.assertEqual(len(fig.data), 1)
+
+        # a chain of 20000 merges is deeper than the default recursion limit
+        chain = np.arange(20000, dtype=float)[:, None] ** 2
+        fig = build_dendrogram(linkage(chain, 'single'), list(range(20000)))
+        self.assertEqual(len(fig.data), 1)
+
+    def test_leaf_ordering(self):
+        from scipy.cluster.hierarchy import leaves_list, linkage
+
+        # a random walk in shuffled order: neighbouring steps should end up adjacent
+        random_state = np.random.RandomState(0)
+        values = np.cumsum(random_state.normal(size=(300, 5)), axis=0)
+        values = values[random_state.permutation(300)]
+        linkage_matrix = linkage(values, 'ward')
+
+        def path_length(order):
+            return np.linalg.norm(np.diff(values[order], axis=0), axis=1).sum()
+
+        # same merges, only the children of some swapped
+        greedy_linkage = greedy_leaf_ordering(linkage_matrix, values, 'euclidean')
+        np.testing.assert_array_equal(greedy_linkage[:, 2:], linkage_matrix[:, 2:])
+        np.testing.assert_array_equal(np.sort(greedy_linkage[:, :2], axis=1),
+                                      np.sort(linkage_matrix[:, :2], axis=1))
+        self.assertLess(path_length(leaves_list(greedy_linkage)),
+                        path_length(leaves_list(linkage_matrix)))
+
+        _, optimal_order = compute_linkage(values, 'euclidean', 'ward', EXACT_STRATEGY, None,
+                                           leaf_ordering=OPTIMAL_LEAF_ORDERING)
+        self.assertLessEqual(path_length(optimal_order),
+                             path_length(leaves_list(greedy_linkage)) + 1e-9)
+
+        heatmap_util = self.serviceImpl.heatmap_util
+        data_df = heatmap_util._read_csv_file(os.path.join('data', 'amplicon_test.tsv'))
+        for leaf_ordering in ['optimal', 'greedy']:
+            clustered_df, cluster_result = heatmap_util._cluster_data(
+                                                data_df, 'euclidean', 'ward',
+                                                leaf_ordering=leaf_ordering)
+            self.assertEqual(clustered_df.index.tolist(), cluster_result.row_order)
+            self.assertCountEqual(cluster_result.row_order, data_df.index.tolist())
+
+        with self.assertRaisesRegex(ValueError, 'Please provide a leaf_ordering argument'):
+            heatmap_util.build_heatmap_html({'tsv_file_path': os.path.join('data',
+                                                                           'amplicon_test.tsv'),
+                                             'leaf_ordering': 'random'})
+
+    def test_truncate_rows(self):
+        from scipy import sparse
+        from scipy.cluster.hierarchy import leaves_list, linkage
+
+        values = np.random.RandomState(0).lognormal(size=(200, 4))
+        linkage_matrix = linkage(values, 'ward')
+        truncated_linkage, group_sizes = truncate_linkage(linkage_matrix, levels=1)
+        self.assertEqual(group_sizes.size, 4)
+        self.assertEqual(group_sizes.sum(), 200)
+        np.testing.assert_array_equal(leaves_list(truncated_linkage), np.arange(4))
+        _, group_sizes = truncate_linkage(linkage_matrix, distance=np.median(linkage_matrix[:, 2]))
+        self.assertEqual(group_sizes.size, 100)
+
+        ordered = values[leaves_list(linkage_matrix)]
+        starts = np.concatenate([[0], np.cumsum(group_sizes)[:-1]])
+        np.testing.assert_allclose(collapse_rows(ordered, group_sizes, how='sum'),
+                                   np.add.reduceat(ordered, starts, axis=0))
+        ordered[ordered < 2] = 0
+        for how in ['mean', 'max', 'sum']:
+            np.testing.assert_allclose(
+                        collapse_rows(sparse.csr_matrix(ordered), group_sizes, how=how).toarray(),
+                        collapse_rows(ordered, group_sizes, how=how))
+
+        heatmap_util = self.serviceImpl.heatmap_util
+        data_df = heatmap_util._read_csv_file(os.path.join('data', 'amplicon_test.tsv'))
+        clustered_df, cluster_result = heatmap_util._cluster_data(data_df, 'euclidean', 'ward')
+        collapsed_df, collapsed_result = heatmap_util._truncate_rows(clustered_df, cluster_result,
+                                                                     levels=0, how='max')
+        self.assertEqual(collapsed_df.index.tolist(), collapsed_result.row_order)
+        self.assertEqual(collapsed_df.index.size, 2)
+        np.testing.assert_array_equal(collapsed_df.max(), clustered_df.max())
+
+        params = {'tsv_file_path': os.path.join('data', 'amplicon_test.tsv'),
+                  'truncate_levels': 0}
+        returnVal = self.serviceImpl.build_heatmap_html(self.ctx, params)[0]
+        self.assertEqual(returnVal['metrics']['heatmap_rows'], 2)
+
+        with self.assertRaisesRegex(ValueError, 'Please provide either a truncate_levels'):
+            self.serviceImpl.build_heatmap_html(self.ctx, dict(params, truncate_distance=1))
+
+    def test_select_top_rows(self):
+        heatmap_util = self.serviceImpl.heatmap_util
+        data_df = heatmap_util._read_csv_file(os.path.join('data', 'amplicon_test.tsv'))
+
+        for top_by in ['sum', 'mean', 'max', 'variance']:
+            top_df = heatmap_util._select_top_rows(data_df, 40, top_by)
+            self.assertEqual(top_df.index.size, 2)
+
+        expected = data_df.sum(axis=1).sort_values(ascending=False).index[:2]
+        top_df = heatmap_util._select_top_rows(data_df, 40, 'sum')
+        self.assertCountEqual(top_df.index.tolist(), expected.tolist())
+
+    def test_read_csv_file(self):
+        heatmap_util = self.serviceImpl.heatmap_util
+
+        data_df = heatmap_util._read_csv_file(os.path.join('data', 'amplicon_test.tsv'))
+        self.assertEqual(data_df.shape, (6, 8))
+        self.assertTrue(all(dtype == 'float64' for dtype in data_df.dtypes))
+        self.assertEqual(data_df.index[0], 'GG_OTU_1')
+
+        csv_file = os.path.join(self.scratch, 'amplicon_test.csv')
+        data_df.to_csv(csv_file)
+        csv_df = heatmap_util._read_csv_file(csv_file)
+        self.assertTrue(csv_df.equals(data_df))
+
+    def test_read_csv_file_top_percent(self):
+        # without the matrix cache, top rows of delimited text are streamed by read_top_rows
+        heatmap_util = HeatmapUtil(dict(self.serviceImpl.heatmap_util.config,
+                                        **{'matrix-cache-size-mb': 0}))
+        self.assertIsNone(heatmap_util.matrix_cache)
+        data_file = os.path.join('data', 'amplicon_test.tsv')
+        data_df = heatmap_util._read_csv_file(data_file)
+
+        for top_by in ['sum', 'variance']:
+            streamed_df = heatmap_util._read_csv_file(data_file, top_percent=40, top_by=top_by)
+            expected_df = heatmap_util._select_top_rows(data_df, 40, top_by)
+            self.assertTrue(streamed_df.equals(expected_df))
+            self.assertTrue(read_top_rows(data_file, 40, top_by=top_by).equals(expected_df))
+
+        statistics = dict()
+        read_top_rows(data_file, 40, statistics=statistics)
+        self.assertCountEqual(statistics, ['sum', 'mean', 'max', 'variance'])
+        np.testing.assert_allclose(statistics['variance'], data_df.values.var(axis=1))
+
+    def test_read_matrix_line_breaks(self):
+        heatmap_util = self.serviceImpl.heatmap_util
+        # CR-only line breaks, and blank lines that are no rows
+        contents = {'cr_only.tsv': 'id\ta\tb\rr1\t1\t2\rr2\t3\t4\rr3\t5\t6\r',
+                    'blank_lines.tsv': 'id\ta\tb\nr1\t1\t2\n\n\nr2\t3\t4\nr3\t5\t6\n\n\n'}
+        for file_name, content in contents.items():
+            data_file = os.path.join(self.scratch, file_name)
+            with open(data_file, 'w', newline='') as matrix_file:
+                matrix_file.write(content)
+
+            data_df = read_matrix(data_file)
+            self.assertEqual(data_df.index.tolist(), ['r1', 'r2', 'r3'])
+            np.testing.assert_array_equal(data_df.values, [[1, 2], [3, 4], [5, 6]])
+
+            cache_dir = os.path.join(self.scratch, 'test_line_breaks_cache')
+            cached_df = MatrixCache(cache_dir, 1024 ** 2).load(data_file)
+            self.assertTrue(cached_df.equals(data_df))
+
+            top_df = read_top_rows(data_file, 67)
+            self.assertTrue(top_df.equals(heatmap_util._select_top_rows(data_df, 67, 'sum')))
+            self.assertEqual(top_df.index.tolist(), ['r2', 'r3'])
+
+    def test_matrix_cache(self):
+        data_file = os.path.join('data', 'amplicon_test.tsv')
+        cache_dir = os.path.join(self.scratch, 'test_matrix_cache')
+        matrix_cache = MatrixCache(cache_dir, 1024 ** 2)
+
+        data_df = matrix_cache.load(data_file)
+        self.assertEqual(len(os.listdir(cache_dir)), 1)
+
+        cached_df = matrix_cache.load(data_file)
+        self.assertTrue(cached_df.equals(data_df))
+
+        # a cache too small for the matrix falls back to reading the file
+        self.assertIsNone(MatrixCache(cache_dir + '_small', 8).load(data_file))
+        # text that may not fit is not parsed at all when ingest is off
+        self.assertFalse(MatrixCache(cache_dir + '_small', 8).fits(data_file))
+        self.assertIsNone(MatrixCache(cache_dir + '_new', 2 ** 20).load(data_file, ingest=False))
+        self.assertTrue(MatrixCache(cache_dir + '_new', 2 ** 20).fits(data_file))
+
+    def test_linkage_cache(self):
+        heatmap_util = self.serviceImpl.heatmap_util
+        data_df = heatmap_util._read_csv_file(os.path.join('data', 'amplicon_test.tsv'))
+
+        _, cluster_result = heatmap_util._cluster_data(data_df, 'cityblock', 'average')
+
+        cache_key = heatmap_util.linkage_cache.key(data_df.values, 'cityblock', 'average',
+                                                   cluster_result.row_strategy)
+        linkage_matrix, ordered_index = heatmap_util.linkage_cache.get(cache_key)
+        self.assertTrue((linkage_matrix == cluster_result.row_linkage).all())
+        self.assertEqual(data_df.index[ordered_index].tolist(), cluster_result.row_order)
+
+        _, cached_result = heatmap_util._cluster_data(data_df, 'cityblock', 'average')
+        self.assertIs(cached_result.row_linkage, cluster_result.row_linkage)
+
+        # the two-stage linkage of another memory budget is not reused
+        random_df = pd.DataFrame(np.random.RandomState(0).rand(400, 3))
+        _, large_result = heatmap_util._cluster_data(random_df, 'euclidean', 'ward',
+                                                     memory_budget=320000)
+        _, small_result = heatmap_util._cluster_data(random_df, 'euclidean', 'ward',
+                                                     memory_budget=2000)
+        self.assertEqual(small_result.row_strategy, 'kmeans_two_stage')
+        self.assertIsNot(small_result.row_linkage, large_result.row_linkage)
+
+    def test_build_heatmap_html_plotlyjs_directory(self):
+        params = {'tsv_file_path': os.path.join('data', 'amplicon_test.tsv'),
+                  'plotlyjs_mode': 'directory',
+                  'gzip_html': True}
+        returnVal = self.serviceImpl.heatmap_util.build_heatmap_html(params)
+
+        html_report_files = os.listdir(returnVal.get('html_dir'))
+        self.assertEqual(4, len(html_report_files))
+        self.assertIn('plotly.min.js', html_report_files)
+        self.assertIn('plotly.min.js.gz', html_report_files)
+
+    def test_encode_z(self):
+        data_df = self.serviceImpl.heatmap_util._read_csv_file(os.path.join('data',
+                                                                            'amplicon_test.tsv'))
+
+        encoded_z = encode_z(data_df.values, 'float32')
+        decoded_z = np.frombuffer(base64.b64decode(encoded_z['data']), dtype='<f4')
+        self.assertEqual(encoded_z['shape'], list(data_df.shape))
+        self.assertTrue((decoded_z.reshape(data_df.shape) == data_df.values).all())
+
+        encoded_z = encode_z(data_df.values, 'uint8')
+        quantized_z = np.frombuffer(base64.b64decode(encoded_z['data']), dtype='u1')
+        self.assertEqual(quantized_z.min(), 0)
+        self.assertEqual(quantized_z.max(), 255)
+
+        # log10 levels follow the colours, so small values keep their relative precision
+        values = np.random.RandomState(0).lognormal(0, 2, (50, 40))
+        relative_errors = list()
+        for transform in [None, {'type': 'log10', 'pseudo_count': 1.}]:
+            encoded_z = encode_z(values, 'uint8', transform=transform)
+            positions = encoded_z['tmin'] + np.frombuffer(
+                base64.b64decode(encoded_z['data']), dtype='u1').reshape(values.shape) * (
+                encoded_z['tmax'] - encoded_z['tmin']) / encoded_z['levels']
+            if transform is not None:
+                self.assertEqual(encoded_z['transform'], transform)
+                positions = 10 ** positions - 1
+            relative_errors.append(np.median(np.abs(positions - values) / values))
+        self.assertLess(relative_errors[1], 0.05)
+        self.assertLess(relative_errors[1], relative_errors[0] / 10)
+
+    def test_sparse_matrix(self):
+        from scipy import sparse
+        from scipy.spatial.distance import pdist
+
+        heatmap_util = self.serviceImpl.heatmap_util
+        data_file = os.path.join('data', 'amplicon_test.tsv')
+        data_df = heatmap_util._read_csv_file(data_file)
+
+        sparse_df = heatmap_util._read_csv_file(data_file, sparse=True)
+        self.assertTrue(is_sparse_frame(sparse_df))
+        self.assertTrue((matrix_values(sparse_df).toarray() == data_df.values).all())
+
+        top_df = heatmap_util._read_csv_file(data_file, top_percent=40, top_by='variance',
+                                             sparse=True)
+        self.assertEqual(top_df.index.tolist(),
+                         heatmap_util._select_top_rows(data_df, 40, 'variance').index.tolist())
+
+        random_state = np.random.RandomState(0)
+        counts = random_state.poisson(2, (30, 50)) * (random_state.rand(30, 50) < 0.2)
+        for metric, values in [('cosine', counts), ('braycurtis', counts),
+                               ('jaccard', counts > 0)]:
+            np.testing.assert_allclose(sparse_pdist(sparse.csr_matrix(values), metric),
+                                       pdist(values.astype(float), metric), atol=1e-12)
+
+        encoded_z = encode_z(matrix_values(sparse_df), 'sparse')
+        decoded_z = sparse.csr_matrix(
+            (np.frombuffer(base64.b64decode(encoded_z['data']), dtype='<f4'),
+             np.frombuffer(base64.b64decode(encoded_z['indices']), dtype='<i4'),
+             np.frombuffer(base64.b64decode(encoded_z['indptr']), dtype='<i4')),
+            shape=encoded_z['shape'])
+        self.assertTrue((decoded_z.toarray() == data_df.values).all())
+
+        returnVal = self.serviceImpl.build_heatmap_html(self.ctx, {'tsv_file_path': data_file,
+                                                                   'sparse': True,
+                                                                   'dist_metric': 'cosine',
+                                                                   'linkage_method': 'average',
+                                                                   'z_encoding': 'sparse'})[0]
+        self.assertEqual(returnVal['cluster_strategy'], {'rows': 'exact', 'columns': 'exact'})
+
+    def test_build_heatmap_html_sparse(self):
+        # mostly zero counts, so raster and tile aggregates are exact on both paths
+        random_state = np.random.RandomState(0)
+        counts = random_state.poisson(5, (600, 60)) * (random_state.rand(600, 60) < 0.1)
+        data_file = os.path.join(self.scratch, 'sparse_counts.tsv')
+        pd.DataFrame(counts, index=['r{}'.format(i) for i in range(600)],
+                     columns=['c{}'.format(i) for i in range(60)]).to_csv(data_file, sep='\t')
+
+        uuid_pattern = '[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}'
+        for params in [{}, {'raster_cell_threshold': 1}, {'tile_pyramid': True}]:
+            outputs = list()
+            for sparse in [False, True]:
+                returnVal = self.serviceImpl.heatmap_util.build_heatmap_html(
+                    dict(params, tsv_file_path=data_file, cluster_data=False, sparse=sparse))
+                output = dict()
+                for root, _, file_names in os.walk(returnVal['html_dir']):
+                    for file_name in file_names:
+                        with open(os.path.join(root, file_name), 'rb') as output_file:
+                            content = output_file.read()
+                        relative_path = os.path.relpath(os.path.join(root, file_name),
+                                                        returnVal['html_dir'])
+                        output[re.sub(uuid_pattern, '', relative_path)] = re.sub(
+                            uuid_pattern.encode(), b'', content)
+                outputs.append(output)
+            self.assertEqual(outputs[1], outputs[0])
+
+    def test_build_heatmap_html_float32(self):
+        heatmap_util = self.serviceImpl.heatmap_util
+        data_file = os.path.join('data', 'amplicon_test.tsv')
+
+        data_df = heatmap_util._read_csv_file(data_file, dtype=np.float32)
+        self.assertTrue(all(dtype == 'float32' for dtype in data_df.dtypes))
+        clustered_df, _ = heatmap_util._cluster_data(data_df, 'euclidean', 'ward')
+        self.assertTrue(all(dtype == 'float32' for dtype in clustered_df.dtypes))
+
+        returnVal = self.serviceImpl.build_heatmap_html(self.ctx, {'tsv_file_path': data_file,
+                                                                   'precision': 'float32'})[0]
+        html_report_files = os.listdir(returnVal['html_dir'])
+        with open(os.path.join(returnVal['html_dir'], html_report_files[0])) as html_report:
+            self.assertIn('"dtype": "float32"', html_report.read())
+
+        with self.assertRaisesRegex(ValueError, 'Please provide a precision argument'):
+            self.serviceImpl.build_heatmap_html(self.ctx, {'tsv_file_path': data_file,
+                                                           'precision': 'float16'})
+
+    def test_build_heatmap_html_profile(self):
+        params = {'tsv_file_path': os.path.join('data', 'amplicon_test.tsv'),
+                  'profile': True}
+        returnVal = self.serviceImpl.build_heatmap_html(self.ctx, params)[0]
+
+        html_dir = returnVal['html_dir']
+        stats = pstats.Stats(os.path.join(html_dir, PROFILE_STATS_FILE))
+        self.assertTrue(any(function_name == '_cluster_data'
+                            for _, _, function_name in stats.stats))
+        with open(os.path.join(html_dir, PROFILE_STACKS_FILE)) as stacks_file:
+            for line in stacks_file:
+                stack, count = line.rsplit(' ', 1)
+                self.assertIn('HeatmapUtil.py:build_heatmap_html', stack)
+                self.assertGreater(int(count), 0)
+
+    def test_build_heatmap_html_raster(self):
+        params = {'tsv_file_path': os.path.join('data', 'amplicon_test.tsv'),
+                  'raster_cell_threshold': 10,
+                  'raster_aggregation': 'max'}
+        returnVal = self.serviceImpl.heatmap_util.build_heatmap_html(params)
+
+        html_dir = returnVal['html_dir']
+        html_file = [name for name in os.listdir(html_dir) if name.endswith('.html')][0]
+        with open(os.path.join(html_dir, html_file)) as html:
+            self.assertIn('data:image/png;base64,', html.read())
+
+        values = np.arange(35.).reshape(7, 5)
+        row_starts = bin_starts(7, 3)
+        col_starts = bin_starts(5, 2)
+        self.assertEqual(block_reduce(values, row_starts, col_starts).shape, (3, 2))
+        self.assertEqual(block_reduce(values, row_starts, col_starts, how='max')[-1, -1], 34)
+
+    def test_build_tile_pyramid(self):
+        tile_dir = os.path.join(self.scratch, 'tiles_' + str(int(time.time() * 1000)))
+        values = np.arange(600 * 10, dtype=float).reshape(600, 10)
+
+        manifest, overview = build_tile_pyramid(values, tile_dir, tile_size=256)
+
+        # only the long axis is halved until the matrix fits into one tile
+        self.assertEqual([level['shape'] for level in manifest['levels']],
+                         [[600, 10], [300, 10], [150, 10]])
+        self.assertEqual(manifest['levels'][0]['tile_rows'], 3)
+        self.assertEqual(overview.shape, (150, 10))
+        self.assertEqual(overview[0, 0], values[:4, 0].mean())
+
+        tile = np.fromfile(os.path.join(tile_dir, '0', '2_0.bin'), dtype='<f4')
+        self.assertEqual(tile.size, (600 - 2 * 256) * 10)
+        self.assertTrue(os.path.isfile(os.path.join(tile_dir, 'pyramid.json')))
+
+    def test_build_heatmap_html_batch(self):
+        params_list = [{'tsv_file_path': os.path.join('data', 'amplicon_test.tsv'),
+                        'plotlyjs_mode': 'directory', 'gzip_html': True},
+                       {'tsv_file_path': os.path.join('data', 'amplicon_test.tsv'),
+                        'cluster_data': False, 'plotlyjs_mode': 'directory'},
+                       {'tsv_file_path': os.path.join('data', 'single_line.tsv')}]
+        returnVal = self.serviceImpl.build_heatmap_html_batch(
+                                                        self.ctx, {'params_list': params_list,
+                                                                   'index_page': True})[0]
+
+        # the directory plotlyjs_mode reports share one plotly.min.js next to index.html
+        index_files = os.listdir(returnVal['index_dir'])
+        self.assertIn('plotly.min.js', index_files)
+        self.assertIn('plotly.min.js.gz', index_files)
+        for result in returnVal['results'][:2]:
+            report_files = os.listdir(result['html_dir'])
+            self.assertNotIn('plotly.min.js', report_files)
+            report_file = [name for name in report_files if name.endswith('.html')][0]
+            with open(os.path.join(result['html_dir'], report_file)) as report_html:
+                self.assertIn('src="../plotly.min.js"', report_html.read())
+
+        self.assertEqual(len(returnVal['results']), len(params_list))
+        self.assertIn('cluster_strategy', returnVal['results'][0])
+        self.assertNotIn('cluster_strategy', returnVal['results'][1])
+
+        index_dir = returnVal['index_dir']
+        with open(os.path.join(index_dir, 'index.html')) as index_html:
+            index_content = index_html.read()
+        for i, result in enumerate(returnVal['results']):
+            self.assertEqual(os.path.dirname(result['html_dir']), index_dir)
+            self.assertIn('heatmap_{}/heatmap_report_'.format(i), index_content)
+
+        with self.assertRaisesRegex(ValueError, 'Please provide a tsv_file_path'):
+            self.serviceImpl.build_heatmap_html_batch(self.ctx, {'params_list': [{}]})
+
+        # a bad entry fails the call before any heatmap is built
+        bad_params_list = params_list + [{'tsv_file_path': params_list[0]['tsv_file_path'],
+                                          'color_scale': 'rainbow'}]
+        with self.assertRaisesRegex(ValueError, 'color_scale argument .* params_list entry 3'):
+            self.serviceImpl.build_heatmap_html_batch(self.ctx, {'params_list': bad_params_list})
+
+    def test_compute_color_scale(self):
+        values = matrix_sketch(np.array([[0, 0, 1], [10, 100, 1000]], dtype=float))
+
+        scale = compute_color_scale(values, 'diverging', centered_by=10)
+        self.assertEqual((scale['cmin'], scale['cmax']), (-980, 1000))
+
+        for color_scale in ['quantile', 'log10']:
+            scale = compute_color_scale(values, color_scale)
+            self.assertEqual((scale['cmin'], scale['cmax']), (0, 1000))
+            stops = [stop for stop, _ in scale['colorscale']]
+            self.assertEqual((stops[0], stops[-1]), (0, 1))
+            self.assertEqual(stops, sorted(set(stops)))
+
+        # log10 breaks are dense towards the low values
+        log_stops = [stop for stop, _ in compute_color_scale(values, 'log10')['colorscale']]
+        self.assertLess(log_stops[len(log_stops) // 2], 0.05)
+
+        with self.assertRaisesRegex(ValueError, 'Please provide a color_scale argument'):
+            self.serviceImpl.build_heatmap_html(self.ctx, {'tsv_file_path': 'a_file',
+                                                           'color_scale': 'rainbow'})
+
+    def test_quantile_sketch(self):
+        values = np.random.RandomState(0).lognormal(size=(400, 500))
+
+        # streamed in chunks into two sketches which are then merged
+        sketch = QuantileSketch()
+        other = QuantileSketch()
+        for i, chunk in enumerate(np.array_split(values, 20)):
+            (sketch if i % 2 else other).update(chunk)
+        sketch.merge(other)
+
+        self.assertEqual(sketch.count, values.size)
+        self.assertEqual((sketch.min, sketch.max), (values.min(), values.max()))
+        self.assertLess(sum(level.size for level in sketch.levels), 20 * sketch.capacity)
+
+        qs = np.array([0.01, 0.1, 0.5, 0.9, 0.99])
+        ranks = np.searchsorted(np.sort(values, axis=None), sketch.quantiles(qs)) / values.size
+        self.assertLess(np.abs(ranks - qs).max(), 0.01)
+
+        sketch_path = os.path.join(self.scratch, 'sketch.npz')
+        sketch.save(sketch_path)
+        loaded = QuantileSketch.load(sketch_path)
+        self.assertEqual(loaded.summary(), sketch.summary())
+
+        # clipping the top and bottom percent bounds the colour range by the percentiles
+        scale = compute_color_scale(sketch, 'quantile', clip_percent=1)
+        self.assertAlmostEqual((values < scale['cmax']).mean(), 0.99, delta=0.01)